@@ -1,6 +1,9 @@
 import os
 import sys
-from flask import Flask, render_template, request, redirect, url_for, flash, session, abort, jsonify
+import json
+import calendar
+from flask import Flask, render_template, request, redirect, url_for, flash, session, abort, jsonify, g, has_request_context
+from sqlalchemy import event
 from werkzeug.utils import secure_filename
 from datetime import datetime, date
 from apscheduler.schedulers.background import BackgroundScheduler
@@ -8,11 +11,11 @@ from apscheduler.triggers.cron import CronTrigger
 import pytz
 
 from config import Config
-from models import db, User, Shop, MenuItem, DailyMenu, Order, LineMessage, SystemSetting, IpBan, LoginLog
+from models import db, User, Shop, MenuItem, MenuAlias, DailyMenu, Order, SystemSetting, IpBan, LoginLog, ProcessedEvent, DuplicateEventError, run_with_retry, apply_sqlite_pragmas
+import ledger
 
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import Configuration, ApiClient, MessagingApi, ReplyMessageRequest, TextMessage
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
 
 # ── 初始化 ──────────────────────────────────────────────
@@ -20,11 +23,40 @@ app = Flask(__name__)
 app.config.from_object(Config)
 db.init_app(app)
 
-configuration = Configuration(access_token=app.config['LINE_CHANNEL_ACCESS_TOKEN'])
 handler = WebhookHandler(app.config['LINE_CHANNEL_SECRET'])
 
 from line_handler import OrderBot
+from menu_catalog import bump_version as bump_catalog_version
+from command_router import CommandRouter, CommandSpec
+from reply_cache import ReplyCache
+from durable_queue import DurableQueue
+from outbound import OutboundDispatcher
 order_bot = OrderBot(app.config)
+# 唯讀指令回覆與儀表板 KPI 共用；寫入訂單 / 帳本的交易 commit 後即失效
+reply_cache = ReplyCache(app.config['REPLY_CACHE_TTL'], app.config['REPLY_CACHE_SIZE']).watch()
+if app.config['OUTBOUND_QUEUE']:
+    order_bot.outbound = OutboundDispatcher(
+        order_bot.line,
+        DurableQueue(app.config['QUEUE_DB_PATH'], 'outbound',
+                     max_attempts=app.config['OUTBOUND_MAX_ATTEMPTS']),
+        rate_limits=app.config['LINE_RATE_LIMITS'])
+
+# ── LINE 訊息紀錄（批次寫入）──────────────────────────────
+from message_log import MessageLogWriter
+message_log = MessageLogWriter.from_config(app)
+
+# ── Webhook 非同步收件 ───────────────────────────────────
+from webhook_intake import WebhookIntake
+
+def _process_webhook(payload):
+    with app.app_context():
+        g.host_url = payload.get('host_url')
+        handler.handle(payload['body'], payload['signature'])
+
+webhook_intake = None
+if app.config['WEBHOOK_ASYNC']:
+    webhook_intake = WebhookIntake(DurableQueue(app.config['QUEUE_DB_PATH'], 'webhook'),
+                                   _process_webhook, workers=app.config['WEBHOOK_WORKERS'])
 
 # ── 排程 ────────────────────────────────────────────────
 def send_daily_summary():
@@ -34,17 +66,54 @@ def send_daily_summary():
         if summary and group_id:
             order_bot.send_push_message(group_id, summary)
 
+def reconcile_ledger():
+    """帳本與 orders 對帳，有誤差就修正並印出；順便清掉過期的 webhook 事件紀錄"""
+    with app.app_context():
+        drift = ledger.reconcile()
+        if drift:
+            print(f'帳本對帳：修正 {len(drift)} 人，例如 user_id={drift[0][0]}: {drift[0][1]} → {drift[0][2]}')
+        meals = ledger.reconcile_tallies()
+        if meals:
+            print(f'叫餐總表對帳：重建 {len(meals)} 餐，daily_menu_id={meals[:10]}')
+        ProcessedEvent.prune()
+        db.session.commit()
+
 scheduler = BackgroundScheduler(timezone=pytz.timezone('Asia/Taipei'))
 if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
     h = app.config['DAILY_PUSH_HOUR']
     m = app.config['DAILY_PUSH_MINUTE']
     scheduler.add_job(send_daily_summary, CronTrigger(hour=h, minute=m, timezone=pytz.timezone('Asia/Taipei')),
                       id='daily_summary', replace_existing=True)
+    scheduler.add_job(reconcile_ledger, CronTrigger(hour=4, minute=0, timezone=pytz.timezone('Asia/Taipei')),
+                      id='reconcile_ledger', replace_existing=True)
     scheduler.start()
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# ── SQL 查詢計數（除錯用）────────────────────────────────
+# debug 模式或 SQL_QUERY_COUNTER=1 時，每個請求回應帶 X-SQL-Queries，超過 SQL_QUERY_WARN 印出警告
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+
+@app.before_request
+def _start_query_count():
+    if app.debug or app.config['SQL_QUERY_COUNTER']:
+        g.sql_queries = 0
+
+@app.after_request
+def _report_query_count(response):
+    count = g.get('sql_queries')
+    if count is not None:
+        response.headers['X-SQL-Queries'] = str(count)
+        if count > app.config['SQL_QUERY_WARN']:
+            print(f'⚠️ {request.method} {request.path} 送出 {count} 個 SQL 查詢'
+                  f'（上限 {app.config["SQL_QUERY_WARN"]}），可能有 N+1')
+    return response
+
 with app.app_context():
+    apply_sqlite_pragmas(db.engine, app.config['SQLITE_PRAGMAS'])
+    event.listen(db.engine, 'before_cursor_execute', _count_query)
     db.create_all()
     # ── SQLite 欄位 Migration ───────────────────────────
     with db.engine.connect() as conn:
@@ -52,16 +121,33 @@ with app.app_context():
             'ALTER TABLE shops ADD COLUMN phone VARCHAR(30)',
             'ALTER TABLE shops ADD COLUMN business_days VARCHAR(7) DEFAULT "1111111"',
             'ALTER TABLE orders ADD COLUMN note VARCHAR(200)',
+            'ALTER TABLE orders ADD COLUMN raw_item VARCHAR(200)',
             'ALTER TABLE users ADD COLUMN role VARCHAR(20) DEFAULT "user"',
             'ALTER TABLE users ADD COLUMN username VARCHAR(50)',
             'ALTER TABLE users ADD COLUMN password_enc TEXT',
             'ALTER TABLE users ADD COLUMN must_change_pw BOOLEAN DEFAULT 1',
+            'ALTER TABLE menu_aliases ADD COLUMN confirmed BOOLEAN NOT NULL DEFAULT 0',
         ]:
             try:
                 conn.execute(db.text(ddl))
                 conn.commit()
             except Exception:
                 pass
+        # 補上 models.py __table_args__ 宣告的索引（create_all 不會替已存在的表建索引）
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                try:
+                    index.create(conn, checkfirst=True)
+                    conn.commit()
+                except Exception as e:
+                    print(f'建立索引 {index.name} 失敗: {e}')
+        # 舊資料可能留有指向已刪除品項的訂單（開啟 foreign_keys 前沒有檢查）
+        try:
+            conn.execute(db.text('UPDATE orders SET menu_item_id = NULL '
+                                 'WHERE menu_item_id IS NOT NULL AND menu_item_id NOT IN (SELECT id FROM menu_items)'))
+            conn.commit()
+        except Exception:
+            pass
         # 修正舊 admin 角色
         try:
             conn.execute(db.text("UPDATE users SET role='admin' WHERE is_admin=1 AND (role IS NULL OR role='user')"))
@@ -121,6 +207,9 @@ with app.app_context():
         provider.must_change_pw = False
         db.session.commit()
 
+# 啟動時先對帳一次（第一次升級時也會從 orders 建出整份帳本）
+reconcile_ledger()
+
 # ── AES 加解密 ──────────────────────────────────────────
 import base64, hashlib, random, string
 from cryptography.fernet import Fernet
@@ -331,21 +420,41 @@ def favicon():
 def health():
     return 'OK', 200
 
+@app.route('/metrics')
+@login_required(roles=['provider', 'admin'])
+def metrics():
+    return jsonify({
+        'webhook': webhook_intake.metrics() if webhook_intake else {'mode': 'sync'},
+        'line_api': order_bot.line.stats(),
+        'outbound': order_bot.outbound.metrics() if order_bot.outbound else {'mode': 'direct'},
+        'commands': command_router.metrics(),
+        'reply_cache': reply_cache.metrics(),
+        'message_log': message_log.metrics(),
+        'menu_alias': order_bot.aliases.metrics(),
+        'menu_match_cache': order_bot.match_cache.metrics(),
+    })
+
 # ── 儀表板 ──────────────────────────────────────────────
 @app.route('/dashboard')
 @login_required(admin_only=True)
 def dashboard():
     user = get_current_user()
     today = date.today()
-    today_orders = Order.query.join(DailyMenu).filter(DailyMenu.menu_date == today).all()
-    total = sum(o.amount for o in today_orders)
-    paid = sum(o.amount for o in today_orders if o.paid)
-    unpaid_all = sum(o.amount for o in Order.query.filter_by(paid=False).all())
+    today_orders = Order.for_date(today).order_by(Order.id).all()
     return render_template('dashboard.html', user=user, today=today,
-                           today_orders=today_orders, total=total,
-                           paid=paid, unpaid=total - paid, unpaid_all=unpaid_all,
+                           today_orders=today_orders, kpi=dashboard_kpis(),
                            meal_types=app.config['MEAL_TYPES'])
 
+def dashboard_kpis():
+    """今日訂單數 / 總額 / 已收 / 未收與累計未收：SQL 加總，結果放在 reply_cache（訂單異動即失效）"""
+    return reply_cache.get_or_compute(('dashboard_kpi',), lambda: ledger.day_kpis(date.today()))
+
+@app.route('/dashboard/kpi')
+@login_required(admin_only=True)
+def dashboard_kpi():
+    """儀表板輪詢用：只回 KPI，不重新渲染整頁"""
+    return jsonify(dashboard_kpis())
+
 # ── 使用者管理 ───────────────────────────────────────────
 @app.route('/users')
 @login_required(admin_only=True)
@@ -396,6 +505,7 @@ def delete_user(uid):
         flash('無法刪除管理員', 'error')
     else:
         name = u.name
+        ledger.user_removed(u.id)
         db.session.delete(u)
         db.session.commit()
         flash(f'✅ 已刪除：{name}', 'success')
@@ -454,6 +564,7 @@ def guide_provider():
     return render_template('guide_provider.html', user=get_current_user())
 
 # ── User 個人入口 ────────────────────────────────────────
+UNPAID_DETAIL_LIMIT = 50
 @app.route('/user-portal')
 @login_required(roles=['provider', 'admin', 'user'])
 def user_portal():
@@ -463,45 +574,98 @@ def user_portal():
         DailyMenu.menu_date == today,
         Order.user_id == user.id
     ).all()
-    # 未付款
-    unpaid = [o for o in Order.query.filter_by(user_id=user.id, paid=False).all()]
-    unpaid_total = sum(o.amount for o in unpaid)
+    # 未付款：金額 / 筆數直接讀帳本，明細只列最近幾筆
+    unpaid_total, unpaid_count = ledger.balance(user.id)
+    unpaid = []
+    if unpaid_count:
+        unpaid = (Order.query.join(DailyMenu)
+                  .filter(Order.user_id == user.id, Order.paid == False)
+                  .order_by(DailyMenu.menu_date.desc(), Order.id.desc())
+                  .limit(UNPAID_DETAIL_LIMIT).all())
     return render_template('user_portal.html', user=user,
                            today_orders=today_orders,
-                           unpaid=unpaid, unpaid_total=unpaid_total,
+                           unpaid=unpaid, unpaid_total=unpaid_total, unpaid_count=unpaid_count,
                            today=today)
 
+HISTORY_PAGE_SIZE = 50
+HISTORY_PAGE_MAX = 200
+
 @app.route('/user-portal/history')
 @login_required(roles=['provider', 'admin', 'user'])
 def user_portal_history():
+    """
+    個人消費紀錄（JSON）：依 (日期, id) 由新到舊的 cursor 分頁
+    - 第一頁（沒帶 cursor）另外用 SQL 加總整個區間的筆數 / 金額
+    - 一頁最多 HISTORY_PAGE_MAX 筆；帶 ETag，內容沒變時回 304
+    """
     user = get_current_user()
     start_str = request.args.get('start', '')
     end_str   = request.args.get('end', '')
+    month_start = date.today().replace(day=1)
     try:
-        start_date = datetime.strptime(start_str, '%Y-%m-%d').date() if start_str else date(date.today().year, 1, 1)
+        start_date = datetime.strptime(start_str, '%Y-%m-%d').date() if start_str else month_start
         end_date   = datetime.strptime(end_str,   '%Y-%m-%d').date() if end_str   else date.today()
     except ValueError:
-        start_date, end_date = date(date.today().year, 1, 1), date.today()
-    orders = Order.query.join(DailyMenu).filter(
-        Order.user_id == user.id,
-        DailyMenu.menu_date >= start_date,
-        DailyMenu.menu_date <= end_date,
-    ).order_by(DailyMenu.menu_date.desc()).all()
-    total = sum(o.amount for o in orders)
-    paid  = sum(o.amount for o in orders if o.paid)
-    return jsonify({
-        'orders': [{
-            'date': o.daily_menu.menu_date.strftime('%Y/%m/%d'),
-            'meal_type': o.daily_menu.meal_type,
-            'items': o.items,
-            'amount': o.amount,
-            'paid': o.paid,
-            'shop': o.daily_menu.shop.name if o.daily_menu.shop_id else '未記錄',
-        } for o in orders],
-        'total': total, 'paid': paid, 'unpaid': total - paid,
-        'start': start_date.strftime('%Y/%m/%d'),
-        'end':   end_date.strftime('%Y/%m/%d'),
-    })
+        start_date, end_date = month_start, date.today()
+    limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_PAGE_MAX)
+    cursor = None
+    if request.args.get('cursor'):
+        try:
+            cursor_date, cursor_id = request.args['cursor'].split(':')
+            cursor = (datetime.strptime(cursor_date, '%Y-%m-%d').date(), int(cursor_id))
+        except ValueError:
+            return jsonify({'error': 'cursor 格式錯誤'}), 400
+
+    in_range = (Order.user_id == user.id,
+                DailyMenu.menu_date >= start_date,
+                DailyMenu.menu_date <= end_date)
+    q = (db.session.query(Order.id, DailyMenu.menu_date, DailyMenu.meal_type,
+                          Order.items, Order.amount, Order.paid, Shop.name)
+         .join(DailyMenu, Order.daily_menu_id == DailyMenu.id)
+         .outerjoin(Shop, DailyMenu.shop_id == Shop.id)
+         .filter(*in_range))
+    if cursor:
+        q = q.filter(db.or_(DailyMenu.menu_date < cursor[0],
+                            db.and_(DailyMenu.menu_date == cursor[0], Order.id < cursor[1])))
+    rows = q.order_by(DailyMenu.menu_date.desc(), Order.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f'{rows[-1].menu_date:%Y-%m-%d}:{rows[-1].id}'
+
+    summary = {'next_cursor': next_cursor,
+               'start': start_date.strftime('%Y/%m/%d'),
+               'end':   end_date.strftime('%Y/%m/%d')}
+    if cursor is None:
+        count, total, paid = (
+            db.session.query(db.func.count(Order.id),
+                             db.func.coalesce(db.func.sum(Order.amount), 0.0),
+                             db.func.coalesce(db.func.sum(db.case((Order.paid == True, Order.amount), else_=0.0)), 0.0))
+            .select_from(Order)
+            .join(DailyMenu, Order.daily_menu_id == DailyMenu.id)
+            .filter(*in_range)
+            .one())
+        summary.update(count=count, total=total, paid=paid, unpaid=total - paid)
+
+    # 整頁序列化後再算 ETag
+    body = json.dumps({'orders': [{
+        'date': r.menu_date.strftime('%Y/%m/%d'),
+        'meal_type': r.meal_type,
+        'items': r.items,
+        'amount': r.amount,
+        'paid': r.paid,
+        'shop': r.name or '未記錄',
+    } for r in rows], **summary}, ensure_ascii=False)
+    etag = hashlib.sha1(f'{user.id}:{body}'.encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+        return resp
+
+    resp = app.response_class(body, mimetype='application/json')
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
 
 # ── Provider 後台 ────────────────────────────────────────
 @app.route('/provider/panel')
@@ -573,6 +737,7 @@ def provider_delete_admin(uid):
     if u.role != 'admin':
         flash('只能刪除 Admin 帳號', 'error')
     else:
+        ledger.user_removed(u.id)
         db.session.delete(u)
         db.session.commit()
         flash(f'✅ 已刪除 {u.username}', 'success')
@@ -594,6 +759,7 @@ def add_shop():
         s = Shop(name=name, category=category, phone=phone, business_days=business_days)
         s.meal_types = meal_types or ['lunch']
         db.session.add(s)
+        bump_catalog_version()
         db.session.commit()
         flash(f'✅ 已新增：{name}', 'success')
     return redirect(url_for('manage_shops'))
@@ -610,6 +776,7 @@ def edit_shop(sid):
     s.business_days = ''.join(
         '1' if request.form.get(f'day_{i}') else '0' for i in range(7)
     )
+    bump_catalog_version()
     db.session.commit()
     flash(f'✅ 已更新：{s.name}', 'success')
     return redirect(url_for('manage_shops'))
@@ -619,6 +786,7 @@ def edit_shop(sid):
 def toggle_shop(sid):
     s = db.get_or_404(Shop, sid)
     s.is_active = not s.is_active
+    bump_catalog_version()
     db.session.commit()
     flash(f'{"✅ 已啟用" if s.is_active else "⏸️ 已停用"}：{s.name}', 'success')
     return redirect(url_for('manage_shops'))
@@ -629,6 +797,7 @@ def delete_shop(sid):
     s = db.get_or_404(Shop, sid)
     name = s.name
     db.session.delete(s)
+    bump_catalog_version()
     db.session.commit()
     flash(f'✅ 已刪除：{name}', 'success')
     return redirect(url_for('manage_shops'))
@@ -657,6 +826,7 @@ def ocr_menu(sid):
     f.save(filepath)
     s.menu_image = ts + filename
     s.last_updated = datetime.utcnow()
+    bump_catalog_version()
     db.session.commit()
 
     # 呼叫 OpenRouter AI (Baidu Qianfan OCR Fast)
@@ -732,7 +902,11 @@ def ocr_menu(sid):
 @login_required(admin_only=True)
 def delete_all_menu_items(sid):
     shop = db.get_or_404(Shop, sid)
+    MenuAlias.query.filter_by(shop_id=shop.id).delete()
+    (Order.query.filter(Order.menu_item_id.in_(db.select(MenuItem.id).where(MenuItem.shop_id == shop.id)))
+     .update({'menu_item_id': None}, synchronize_session=False))
     MenuItem.query.filter_by(shop_id=shop.id).delete()
+    bump_catalog_version()
     db.session.commit()
     flash('✅ 已清空所有品項', 'success')
     return redirect(url_for('manage_menu', sid=sid))
@@ -751,6 +925,7 @@ def save_ocr_menu(sid):
         except ValueError:
             price = None
         db.session.add(MenuItem(shop_id=sid, name=name, price=price))
+    bump_catalog_version()
     db.session.commit()
     session.pop('ocr_result', None)
     flash('✅ 菜單品項已儲存', 'success')
@@ -766,6 +941,7 @@ def add_menu_item(sid):
         flash('請填寫品項名稱', 'error')
     else:
         db.session.add(MenuItem(shop_id=sid, name=name, price=price))
+        bump_catalog_version()
         db.session.commit()
         flash(f'✅ 已新增：{name}', 'success')
     return redirect(url_for('manage_menu', sid=sid))
@@ -778,6 +954,7 @@ def edit_menu_item(sid, iid):
     price_str = request.form.get('price', '').strip()
     item.price = float(price_str) if price_str else None
     item.is_available = 'is_available' in request.form
+    bump_catalog_version()
     db.session.commit()
     flash('✅ 已更新品項', 'success')
     return redirect(url_for('manage_menu', sid=sid))
@@ -787,6 +964,7 @@ def edit_menu_item(sid, iid):
 def delete_menu_item(sid, iid):
     item = db.get_or_404(MenuItem, iid)
     db.session.delete(item)
+    bump_catalog_version()
     db.session.commit()
     flash('✅ 已刪除品項', 'success')
     return redirect(url_for('manage_menu', sid=sid))
@@ -816,18 +994,17 @@ def add_order():
             except ValueError:
                 order_date = date.today()
 
-            dm = DailyMenu.query.filter_by(menu_date=order_date, meal_type=meal_type).first()
-            if not dm:
-                dm = DailyMenu(menu_date=order_date, meal_type=meal_type)
-                db.session.add(dm)
-                db.session.commit()
-
             amount = float(amount_str) if amount_str else 0.0
-            order = Order(user_id=user.id, daily_menu_id=dm.id,
-                          items=item_name, amount=amount,
-                          payer_id=payer.id if payer else None)
-            db.session.add(order)
-            db.session.commit()
+
+            def write():
+                dm = DailyMenu.get_or_create(order_date, meal_type)
+                rows = [{'user_id': user.id, 'daily_menu_id': dm.id,
+                         'items': item_name, 'amount': amount,
+                         'payer_id': payer.id if payer else None}]
+                ledger.orders_added(rows)
+                return Order.insert_many(rows)
+
+            run_with_retry(write)
             flash(f'✅ 已補登：{user.name} - {item_name}', 'success')
             return redirect(url_for('add_order'))
 
@@ -845,10 +1022,7 @@ def accounting():
     except ValueError:
         target_date = date.today()
 
-    orders = (Order.query
-              .join(DailyMenu)
-              .join(User, Order.user_id == User.id)
-              .filter(DailyMenu.menu_date == target_date)
+    orders = (Order.for_date(target_date)
               .order_by(db.cast(User.user_code, db.Integer))
               .all())
 
@@ -863,9 +1037,18 @@ def accounting():
 
     total = sum(o.amount for o in orders)
     paid = sum(o.amount for o in orders if o.paid)
+
+    # 當天店家的菜單（修正品項用）
+    shop_ids = {o.daily_menu.shop_id for o in orders if o.daily_menu.shop_id}
+    shop_items = {}
+    if shop_ids:
+        for item in (MenuItem.query.filter(MenuItem.shop_id.in_(shop_ids)).filter_by(is_available=True)
+                     .order_by(MenuItem.id)):
+            shop_items.setdefault(item.shop_id, []).append(item)
     return render_template('accounting.html', user=get_current_user(),
                            target_date=target_date, by_user=by_user,
                            total=total, paid=paid, unpaid=total - paid,
+                           shop_items=shop_items,
                            meal_types=app.config['MEAL_TYPES'])
 
 @app.route('/orders/<int:oid>/toggle_paid', methods=['POST'])
@@ -873,9 +1056,27 @@ def accounting():
 def toggle_paid(oid):
     o = db.get_or_404(Order, oid)
     o.paid = not o.paid
+    ledger.order_changed(o, o.amount, not o.paid)
     db.session.commit()
     return redirect(request.referrer or url_for('accounting'))
 
+@app.route('/orders/settle', methods=['POST'])
+@login_required(admin_only=True)
+def settle_orders():
+    """記帳頁批次結清：某人（或所有人）某一天的未付款訂單一次標記為已付"""
+    date_str = request.form.get('date', '')
+    try:
+        target_date = datetime.strptime(date_str, '%Y-%m-%d').date()
+    except ValueError:
+        flash('❌ 日期格式錯誤', 'error')
+        return redirect(request.referrer or url_for('accounting'))
+    user_id = request.form.get('user_id', type=int)
+    settled = run_with_retry(lambda: ledger.settle(user_id, date_from=target_date, date_to=target_date))
+    count = sum(c for c, _ in settled.values())
+    total = sum(t for _, t in settled.values())
+    flash(f'✅ 已結清 {count} 筆，共 ${int(total)}', 'success')
+    return redirect(request.referrer or url_for('accounting', date=date_str))
+
 @app.route('/debug_menu')
 @login_required(admin_only=True)
 def debug_menu():
@@ -897,36 +1098,115 @@ def update_order_amount(oid):
     o = db.get_or_404(Order, oid)
     try:
         new_amount = float(request.form.get('amount', 0))
+        old_amount = o.amount
         o.amount = new_amount
+        ledger.order_changed(o, old_amount, o.paid)
         db.session.commit()
         flash('✅ 已更新金額', 'success')
     except ValueError:
         flash('❌ 金額格式錯誤', 'error')
     return redirect(request.referrer or url_for('accounting'))
 
+@app.route('/orders/<int:oid>/item', methods=['POST'])
+@login_required(admin_only=True)
+def update_order_item(oid):
+    """修正比對錯的品項；同時把使用者原本的打法記成別名"""
+    o = db.get_or_404(Order, oid)
+    item = db.session.get(MenuItem, request.form.get('menu_item_id', type=int) or 0)
+    if not item:
+        flash('❌ 品項不存在', 'error')
+        return redirect(request.referrer or url_for('accounting'))
+    old_amount, old_items = o.amount, o.items
+    o.menu_item_id = item.id
+    o.items = f'{item.name} ({o.note})' if o.note else item.name
+    if item.price is not None:
+        o.amount = item.price
+    ledger.order_changed(o, old_amount, o.paid, old_items)
+    if o.raw_item:
+        order_bot.aliases.remember(item.shop_id, [(o.raw_item, item.id)], confirmed=True)
+    db.session.commit()
+    flash(f'✅ 已改為：{item.name}', 'success')
+    return redirect(request.referrer or url_for('accounting'))
+
 @app.route('/orders/<int:oid>/delete', methods=['POST'])
 @login_required(admin_only=True)
 def delete_order(oid):
     o = db.get_or_404(Order, oid)
+    ledger.order_removed(o)
     db.session.delete(o)
     db.session.commit()
     flash('✅ 已刪除訂單', 'success')
     return redirect(request.referrer or url_for('accounting'))
 
+# ── 品名別名 ────────────────────────────────────────────
+@app.route('/aliases')
+@login_required(admin_only=True)
+def manage_aliases():
+    aliases = (MenuAlias.query
+               .join(Shop, MenuAlias.shop_id == Shop.id)
+               .join(MenuItem, MenuAlias.menu_item_id == MenuItem.id)
+               .options(db.contains_eager(MenuAlias.shop), db.contains_eager(MenuAlias.menu_item))
+               .order_by(Shop.name, MenuAlias.hits.desc(), MenuAlias.normalized_input)
+               .all())
+    return render_template('manage_aliases.html', user=get_current_user(),
+                           aliases=aliases, stats=order_bot.aliases.metrics(),
+                           trust_hits=order_bot.aliases.trust_hits)
+
+@app.route('/aliases/confirm/<int:aid>', methods=['POST'])
+@login_required(admin_only=True)
+def confirm_alias(aid):
+    a = db.get_or_404(MenuAlias, aid)
+    a.confirmed = True
+    db.session.commit()
+    flash(f'✅ 已確認別名：{a.normalized_input}', 'success')
+    return redirect(url_for('manage_aliases'))
+
+@app.route('/aliases/delete/<int:aid>', methods=['POST'])
+@login_required(admin_only=True)
+def delete_alias(aid):
+    a = db.get_or_404(MenuAlias, aid)
+    db.session.delete(a)
+    db.session.commit()
+    flash(f'✅ 已刪除別名：{a.normalized_input}', 'success')
+    return redirect(url_for('manage_aliases'))
+
+@app.route('/aliases/prune', methods=['POST'])
+@login_required(admin_only=True)
+def prune_aliases():
+    max_hits = request.form.get('max_hits', 0, type=int)
+    idle_days = request.form.get('idle_days', 30, type=int)
+    removed = order_bot.aliases.prune(max_hits=max_hits, idle_days=idle_days)
+    db.session.commit()
+    flash(f'✅ 已清除 {removed} 筆別名', 'success')
+    return redirect(url_for('manage_aliases'))
+
 # ── 歷史 ────────────────────────────────────────────────
+def _has_orders():
+    return db.exists().where(Order.daily_menu_id == DailyMenu.id)
+
+def latest_order_date():
+    """最近一個有訂單的日期：沿 daily_menus (menu_date, meal_type) 索引由新往舊找，LIMIT 1"""
+    return reply_cache.get_or_compute(('history_latest',), lambda: (
+        db.session.query(DailyMenu.menu_date)
+        .filter(_has_orders())
+        .order_by(DailyMenu.menu_date.desc())
+        .limit(1)
+        .scalar()))
+
+def month_order_dates(year, month):
+    """某月有訂單的日期 {'YYYY-MM-DD'}；放在 reply_cache，寫入訂單即失效"""
+    def load():
+        first = date(year, month, 1)
+        last = first.replace(day=calendar.monthrange(year, month)[1])
+        return frozenset(d.strftime('%Y-%m-%d') for (d,) in
+                         db.session.query(DailyMenu.menu_date)
+                         .filter(DailyMenu.menu_date.between(first, last), _has_orders())
+                         .distinct())
+    return reply_cache.get_or_compute(('history_month', year, month), load)
+
 @app.route('/history')
 @login_required(admin_only=True)
 def history():
-    from sqlalchemy import distinct
-    # 所有有訂單的日期
-    dates_with_orders = [
-        row[0] for row in
-        db.session.query(distinct(DailyMenu.menu_date))
-        .join(Order, Order.daily_menu_id == DailyMenu.id)
-        .order_by(DailyMenu.menu_date.desc())
-        .all()
-    ]
-
     # 選擇的日期（預設今天，若無訂單則取最近有訂單的日期）
     date_str = request.args.get('date')
     if date_str:
@@ -935,20 +1215,18 @@ def history():
         except ValueError:
             selected_date = date.today()
     else:
-        selected_date = dates_with_orders[0] if dates_with_orders else date.today()
+        selected_date = latest_order_date() or date.today()
 
     # 該日訂單
-    orders = (Order.query.join(DailyMenu)
-              .filter(DailyMenu.menu_date == selected_date)
+    orders = (Order.for_date(selected_date)
               .order_by(DailyMenu.meal_type, Order.created_date)
               .all())
 
-    # 日曆用：本月的有訂單日期 set
+    # 日曆用：只查顯示中那個月的有訂單日期
     cal_year  = request.args.get('year',  selected_date.year,  type=int)
     cal_month = request.args.get('month', selected_date.month, type=int)
-    order_dates_set = {d.strftime('%Y-%m-%d') for d in dates_with_orders}
+    order_dates_set = month_order_dates(cal_year, cal_month)
 
-    import calendar
     cal = calendar.monthcalendar(cal_year, cal_month)
 
     return render_template('history.html',
@@ -994,53 +1272,77 @@ def callback():
     signature = request.headers.get('X-Line-Signature', '')
     body = request.get_data(as_text=True)
     try:
-        handler.handle(body, signature)
+        if webhook_intake:
+            # 先驗簽章再入佇列，LINE 立刻拿到 200；事件由背景工作執行緒處理
+            if not handler.parser.signature_validator.validate(body, signature):
+                raise InvalidSignatureError('Invalid signature. signature=' + signature)
+            webhook_intake.submit(body, signature, request.host_url)
+        else:
+            handler.handle(body, signature)
     except InvalidSignatureError:
         abort(400)
     return 'OK'
 
+def _host_url():
+    """背景工作執行緒沒有 request，改用收件時記下的網址"""
+    return g.get('host_url') or request.host_url
+
+# ── 指令路由 ─────────────────────────────────────────────
+def _handle_group_id(group_id):
+    return f'群組 ID：{group_id}' if group_id else None
+
+def _handle_test_daily():
+    summary = order_bot.generate_daily_unpaid_summary()
+    return ('【測試預覽】\n\n' + summary) if summary else '目前無未付款訂單'
+
+command_router = CommandRouter(reply_cache)
+command_router.register_object(order_bot)
+command_router.register(CommandSpec('groupid', (), _handle_group_id, args=('group_id',),
+                                    exact=('!groupid',)))
+command_router.register(CommandSpec('test_daily', ('!test_daily', '!測試統計'), _handle_test_daily, args=()))
+
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_text_message(event):
     text = event.message.text.strip()
     user_id = event.source.user_id
     group_id = getattr(event.source, 'group_id', None)
+    spec = command_router.resolve(text)
 
-    # 記錄訊息
-    log = LineMessage(message_type='text', message_content=text,
-                      user_id=user_id, group_id=group_id)
-    db.session.add(log)
-    db.session.commit()
+    # LINE 重送或佇列重跑的同一個事件：寫入過就略過（寫入與事件 id 同一個交易記錄，見 run_with_retry）
+    event_id = getattr(event, 'webhook_event_id', None)
+    if event_id and db.session.get(ProcessedEvent, event_id):
+        print(f'略過已處理的 webhook 事件 {event_id}')
+        return
+    g.webhook_event_id = event_id
 
-    reply = None
-
-    if text.lower().startswith(('!點', '！點')):
-        reply = order_bot.handle_order_command(text, event.reply_token, group_id)
-        if reply is None:  # Flex 已直接發送
-            return
-    elif text == '!groupid' and group_id:
-        reply = f'群組 ID：{group_id}'
-    elif text.lower().startswith(('!菜單', '！菜單', '!menu', '！menu')):
-        messages = order_bot.handle_menu_query(text, request.host_url)
-        order_bot.send_messages(event.reply_token, messages)
+    # 記錄訊息（背景批次寫入；一般聊天依 LINE_LOG_CHATTER / LINE_LOG_CHATTER_SAMPLE 抽樣）
+    message_log.log('text', text, user_id, group_id, is_command=spec is not None)
+
+    if spec is None:
         return
-    elif text.isdigit() or text.lower().startswith(('!bill', '！bill', '!查帳', '！查帳')):
-        reply = order_bot.handle_bill_query(text)
-    elif text.lower().startswith(('!統計', '！統計')):
-        reply = order_bot.handle_stats_query(text)
-    elif text.lower().startswith(('!today', '！today', '!今日', '！今日', '!今天', '！今天')) and not text.lower().startswith(('!今天吃', '！今天吃')):
-        reply = order_bot.handle_today_summary()
-    elif text.lower().startswith(('!今天吃什麼', '！今天吃什麼', '!吃什麼', '！吃什麼', '!隨機', '！隨機')):
-        reply = order_bot.handle_suggest_shops()
-    elif text.lower().startswith(('!結清', '！結清', '!checkout', '！checkout')):
-        reply = order_bot.handle_checkout(text)
-    elif text.lower().startswith(('!help', '！help', '!說明', '！說明')):
-        reply = order_bot.handle_help()
-    elif text.lower().startswith(('!test_daily', '!測試統計')):
-        summary = order_bot.generate_daily_unpaid_summary()
-        reply = ('【測試預覽】\n\n' + summary) if summary else '目前無未付款訂單'
 
-    if reply:
-        order_bot.send_reply(event.reply_token, reply)
+    try:
+        reply = command_router.dispatch(spec, text=text, reply_token=event.reply_token,
+                                        group_id=group_id, host_url=_host_url())
+    except DuplicateEventError:
+        print(f'略過已處理的 webhook 事件 {event_id}（另一個 worker 先寫入）')
+        return
+    if not reply:  # 沒有回覆，或 Flex 已直接發送
+        return
+    # 超過一個 reply token 能送的量（5 則）時，其餘推播回同一個群組 / 個人
+    push_to = group_id or user_id
+    if isinstance(reply, list):
+        order_bot.send_messages(event.reply_token, reply, push_to)
+    else:
+        order_bot.send_reply(event.reply_token, reply, push_to)
+
+# handler 全部註冊完才啟動工作執行緒，避免事件找不到對應的處理函式
+if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    message_log.start()
+    if order_bot.outbound:
+        order_bot.outbound.start()
+    if webhook_intake:
+        webhook_intake.start()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,139 @@
+"""
+LINE 指令路由
+
+以前綴樹 (trie) 一次走完訊息開頭就決定要交給哪個 handler：
+- 全形「！」與半形「!」視為相同，英文不分大小寫
+- 多個前綴對應同一指令（別名），最長前綴優先；exclude 的前綴會擋掉較短的前綴
+- 沒有對應指令的一般聊天直接回傳 None，不做任何 DB 動作
+- cache=True 的指令交給 ReplyCache（reply_cache.py），資料沒變就直接回上次的回覆
+"""
+import threading
+import time
+
+
+class CommandSpec:
+    def __init__(self, name, prefixes, func=None, read_only=True, args=('text',),
+                 bare_digits=False, exact=(), exclude=(), cache=False):
+        self.name = name
+        self.prefixes = prefixes
+        self.func = func
+        self.read_only = read_only    # True = 不寫入 DB（可被快取 / 跳過交易）
+        self.args = args              # 從 dispatch 的 context 取哪些參數傳給 func
+        self.bare_digits = bare_digits
+        self.exact = exact
+        self.exclude = exclude
+        self.cache = cache and read_only   # 回覆只取決於參數與 DB 資料（不含亂數 / 外部狀態）
+
+    def __repr__(self):
+        return f'<Command {self.name}>'
+
+
+def command(name, *prefixes, read_only=True, args=('text',), bare_digits=False, exact=(), exclude=(),
+            cache=False):
+    """標記 OrderBot 的 handle_* 方法，由 CommandRouter.register_object() 收集"""
+    def decorator(func):
+        func.command_spec = CommandSpec(name, prefixes, read_only=read_only, args=args,
+                                        bare_digits=bare_digits, exact=exact, exclude=exclude,
+                                        cache=cache)
+        return func
+    return decorator
+
+
+def _fold(ch, first):
+    ch = ch.lower()
+    if first and ch == '！':
+        return '!'
+    return ch
+
+
+class CommandRouter:
+    _END = object()
+
+    def __init__(self, reply_cache=None):
+        self.reply_cache = reply_cache
+        self._trie = {}
+        self._exact = {}
+        self._digits = None
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    # ─── 註冊 ─────────────────────────────────────────────────────
+    def register(self, spec):
+        for prefix in spec.prefixes:
+            self._insert(prefix, spec)
+        for prefix in spec.exclude:
+            self._insert(prefix, None)
+        for text in spec.exact:
+            self._exact[text] = spec
+        if spec.bare_digits:
+            self._digits = spec
+        self._stats.setdefault(spec.name, {'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        return spec
+
+    def register_object(self, obj):
+        """註冊物件上所有以 @command 標記的方法"""
+        for attr in dir(type(obj)):
+            spec = getattr(getattr(type(obj), attr), 'command_spec', None)
+            if spec is not None:
+                self.register(CommandSpec(spec.name, spec.prefixes, getattr(obj, attr),
+                                          spec.read_only, spec.args, spec.bare_digits,
+                                          spec.exact, spec.exclude, spec.cache))
+
+    def _insert(self, prefix, spec):
+        node = self._trie
+        for i, ch in enumerate(prefix):
+            node = node.setdefault(_fold(ch, i == 0), {})
+        node[self._END] = spec
+
+    # ─── 解析 / 執行 ──────────────────────────────────────────────
+    def resolve(self, text):
+        """回傳 CommandSpec；一般聊天回傳 None"""
+        if not text:
+            return None
+        spec = self._exact.get(text)
+        if spec is not None:
+            return spec
+        if self._digits is not None and text.isdigit():
+            return self._digits
+        node = self._trie
+        found = None
+        for i, ch in enumerate(text):
+            node = node.get(_fold(ch, i == 0))
+            if node is None:
+                break
+            if self._END in node:
+                found = node[self._END]
+        return found
+
+    def dispatch(self, spec, **context):
+        started = time.perf_counter()
+        failed = False
+        try:
+            args = tuple(context.get(a) for a in spec.args)
+            if spec.cache and self.reply_cache is not None:
+                return self.reply_cache.get_or_compute((spec.name,) + args, lambda: spec.func(*args))
+            return spec.func(*args)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            with self._lock:
+                s = self._stats[spec.name]
+                s['count'] += 1
+                s['errors'] += failed
+                s['total_ms'] += elapsed
+                s['max_ms'] = max(s['max_ms'], elapsed)
+
+    # ─── 監控 ─────────────────────────────────────────────────────
+    def metrics(self):
+        with self._lock:
+            return {
+                name: {
+                    'count': s['count'],
+                    'errors': s['errors'],
+                    'avg_ms': round(s['total_ms'] / s['count'], 2) if s['count'] else 0.0,
+                    'max_ms': round(s['max_ms'], 2),
+                }
+                for name, s in self._stats.items()
+            }
@@ -10,6 +10,18 @@ class Config:
     SQLALCHEMY_DATABASE_URI = 'sqlite:////app/data/orders.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # SQLite 每條連線套用的 PRAGMA（models.apply_sqlite_pragmas）
+    # WAL 讓讀寫不互卡；busy_timeout 是遇到寫鎖時等待的毫秒數；cache_size 負數代表 KiB
+    SQLITE_PRAGMAS = {
+        'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+        'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -16000)),
+        'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 64 * 1024 * 1024)),
+        'temp_store': os.environ.get('SQLITE_TEMP_STORE', 'MEMORY'),
+        'foreign_keys': os.environ.get('SQLITE_FOREIGN_KEYS', 'ON'),
+    }
+
     # 檔案上傳
     UPLOAD_FOLDER = 'static/uploads'
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
@@ -20,6 +32,48 @@ class Config:
     LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
     LINE_GROUP_ID = os.environ.get('LINE_GROUP_ID')
 
+    # 非指令的一般聊天是否寫入 line_messages（偵錯用，關閉可省下每則訊息一次 DB commit）
+    LINE_LOG_CHATTER = os.environ.get('LINE_LOG_CHATTER', '1') == '1'
+    LINE_LOG_CHATTER_SAMPLE = float(os.environ.get('LINE_LOG_CHATTER_SAMPLE', 1.0))  # 0~1 抽樣比例
+    # line_messages 批次寫入：累積筆數 / 最久等待秒數 / 緩衝上限
+    LINE_LOG_BATCH_SIZE = int(os.environ.get('LINE_LOG_BATCH_SIZE', 100))
+    LINE_LOG_FLUSH_SECONDS = float(os.environ.get('LINE_LOG_FLUSH_SECONDS', 2))
+    LINE_LOG_BUFFER = int(os.environ.get('LINE_LOG_BUFFER', 5000))
+
+    # LINE API 連線池（每個 worker 共用一個 keep-alive 客戶端）
+    LINE_API_HOST = os.environ.get('LINE_API_HOST') or None     # 測試 / 壓測時指向本機假伺服器
+    LINE_API_POOL_SIZE = int(os.environ.get('LINE_API_POOL_SIZE', 10))
+    LINE_API_CONNECT_TIMEOUT = float(os.environ.get('LINE_API_CONNECT_TIMEOUT', 3))
+    LINE_API_READ_TIMEOUT = float(os.environ.get('LINE_API_READ_TIMEOUT', 10))
+
+    # 推播派送佇列（限流 + 失敗重試 + multicast 合併）
+    OUTBOUND_QUEUE = os.environ.get('OUTBOUND_QUEUE', '1') == '1'
+    OUTBOUND_MAX_ATTEMPTS = int(os.environ.get('OUTBOUND_MAX_ATTEMPTS', 6))
+    # 各 API 每秒請求上限（每個 worker 各自計算）
+    LINE_RATE_LIMITS = {
+        'reply': 1000,
+        'push': 1000,
+        'multicast': 100,
+    }
+
+    # Webhook 非同步收件：/callback 驗完簽章即回 200，事件交給背景工作執行緒處理
+    WEBHOOK_ASYNC = os.environ.get('WEBHOOK_ASYNC', '0') == '1'
+    WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 4))
+    QUEUE_DB_PATH = os.environ.get('QUEUE_DB_PATH', '/app/data/queue.db')
+
+    # 品項模糊比對結果快取（LRU，菜單版本變動即失效）
+    MENU_MATCH_CACHE_SIZE = int(os.environ.get('MENU_MATCH_CACHE_SIZE', 2048))
+    # 模糊比對自動學到的別名，命中這麼多次前仍顯示「⚠️ 比對為」提醒（後台修正過的別名直接採用）
+    ALIAS_TRUST_HITS = int(os.environ.get('ALIAS_TRUST_HITS', 3))
+
+    # 唯讀指令（!today、!統計、!bill）回覆快取：本 worker 寫入即失效，其他 worker 的寫入最多延遲 TTL 秒
+    REPLY_CACHE_TTL = float(os.environ.get('REPLY_CACHE_TTL', 10))
+    REPLY_CACHE_SIZE = int(os.environ.get('REPLY_CACHE_SIZE', 512))
+
+    # 每個請求的 SQL 查詢數（debug 模式自動開啟）：回應帶 X-SQL-Queries，超過上限印警告
+    SQL_QUERY_COUNTER = os.environ.get('SQL_QUERY_COUNTER', '0') == '1'
+    SQL_QUERY_WARN = int(os.environ.get('SQL_QUERY_WARN', 20))
+
     # OpenRouter AI（OCR 菜單辨識）
     OPENROUTER_API_KEY = os.environ.get('OPENROUTER_API_KEY')
 
@@ -29,6 +83,8 @@ class Config:
     # 排程推播時間（每日）
     DAILY_PUSH_HOUR = int(os.environ.get('DAILY_PUSH_HOUR', 20))
     DAILY_PUSH_MINUTE = int(os.environ.get('DAILY_PUSH_MINUTE', 30))
+    # 每日帳務提醒是否列出「欠哪位代墊人多少」
+    DAILY_SUMMARY_BY_PAYER = os.environ.get('DAILY_SUMMARY_BY_PAYER', '0') == '1'
 
     # 餐別設定
     MEAL_TYPES = {
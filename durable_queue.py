@@ -0,0 +1,146 @@
+"""
+SQLite 持久化工作佇列
+
+獨立於主資料庫的本機 SQLite 檔案，多個 gunicorn worker 共用同一個檔案：
+enqueue() 寫入一筆 → 工作執行緒 claim() 取走 → ack() 完成 / retry() 延後重試 / fail() 放棄。
+claim 之後若行程當掉，租約 (lease) 到期後會被其他 worker 重新取走。
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class DurableQueue:
+    def __init__(self, path, name, lease_seconds=120, max_attempts=3):
+        self.path = path
+        self.name = name
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._init_schema()
+
+    # ─── 連線（每個執行緒各自一條） ───────────────────────────────
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._conn()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS queue_jobs (
+                id           INTEGER PRIMARY KEY AUTOINCREMENT,
+                queue        TEXT    NOT NULL,
+                payload      TEXT    NOT NULL,
+                status       TEXT    NOT NULL DEFAULT 'pending',
+                attempts     INTEGER NOT NULL DEFAULT 0,
+                enqueued_at  REAL    NOT NULL,
+                available_at REAL    NOT NULL,
+                claimed_at   REAL,
+                last_error   TEXT
+            )''')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_queue_jobs_ready '
+                     'ON queue_jobs (queue, status, available_at)')
+
+    # ─── 寫入 / 取出 ──────────────────────────────────────────────
+    def enqueue(self, payload, delay=0):
+        now = time.time()
+        cur = self._conn().execute(
+            'INSERT INTO queue_jobs (queue, payload, enqueued_at, available_at) VALUES (?, ?, ?, ?)',
+            (self.name, json.dumps(payload, ensure_ascii=False), now, now + delay))
+        self.notify()
+        return cur.lastrowid
+
+    def claim(self):
+        """
+        原子性取走一筆可執行的工作，回傳 dict(id, payload, attempts, enqueued_at)，沒有則回傳 None
+        """
+        jobs = self.claim_many(1)
+        return jobs[0] if jobs else None
+
+    def claim_many(self, limit):
+        """一次取走最多 limit 筆可執行的工作（同一個交易內，其他 worker 不會拿到同一筆）"""
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # 租約過期且已達重試上限的（反覆讓行程當掉的工作）直接放棄
+            conn.execute(
+                '''UPDATE queue_jobs SET status = 'dead', last_error = 'lease expired'
+                   WHERE queue = ? AND status = 'processing' AND claimed_at < ? AND attempts >= ?''',
+                (self.name, now - self.lease_seconds, self.max_attempts))
+            rows = conn.execute(
+                '''SELECT id, payload, attempts, enqueued_at FROM queue_jobs
+                   WHERE queue = ? AND (
+                         (status = 'pending' AND available_at <= ?)
+                      OR (status = 'processing' AND claimed_at < ?))
+                   ORDER BY available_at, id LIMIT ?''',
+                (self.name, now, now - self.lease_seconds, limit)).fetchall()
+            if rows:
+                conn.executemany(
+                    "UPDATE queue_jobs SET status = 'processing', claimed_at = ?, attempts = attempts + 1 WHERE id = ?",
+                    [(now, row[0]) for row in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return [{'id': row[0], 'payload': json.loads(row[1]),
+                 'attempts': row[2] + 1, 'enqueued_at': row[3]} for row in rows]
+
+    def ack(self, job_id):
+        self._conn().execute('DELETE FROM queue_jobs WHERE id = ?', (job_id,))
+
+    def retry(self, job_id, delay, error=None):
+        """放回佇列，delay 秒後可再被取走"""
+        self._conn().execute(
+            "UPDATE queue_jobs SET status = 'pending', claimed_at = NULL, available_at = ?, last_error = ? WHERE id = ?",
+            (time.time() + delay, error, job_id))
+
+    def release(self, job_ids):
+        """取走但沒處理的工作原樣放回（不算一次嘗試）"""
+        self._conn().executemany(
+            "UPDATE queue_jobs SET status = 'pending', claimed_at = NULL, attempts = attempts - 1 WHERE id = ?",
+            [(job_id,) for job_id in job_ids])
+
+    def update_payloads(self, jobs):
+        """覆寫工作內容（jobs: [(id, payload)]），之後 claim 到的是新內容"""
+        self._conn().executemany(
+            'UPDATE queue_jobs SET payload = ? WHERE id = ?',
+            [(json.dumps(payload, ensure_ascii=False), job_id) for job_id, payload in jobs])
+
+    def fail(self, job_id, error=None):
+        """不再重試，保留紀錄供事後檢查"""
+        self._conn().execute(
+            "UPDATE queue_jobs SET status = 'dead', last_error = ? WHERE id = ?",
+            (error, job_id))
+
+    def notify(self):
+        self._wakeup.set()
+
+    def wait(self, timeout):
+        """閒置時等待新工作（同一行程 enqueue 會立刻喚醒）"""
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+    # ─── 監控 ─────────────────────────────────────────────────────
+    def depth(self):
+        row = self._conn().execute(
+            "SELECT COUNT(*) FROM queue_jobs WHERE queue = ? AND status IN ('pending', 'processing')",
+            (self.name,)).fetchone()
+        return row[0]
+
+    def counts(self):
+        rows = self._conn().execute(
+            'SELECT status, COUNT(*) FROM queue_jobs WHERE queue = ? GROUP BY status',
+            (self.name,)).fetchall()
+        return {status: n for status, n in rows}
@@ -0,0 +1,253 @@
+"""
+訂單的彙總帳本
+
+- user_balances：每人未付款累計。!bill、!結清、個人入口與每日帳務提醒只需要
+  「某人目前欠多少、幾筆」，不必每次把他所有未付款訂單撈出來加總。
+- meal_tallies：每餐的叫餐總表（品項 → 份數 / 金額），!點 回覆與 !統計 直接讀，
+  同一餐分好幾則訊息點也是累計結果。
+
+每個會改變訂單的地方（新增、改金額 / 品項、切換已付、結清、刪除）都在同一個交易裡
+呼叫這裡的函式，用 UPSERT 增減累計值。
+另有 reconcile() 直接從 orders 重算、找出並修正誤差（排程每天跑一次，啟動時也跑一次）。
+"""
+from datetime import datetime
+
+from sqlalchemy import case, func, literal, select, update
+from sqlalchemy.dialects.sqlite import insert
+
+from models import db, DailyMenu, MealTally, Order, UserBalance
+
+EPSILON = 0.005   # 金額是浮點數，比對時容許的誤差
+
+
+# ─── 增減 ─────────────────────────────────────────────────────────
+def apply(deltas):
+    """
+    deltas: {user_id: (金額增減, 筆數增減)}；不 commit，與呼叫端同一個交易
+    """
+    rows = [{'user_id': uid, 'unpaid_total': amount, 'unpaid_count': count,
+             'updated_at': datetime.utcnow()}
+            for uid, (amount, count) in deltas.items() if amount or count]
+    if not rows:
+        return
+    stmt = insert(UserBalance)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UserBalance.user_id],
+        set_={
+            'unpaid_total': UserBalance.unpaid_total + stmt.excluded.unpaid_total,
+            'unpaid_count': UserBalance.unpaid_count + stmt.excluded.unpaid_count,
+            'updated_at': stmt.excluded.updated_at,
+        },
+    )
+    db.session.execute(stmt, rows)
+
+
+def apply_tally(deltas):
+    """
+    deltas: {(daily_menu_id, 品項): (份數增減, 金額增減)}；不 commit
+    份數減到 0 的品項直接刪掉
+    """
+    rows = [{'daily_menu_id': dm_id, 'item': item, 'count': count, 'amount': amount}
+            for (dm_id, item), (count, amount) in deltas.items() if count or amount]
+    if not rows:
+        return
+    stmt = insert(MealTally)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[MealTally.daily_menu_id, MealTally.item],
+        set_={
+            'count': MealTally.count + stmt.excluded.count,
+            'amount': MealTally.amount + stmt.excluded.amount,
+        },
+    )
+    db.session.execute(stmt, rows)
+    if any(row['count'] < 0 for row in rows):
+        (MealTally.query
+         .filter(MealTally.daily_menu_id.in_({row['daily_menu_id'] for row in rows}), MealTally.count <= 0)
+         .delete(synchronize_session=False))
+
+
+def _add(deltas, key, count, amount):
+    old_count, old_amount = deltas.get(key, (0, 0.0))
+    deltas[key] = (old_count + count, old_amount + amount)
+
+
+def orders_added(rows):
+    """新增訂單（Order.insert_many 的 rows）；已付款的不計入欠款，但計入叫餐總表"""
+    balances, tallies = {}, {}
+    for row in rows:
+        amount = row.get('amount') or 0.0
+        _add(tallies, (row['daily_menu_id'], row['items']), 1, amount)
+        if not row.get('paid'):
+            _add(balances, row['user_id'], amount, 1)
+    apply(balances)
+    apply_tally(tallies)
+
+
+def order_changed(order, old_amount, old_paid, old_items=None):
+    """訂單金額、品項或付款狀態改變（order 已是新值）"""
+    before = (0.0, 0) if old_paid else (old_amount or 0.0, 1)
+    after = (0.0, 0) if order.paid else (order.amount or 0.0, 1)
+    apply({order.user_id: (after[0] - before[0], after[1] - before[1])})
+
+    tallies = {}
+    _add(tallies, (order.daily_menu_id, order.items if old_items is None else old_items), -1, -(old_amount or 0.0))
+    _add(tallies, (order.daily_menu_id, order.items), 1, order.amount or 0.0)
+    apply_tally(tallies)
+
+
+def order_removed(order):
+    if not order.paid:
+        apply({order.user_id: (-(order.amount or 0.0), -1)})
+    apply_tally({(order.daily_menu_id, order.items): (-1, -(order.amount or 0.0))})
+
+
+def user_removed(user_id):
+    """刪除使用者前呼叫（他的訂單會跟著刪掉）"""
+    UserBalance.query.filter_by(user_id=user_id).delete()
+    apply_tally({(dm_id, items): (-count, -(amount or 0.0)) for dm_id, items, count, amount in
+                 db.session.query(Order.daily_menu_id, Order.items, func.count(Order.id), func.sum(Order.amount))
+                 .filter(Order.user_id == user_id)
+                 .group_by(Order.daily_menu_id, Order.items)})
+
+
+# ─── 結清 ─────────────────────────────────────────────────────────
+def settle(user_id=None, payer_id=None, date_from=None, date_to=None, meal_type=None):
+    """
+    把符合條件的未付款訂單一次標記為已付（單一 UPDATE ... RETURNING），並扣掉帳本
+    條件都是選填：欠款人、代墊人、日期區間（含頭尾）、餐別；不 commit
+    回傳 {user_id: (筆數, 金額)}
+    """
+    conds = [Order.paid == False]
+    if user_id is not None:
+        conds.append(Order.user_id == user_id)
+    if payer_id is not None:
+        conds.append(Order.payer_id == payer_id)
+    if date_from or date_to or meal_type:
+        menus = select(DailyMenu.id)
+        if date_from:
+            menus = menus.where(DailyMenu.menu_date >= date_from)
+        if date_to:
+            menus = menus.where(DailyMenu.menu_date <= date_to)
+        if meal_type:
+            menus = menus.where(DailyMenu.meal_type == meal_type)
+        conds.append(Order.daily_menu_id.in_(menus))
+
+    rows = db.session.execute(
+        update(Order).where(*conds).values(paid=True).returning(Order.user_id, Order.amount),
+        execution_options={'synchronize_session': False},
+    ).all()
+    settled = {}
+    for uid, amount in rows:
+        count, total = settled.get(uid, (0, 0.0))
+        settled[uid] = (count + 1, total + (amount or 0.0))
+    apply({uid: (-total, -count) for uid, (count, total) in settled.items()})
+    return settled
+
+
+# ─── 查詢 ─────────────────────────────────────────────────────────
+def balance(user_id):
+    """回傳 (未付總額, 未付筆數)"""
+    row = (db.session.query(UserBalance.unpaid_total, UserBalance.unpaid_count)
+           .filter_by(user_id=user_id).first())
+    return (row[0], row[1]) if row else (0.0, 0)
+
+
+def tally(daily_menu_id):
+    """某一餐的叫餐總表 [(品項, 份數, 金額)]，依品項排序"""
+    return (db.session.query(MealTally.item, MealTally.count, MealTally.amount)
+            .filter(MealTally.daily_menu_id == daily_menu_id, MealTally.count > 0)
+            .order_by(MealTally.item)
+            .all())
+
+
+def day_kpis(menu_date):
+    """
+    後台儀表板 KPI：某天的訂單數 / 總額 / 已收，加上所有人累計未收（讀帳本），一個查詢
+    """
+    unpaid_all = select(func.coalesce(func.sum(UserBalance.unpaid_total), 0.0)).scalar_subquery()
+    count, total, paid, unpaid = (
+        db.session.query(func.count(Order.id),
+                         func.coalesce(func.sum(Order.amount), 0.0),
+                         func.coalesce(func.sum(case((Order.paid == True, Order.amount), else_=0.0)), 0.0),
+                         unpaid_all)
+        .select_from(Order)
+        .join(DailyMenu, Order.daily_menu_id == DailyMenu.id)
+        .filter(DailyMenu.menu_date == menu_date)
+        .one())
+    return {'count': count, 'total': total, 'paid': paid, 'unpaid': total - paid, 'unpaid_all': unpaid}
+
+
+# ─── 對帳 ─────────────────────────────────────────────────────────
+def reconcile(repair=True):
+    """
+    從 orders 重新加總每人未付款，與 user_balances 比對
+    回傳有誤差的 [(user_id, 帳本 (金額, 筆數), 實際 (金額, 筆數))]；repair=True 時直接改成實際值並 commit
+    """
+    actual = {uid: (total or 0.0, count) for uid, total, count in
+              db.session.query(Order.user_id, func.sum(Order.amount), func.count(Order.id))
+              .filter(Order.paid == False)
+              .group_by(Order.user_id)}
+    stored = {uid: (total, count) for uid, total, count in
+              db.session.query(UserBalance.user_id, UserBalance.unpaid_total, UserBalance.unpaid_count)}
+
+    drift = []
+    for uid in actual.keys() | stored.keys():
+        want = actual.get(uid, (0.0, 0))
+        have = stored.get(uid, (0.0, 0))
+        if abs(want[0] - have[0]) > EPSILON or want[1] != have[1]:
+            drift.append((uid, have, want))
+
+    if drift and repair:
+        # 直接在 SQL 內從 orders 重算（不是用上面讀到的值），避免覆蓋掉對帳期間新增的訂單
+        ids = [uid for uid, _, _ in drift]
+        now = datetime.utcnow()
+        unpaid = (select(Order.user_id, func.sum(Order.amount), func.count(Order.id), literal(now))
+                  .where(Order.paid == False, Order.user_id.in_(ids))
+                  .group_by(Order.user_id))
+        stmt = insert(UserBalance).from_select(
+            ['user_id', 'unpaid_total', 'unpaid_count', 'updated_at'], unpaid)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[UserBalance.user_id],
+            set_={'unpaid_total': stmt.excluded.unpaid_total,
+                  'unpaid_count': stmt.excluded.unpaid_count,
+                  'updated_at': stmt.excluded.updated_at},
+        )
+        db.session.execute(stmt)
+        (UserBalance.query
+         .filter(UserBalance.user_id.in_(ids),
+                 ~UserBalance.user_id.in_(select(Order.user_id).where(Order.paid == False)))
+         .update({'unpaid_total': 0.0, 'unpaid_count': 0, 'updated_at': now},
+                 synchronize_session=False))
+        db.session.commit()
+    return drift
+
+
+def reconcile_tallies(repair=True):
+    """
+    從 orders 重算每餐叫餐總表並比對；回傳有誤差的 daily_menu_id
+    repair=True 時把這些餐的總表整份重建並 commit
+    """
+    actual = {(dm_id, items): (count, amount or 0.0) for dm_id, items, count, amount in
+              db.session.query(Order.daily_menu_id, Order.items, func.count(Order.id), func.sum(Order.amount))
+              .group_by(Order.daily_menu_id, Order.items)}
+    stored = {(dm_id, item): (count, amount) for dm_id, item, count, amount in
+              db.session.query(MealTally.daily_menu_id, MealTally.item, MealTally.count, MealTally.amount)
+              .filter(MealTally.count > 0)}
+
+    drift = set()
+    for key in actual.keys() | stored.keys():
+        want = actual.get(key, (0, 0.0))
+        have = stored.get(key, (0, 0.0))
+        if want[0] != have[0] or abs(want[1] - have[1]) > EPSILON:
+            drift.add(key[0])
+
+    if drift and repair:
+        ids = sorted(drift)
+        MealTally.query.filter(MealTally.daily_menu_id.in_(ids)).delete(synchronize_session=False)
+        db.session.execute(insert(MealTally).from_select(
+            ['daily_menu_id', 'item', 'count', 'amount'],
+            select(Order.daily_menu_id, Order.items, func.count(Order.id), func.coalesce(func.sum(Order.amount), 0.0))
+            .where(Order.daily_menu_id.in_(ids))
+            .group_by(Order.daily_menu_id, Order.items)))
+        db.session.commit()
+    return sorted(drift)
@@ -0,0 +1,85 @@
+"""
+共用的 LINE Messaging API 客戶端
+
+每個行程只建立一個 ApiClient（底層 urllib3 PoolManager 保持 keep-alive 連線池），
+所有執行緒共用，避免每次回覆都重新建立 TCP/TLS 連線。
+"""
+import os
+import threading
+
+from linebot.v3.messaging import Configuration, ApiClient, MessagingApi
+
+
+class LineClient:
+    def __init__(self, access_token, host=None, pool_size=10,
+                 connect_timeout=3.0, read_timeout=10.0):
+        self.configuration = Configuration(access_token=access_token or '', host=host)
+        self.configuration.connection_pool_maxsize = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._api_client = None
+        self._api = None
+        self.requests = 0
+        self.errors = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config['LINE_CHANNEL_ACCESS_TOKEN'],
+            host=config.get('LINE_API_HOST'),
+            pool_size=config.get('LINE_API_POOL_SIZE', 10),
+            connect_timeout=config.get('LINE_API_CONNECT_TIMEOUT', 3.0),
+            read_timeout=config.get('LINE_API_READ_TIMEOUT', 10.0),
+        )
+
+    def _messaging_api(self):
+        # gunicorn fork 後連線池不能跨行程共用，依 pid 重建
+        pid = os.getpid()
+        if self._api is None or self._pid != pid:
+            with self._lock:
+                if self._api is None or self._pid != pid:
+                    self._api_client = ApiClient(self.configuration)
+                    self._api = MessagingApi(self._api_client)
+                    self._pid = pid
+        return self._api
+
+    def _call(self, method, request, **kwargs):
+        api = self._messaging_api()
+        with self._lock:
+            self.requests += 1
+        try:
+            return getattr(api, method)(request, _request_timeout=self.timeout, **kwargs)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+
+    # ─── API ──────────────────────────────────────────────────────
+    def reply_message(self, request):
+        return self._call('reply_message', request)
+
+    def push_message(self, request, retry_key=None):
+        return self._call('push_message', request, x_line_retry_key=retry_key)
+
+    def multicast(self, request, retry_key=None):
+        return self._call('multicast', request, x_line_retry_key=retry_key)
+
+    # ─── 監控 ─────────────────────────────────────────────────────
+    def stats(self):
+        connections = 0
+        pool_requests = 0
+        if self._api_client is not None:
+            pools = self._api_client.rest_client.pool_manager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+                    pool_requests += pool.num_requests
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'connections_opened': connections,
+            'connections_reused': max(0, pool_requests - connections),
+            'pool_size': self.configuration.connection_pool_maxsize,
+        }
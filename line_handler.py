@@ -1,60 +1,86 @@
 from linebot.v3.messaging import (
-    Configuration, ApiClient, MessagingApi,
     ReplyMessageRequest, PushMessageRequest,
     TextMessage as LineTextMessage,
     FlexMessage, FlexContainer,
     ImageMessage,
 )
-from models import db, User, Shop, MenuItem, DailyMenu, Order, SystemSetting
+from linebot.v3.messaging.exceptions import ApiException
+from models import db, User, Shop, DailyMenu, Order, MealTally, SystemSetting, UserBalance, run_with_retry
+import ledger
 from config import Config
-from datetime import datetime, date
+from line_client import LineClient
+from command_router import command
+from menu_catalog import get_catalog, clean_name, MatchCache
+from menu_alias import AliasStore
+from reply_builder import ReplyBuilder, split_text, batches, MAX_MESSAGES
+from datetime import datetime, date, timedelta
 import pytz
 import re
 from rapidfuzz import process, fuzz
+import numpy as np
+
+# 餐別關鍵字對應表（!點、!結清 共用）
+MEAL_KEYWORDS = {
+    '早餐': 'breakfast', '早': 'breakfast', 'breakfast': 'breakfast',
+    '午餐': 'lunch',     '午': 'lunch',     'lunch': 'lunch',
+    '晚餐': 'dinner',    '晚': 'dinner',    'dinner': 'dinner',
+    '點心': 'snack',     '下午茶': 'snack',  'snack': 'snack',
+    '飲料': 'drink',     '飲': 'drink',      'drink': 'drink',
+}
 
 
 class OrderBot:
     def __init__(self, config):
         self.config = config
-        self.configuration = Configuration(access_token=config['LINE_CHANNEL_ACCESS_TOKEN'])
+        self.line = LineClient.from_config(config)
+        self.configuration = self.line.configuration
+        self.outbound = None   # OutboundDispatcher，由 app.py 啟用後推播改走佇列
+        self.aliases = AliasStore(config.get('ALIAS_TRUST_HITS', 3))
+        self.match_cache = MatchCache(config.get('MENU_MATCH_CACHE_SIZE', 2048))
 
     # ─── 發送工具 ──────────────────────────────────────────────────
-    def send_reply(self, reply_token, text):
-        with ApiClient(self.configuration) as api:
-            MessagingApi(api).reply_message(
-                ReplyMessageRequest(reply_token=reply_token,
-                                    messages=[LineTextMessage(text=text)])
-            )
+    def send_reply(self, reply_token, text, push_to=None):
+        """長回覆自動切成多則；超過 5 則的部分推播給 push_to（群組或個人）"""
+        self.send_messages(reply_token, [LineTextMessage(text=t) for t in split_text(text)], push_to)
 
-    def send_messages(self, reply_token, messages):
-        with ApiClient(self.configuration) as api:
-            MessagingApi(api).reply_message(
+    def send_messages(self, reply_token, messages, push_to=None):
+        messages, overflow = messages[:MAX_MESSAGES], messages[MAX_MESSAGES:]
+        try:
+            self.line.reply_message(
                 ReplyMessageRequest(reply_token=reply_token, messages=messages)
             )
+        except ApiException as e:
+            # 被限流或 LINE 暫時故障：交給派送佇列在 token 失效前重試
+            if self.outbound and (e.status == 429 or (e.status or 0) >= 500):
+                self.outbound.reply(reply_token, messages)
+            else:
+                raise
+        if overflow:
+            if push_to:
+                self._push(push_to, overflow)
+            else:
+                print(f'回覆超過 {MAX_MESSAGES} 則且沒有推播對象，略過 {len(overflow)} 則')
 
     def send_push_message(self, to, text):
-        try:
-            with ApiClient(self.configuration) as api:
-                MessagingApi(api).push_message(
-                    PushMessageRequest(to=to, messages=[LineTextMessage(text=text)])
-                )
-            return True
-        except Exception as e:
-            print(f'推播失敗: {e}')
-            return False
+        return self._push(to, [LineTextMessage(text=t) for t in split_text(text)])
+
+    def _push(self, to, messages):
+        for batch in batches(messages):
+            if self.outbound:
+                self.outbound.push(to, batch)
+                continue
+            try:
+                self.line.push_message(PushMessageRequest(to=to, messages=batch))
+            except Exception as e:
+                print(f'推播失敗: {e}')
+                return False
+        return True
 
     def send_flex_reply(self, reply_token, alt_text, flex_dict):
-        import json
-        with ApiClient(self.configuration) as api:
-            MessagingApi(api).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[FlexMessage(
-                        alt_text=alt_text,
-                        contents=FlexContainer.from_dict(flex_dict)
-                    )]
-                )
-            )
+        self.send_messages(reply_token, [FlexMessage(
+            alt_text=alt_text,
+            contents=FlexContainer.from_dict(flex_dict)
+        )])
 
     # ─── 時間判斷 ──────────────────────────────────────────────────
     def get_current_meal_type(self):
@@ -72,56 +98,104 @@ class OrderBot:
         return 'lunch'
 
     def clean_name(self, name):
-        import re, unicodedata
-        if not name: return ''
-        n = unicodedata.normalize('NFKC', name)
-        n = re.sub(r'[\u200b-\u200f\ufeff\u202a-\u202e\r\n]', '', n)
-        n = re.sub(r'\s+', ' ', n)
-        return n.strip()
-
-    def match_menu_item(self, item_name, shop_id=None):
+        return clean_name(name)
+
+    def match_menu_item(self, item_name, shop_id=None, catalog=None):
         """
-        回傳 (MenuItem or None, confidence: 'exact'|'fuzzy'|'none')
+        回傳 (CatalogItem or None, confidence: 'exact'|'alias'|'unconfirmed'|'fuzzy'|'none')
+        'unconfirmed' 是還沒確認的自動學習別名，與 'fuzzy' 一樣要提醒使用者確認
+        CatalogItem 有 id / name / price，可當 MenuItem 使用
         """
-        query = MenuItem.query.filter_by(is_available=True)
-        if shop_id:
-            query = query.filter_by(shop_id=shop_id)
-        items = query.all()
-        if not items:
-            return None, 'none'
-
-        clean_item_name = self.clean_name(item_name)
-        names = [self.clean_name(i.name) for i in items]
+        return self.match_menu_items([item_name], shop_id, catalog)[0]
 
-        # 精確比對
-        for i, cname in zip(items, names):
-            if cname == clean_item_name:
-                return i, 'exact'
-
-        # 模糊比對（threshold 75）
-        from rapidfuzz import process, fuzz
-        result = process.extractOne(clean_item_name, names, scorer=fuzz.ratio)
-        if result and result[1] >= 75:
-            matched = next(i for i, cname in zip(items, names) if cname == result[0])
-            return matched, 'fuzzy'
-        return None, 'none'
+    def match_menu_items(self, item_names, shop_id=None, catalog=None):
+        """
+        批次比對，回傳與 item_names 同順序的 [(CatalogItem or None, confidence)]
+        先查精確比對的 dict，再整批查學習過的別名，剩下的先查 LRU 快取，
+        快取沒有的才用一次 cdist 算出整批對所有品名的分數（多核心），
+        每列取最高分（同分取第一個，與 extractOne 相同），門檻 75
+        別名不進快取（後台修正要立即生效），快取只省下模糊比對本身
+        """
+        catalog = catalog or get_catalog()
+        results = [(None, 'none')] * len(item_names)
+        items = catalog.items(shop_id)
+        if not items:
+            return results
+
+        pending = []
+        for idx, name in enumerate(item_names):
+            cleaned = self.clean_name(name)
+            item = catalog.exact(shop_id, cleaned)
+            if item:
+                results[idx] = (item, 'exact')
+            else:
+                pending.append((idx, cleaned))
+
+        if pending and shop_id is not None:
+            found = self.aliases.resolve(shop_id, [cleaned for _, cleaned in pending], catalog)
+            if found:
+                for idx, cleaned in pending:
+                    if cleaned in found:
+                        item, trusted = found[cleaned]
+                        results[idx] = (item, 'alias' if trusted else 'unconfirmed')
+                pending = [(idx, cleaned) for idx, cleaned in pending if cleaned not in found]
+
+        misses = []
+        for idx, cleaned in pending:
+            cached = self.match_cache.get((catalog.version, shop_id, cleaned))
+            if cached is None:
+                misses.append((idx, cleaned))
+            elif cached[0] is not None:
+                results[idx] = (catalog.items_by_id[cached[0]], cached[1])
+
+        if misses:
+            scores = process.cdist([cleaned for _, cleaned in misses], catalog.names(shop_id),
+                                   scorer=fuzz.ratio, dtype=np.float64, workers=-1)
+            best = scores.argmax(axis=1)
+            for (idx, cleaned), row, col in zip(misses, scores, best):
+                if row[col] >= 75:
+                    results[idx] = (items[col], 'fuzzy')
+                    self.match_cache.put((catalog.version, shop_id, cleaned), (items[col].id, 'fuzzy'))
+                else:
+                    self.match_cache.put((catalog.version, shop_id, cleaned), (None, 'none'))
+        return results
+
+    @staticmethod
+    def parse_item_and_remark(raw_item):
+        """
+        拆出品名與備註 (支援: 括號, 減號, 空格)
+        回傳 (品名, 備註, 是否為空格拆分)；空格拆分可能誤切到品名本身的空白
+        """
+        paren_match = re.search(r'[\(（](.*?)[\)）]?$', raw_item)
+        if paren_match:
+            return raw_item[:paren_match.start()].strip(), paren_match.group(1).strip(), False
+        if '-' in raw_item or '－' in raw_item:
+            parts = re.split(r'\s*[-－]\s*', raw_item, maxsplit=1)
+            return parts[0].strip(), parts[1].strip(), False
+        parts = raw_item.rsplit(maxsplit=1)
+        if len(parts) == 2:
+            return parts[0].strip(), parts[1].strip(), True
+        return raw_item, '', False
+
+    def resolve_users(self, codes):
+        """
+        一次查出所有代號對應的使用者，回傳 {user_code: Row(id, user_code, name)}
+        只取欄位不取 ORM 物件，中途 commit 也不會因 expire 而逐筆重新查詢
+        """
+        codes = {c for c in codes if c}
+        if not codes:
+            return {}
+        rows = db.session.query(User.id, User.user_code, User.name).filter(User.user_code.in_(codes)).all()
+        return {r.user_code: r for r in rows}
 
     # ─── !點 指令 ─────────────────────────────────────────────────
+    @command('order', '!點', read_only=False, args=('text', 'reply_token', 'group_id'))
     def handle_order_command(self, message_text, reply_token, group_id=None):
         """
         格式：
         !點 [餐別(選填)] [店家] [代墊人代號]
         餐別關鍵字：早餐/早 午餐/午 晚餐/晚 點心/下午茶 飲料/飲
         """
-        # 餐別關鍵字對應表
-        MEAL_KEYWORDS = {
-            '早餐': 'breakfast', '早': 'breakfast', 'breakfast': 'breakfast',
-            '午餐': 'lunch',     '午': 'lunch',     'lunch': 'lunch',
-            '晚餐': 'dinner',    '晚': 'dinner',    'dinner': 'dinner',
-            '點心': 'snack',     '下午茶': 'snack',  'snack': 'snack',
-            '飲料': 'drink',     '飲': 'drink',      'drink': 'drink',
-        }
-
         lines = message_text.strip().split('\n')
         first = lines[0].replace('!點', '').replace('！點', '').strip()
 
@@ -147,118 +221,127 @@ class OrderBot:
         if not payer_code:
             payer_code = SystemSetting.get('default_payer_code', '')
 
-        payer = User.query.filter_by(user_code=payer_code).first() if payer_code else None
+        # 先解析所有訂單行，把代號收齊後一次查詢（不再每行一次 User 查詢）
+        entries = []
+        for line in lines[1:]:
+            line = line.strip()
+            if not line:
+                continue
+            m = re.match(r'^(\d+)[.\s]+(.+)$', line)
+            entries.append((line, m.group(1), m.group(2).strip()) if m else (line, None, None))
+        users = self.resolve_users([payer_code] + [code for _, code, _ in entries])
+
+        payer = users.get(payer_code) if payer_code else None
         if payer_code and not payer:
             return f'❌ 代墊人代號 {payer_code} 不存在'
 
-        # 取得餐別 & 今日 DailyMenu
+        # 取得餐別；DailyMenu 留到最後與訂單同一個交易寫入
         meal_type = forced_meal_type if forced_meal_type else self.get_current_meal_type()
         today = date.today()
-        dm = DailyMenu.query.filter_by(menu_date=today, meal_type=meal_type).first()
-        if not dm:
-            dm = DailyMenu(menu_date=today, meal_type=meal_type)
-            db.session.add(dm)
-            db.session.commit()
+        catalog = get_catalog()
 
-        # 若有輸入店家名稱，尋找並更新 DailyMenu
+        # 若有輸入店家名稱，尋找店家；沒輸入就沿用這一餐已設定的店家
         business_day_warning = None
-        if shop_name:
-            shops = Shop.query.filter_by(is_active=True).all()
-            if shops:
-                shop_names = [s.name for s in shops]
-                from rapidfuzz import process, fuzz
-                result = process.extractOne(shop_name, shop_names, scorer=fuzz.ratio)
-                if result and result[1] >= 50:
-                    matched_shop = next(s for s in shops if s.name == result[0])
-                    dm.shop_id = matched_shop.id
-                    db.session.commit()
-                    # 檢查今天是否營業
-                    weekday = date.today().weekday()  # 0=Mon ... 6=Sun
-                    days = matched_shop.business_days or '1111111'
-                    if len(days) == 7 and days[weekday] == '0':
-                        day_names = ['一','二','三','四','五','六','日']
-                        business_day_warning = f'⚠️ 注意：【{matched_shop.name}】今天（週{day_names[weekday]}）可能沒有營業，請再次確認！'
-
-        shop = dm.shop
+        matched_shop = catalog.match_shop(shop_name) if shop_name else None
+        if matched_shop:
+            shop = matched_shop
+            # 檢查今天是否營業
+            weekday = date.today().weekday()  # 0=Mon ... 6=Sun
+            if not matched_shop.is_open(weekday):
+                day_names = ['一','二','三','四','五','六','日']
+                business_day_warning = f'⚠️ 注意：【{matched_shop.name}】今天（週{day_names[weekday]}）可能沒有營業，請再次確認！'
+        else:
+            current_shop_id = (db.session.query(DailyMenu.shop_id)
+                               .filter_by(menu_date=today, meal_type=meal_type).scalar())
+            shop = catalog.shops_by_id.get(current_shop_id)
 
         # 解析訂單行
         orders_info = []
         errors = []
         fuzzy_warnings = []
 
-        for line in lines[1:]:
-            line = line.strip()
-            if not line:
-                continue
-            m = re.match(r'^(\d+)[.\s]+(.+)$', line)
-            if not m:
+        parsed = []
+        for line, user_code, raw_item in entries:
+            if user_code is None:
                 errors.append(f'無法解析：{line}')
                 continue
 
-            user_code, raw_item = m.group(1), m.group(2).strip()
-            user = User.query.filter_by(user_code=user_code).first()
+            user = users.get(user_code)
             if not user:
                 errors.append(f'代號 {user_code} 不存在')
                 continue
 
-            # 解析可能的備註 (支援: 括號, 減號, 空格)
-            parsed_name = raw_item
-            parsed_remark = ""
-            
-            paren_match = re.search(r'[\(（](.*?)[\)）]?$', raw_item)
-            if paren_match:
-                parsed_remark = paren_match.group(1).strip()
-                parsed_name = raw_item[:paren_match.start()].strip()
-            elif '-' in raw_item or '－' in raw_item:
-                parts = re.split(r'\s*[-－]\s*', raw_item, maxsplit=1)
-                parsed_name = parts[0].strip()
-                parsed_remark = parts[1].strip()
-            else:
-                parts = raw_item.rsplit(maxsplit=1)
-                if len(parts) == 2:
-                    parsed_name = parts[0].strip()
-                    parsed_remark = parts[1].strip()
-
-            # 嘗試用拆分後的品名去比對
-            menu_item, confidence = self.match_menu_item(parsed_name, shop_id=shop.id if shop else None)
-            item_name = parsed_name
-            remark = parsed_remark
-            
-            # 若空格拆分失敗，有可能是品名自帶空格，退回使用完整字串比對
-            if confidence == 'none' and parsed_remark and not paren_match and '-' not in raw_item and '－' not in raw_item:
-                fallback_item, fallback_conf = self.match_menu_item(raw_item, shop_id=shop.id if shop else None)
+            parsed_name, parsed_remark, space_split = self.parse_item_and_remark(raw_item)
+            parsed.append({'code': user_code, 'user': user, 'raw': raw_item,
+                           'name': parsed_name, 'remark': parsed_remark, 'space_split': space_split})
+
+        # 整批比對：先用拆分後的品名
+        shop_id = shop.id if shop else None
+        matches = self.match_menu_items([p['name'] for p in parsed], shop_id, catalog)
+
+        # 若空格拆分失敗，有可能是品名自帶空格，退回使用完整字串再整批比對一次
+        retry = [i for i, p in enumerate(parsed)
+                 if matches[i][1] == 'none' and p['remark'] and p['space_split']]
+        if retry:
+            fallback = self.match_menu_items([parsed[i]['raw'] for i in retry], shop_id, catalog)
+            for i, (fallback_item, fallback_conf) in zip(retry, fallback):
                 if fallback_conf != 'none':
-                    menu_item, confidence = fallback_item, fallback_conf
-                    item_name = raw_item
-                    remark = ""
+                    matches[i] = (fallback_item, fallback_conf)
+                    parsed[i]['name'] = parsed[i]['raw']
+                    parsed[i]['remark'] = ''
+
+        rows = []
+        for p, (menu_item, confidence) in zip(parsed, matches):
+            user_code, user = p['code'], p['user']
+            item_name, remark = p['name'], p['remark']
 
             amount = menu_item.price or 0.0 if menu_item else 0.0
 
-            if confidence == 'fuzzy':
+            if confidence in ('fuzzy', 'unconfirmed'):
                 fuzzy_warnings.append(f'⚠️ {user_code}. {user.name}：「{item_name}」→ 比對為「{menu_item.name}」，請確認')
 
             item_display = menu_item.name if menu_item else item_name
             if remark:
                 item_display += f' ({remark})'
 
-            order = Order(
-                user_id=user.id,
-                daily_menu_id=dm.id,
-                menu_item_id=menu_item.id if menu_item else None,
-                items=item_display,
-                amount=amount,
-                payer_id=payer.id if payer else None,
-                note=remark
-            )
-            db.session.add(order)
+            rows.append({
+                'user_id': user.id,
+                'menu_item_id': menu_item.id if menu_item else None,
+                'items': item_display,
+                'amount': amount,
+                'payer_id': payer.id if payer else None,
+                'note': remark,
+                'raw_item': item_name,
+            })
             orders_info.append({
                 'code': user_code, 'name': user.name,
                 'item': item_display,
                 'amount': amount,
-                'warning': confidence == 'fuzzy',
+                'warning': confidence in ('fuzzy', 'unconfirmed'),
             })
 
-        db.session.commit()
+        learned = [(p['name'], menu_item.id) for p, (menu_item, confidence) in zip(parsed, matches)
+                   if confidence == 'fuzzy']
+        alias_used = [p['name'] for p, (_, confidence) in zip(parsed, matches)
+                      if confidence in ('alias', 'unconfirmed')]
+
+        def write():
+            # 單一交易：DailyMenu upsert（同時建立同一餐不會撞 unique_daily_meal）+ 整批訂單 + 別名
+            dm = DailyMenu.get_or_create(today, meal_type)
+            if matched_shop:
+                dm.shop_id = matched_shop.id
+            # 模糊比對記成（未確認的）別名；命中夠多次或後台修正過才不再提醒
+            self.aliases.remember(shop_id, learned)
+            self.aliases.touch(shop_id, alias_used)
+            order_rows = [dict(row, daily_menu_id=dm.id) for row in rows]
+            ledger.orders_added(order_rows)
+            ids = Order.insert_many(order_rows)
+            # 同一個交易裡讀這一餐的累計總表（含先前幾批訊息）
+            return ids, ledger.tally(dm.id) if order_rows else []
+
+        order_ids, meal_tally = run_with_retry(write)
+        for info, order_id in zip(orders_info, order_ids):
+            info['id'] = order_id
 
         # 如果完全沒有任何有效訂單，直接回傳錯誤，不要輸出「已記錄 0 筆」
         if not orders_info:
@@ -285,12 +368,15 @@ class OrderBot:
         # ─── Part 2：打電話叫餐總表 ──────────────────
         reply += '─' * 20 + '\n'
         reply += f'📞 打電話叫餐總表\n'
-        from collections import Counter
-        item_counter = Counter(o['item'] for o in orders_info)
-        for item_display, count in sorted(item_counter.items()):
+        for item_display, count, _ in meal_tally:
             reply += f'🍱 {item_display} × {count}\n'
         reply += '─' * 20 + '\n'
-        reply += f'共 {len(orders_info)} 份，總計 ${int(total)}\n'
+        meal_count = sum(count for _, count, _ in meal_tally)
+        meal_total = sum(amount for _, _, amount in meal_tally)
+        reply += f'共 {meal_count} 份，總計 ${int(meal_total)}'
+        if meal_count != len(orders_info):
+            reply += f'（本次 {len(orders_info)} 份 ${int(total)}）'
+        reply += '\n'
         reply += f'（請確認是否有人漏點）\n'
 
         if shop and shop.phone:
@@ -308,6 +394,7 @@ class OrderBot:
         return reply
 
     # ─── !bill / !查帳 ───────────────────────────────────────────
+    @command('bill', '!bill', '!查帳', bare_digits=True, cache=True)
     def handle_bill_query(self, message_text):
         code = re.sub(r'[！!]bill|[！!]帳單|[！!]結帳|[！!]查帳', '', message_text, flags=re.IGNORECASE).strip()
         if not code.isdigit():
@@ -322,7 +409,7 @@ class OrderBot:
             Order.user_id == user.id, DailyMenu.menu_date == today
         ).all()
 
-        unpaid_all = Order.query.filter_by(user_id=user.id, paid=False).all()
+        unpaid_total, unpaid_count = ledger.balance(user.id)
 
         reply = f'📋 {code}號 {user.name} 的帳單\n'
         reply += '=' * 28 + '\n'
@@ -335,9 +422,8 @@ class OrderBot:
                 reply += f'{s} {meal}：{o.items} ${int(o.amount)}\n'
             reply += '\n'
 
-        if unpaid_all:
-            total = sum(o.amount for o in unpaid_all)
-            reply += f'【累計欠款】${int(total)}\n'
+        if unpaid_count:
+            reply += f'【累計欠款】${int(unpaid_total)}\n'
             reply += f'💡 輸入 !結清 {code} 結清所有欠款'
         else:
             reply += '✅ 目前沒有欠款'
@@ -345,50 +431,59 @@ class OrderBot:
         return reply
 
     # ─── !today ───────────────────────────────────────────────────
+    @command('today', '!today', '!今日', '!今天', args=(), exclude=('!今天吃',), cache=True)
     def handle_today_summary(self):
         today = date.today()
-        orders = Order.query.join(DailyMenu).filter(DailyMenu.menu_date == today).all()
-        if not orders:
+        # 各餐別的筆數 / 金額 / 已收直接在 SQL 加總
+        meals = (db.session.query(DailyMenu.meal_type, db.func.count(Order.id), db.func.sum(Order.amount),
+                                  db.func.sum(db.case((Order.paid == True, Order.amount), else_=0)),
+                                  db.func.min(Order.id))
+                 .join(Order, Order.daily_menu_id == DailyMenu.id)
+                 .filter(DailyMenu.menu_date == today)
+                 .group_by(DailyMenu.meal_type)
+                 .order_by(db.func.min(Order.id))
+                 .all())
+        if not meals:
             return f'📋 今日 ({today.strftime("%m/%d")}) 還沒有訂單'
 
-        by_meal = {}
-        for o in orders:
-            mt = o.daily_menu.meal_type
-            by_meal.setdefault(mt, []).append(o)
-
-        reply = f'📋 今日訂單 ({today.strftime("%m/%d")})\n\n'
+        # 每人明細：一個查詢直接取需要的欄位（不逐筆載入 daily_menu / user）
+        lines = {}
+        for mt, code, name, items, amount, paid in (
+                db.session.query(DailyMenu.meal_type, User.user_code, User.name,
+                                 Order.items, Order.amount, Order.paid)
+                .join(Order, Order.daily_menu_id == DailyMenu.id)
+                .join(User, Order.user_id == User.id)
+                .filter(DailyMenu.menu_date == today)
+                .order_by(Order.id)):
+            s = '✅' if paid else '⏳'
+            lines.setdefault(mt, []).append(f'{s} {code}. {name} - {items} (${int(amount)})')
+
+        reply = ReplyBuilder().line(f'📋 今日訂單 ({today.strftime("%m/%d")})').line()
         total = paid = 0
-        for mt, os in by_meal.items():
-            reply += f'【{Config.MEAL_TYPES.get(mt, mt)}】{len(os)} 筆\n'
-            for o in os:
-                s = '✅' if o.paid else '⏳'
-                reply += f'{s} {o.user.user_code}. {o.user.name} - {o.items} (${int(o.amount)})\n'
-                total += o.amount
-                if o.paid:
-                    paid += o.amount
-            reply += '\n'
+        for mt, count, meal_total, meal_paid, _ in meals:
+            reply.line(f'【{Config.MEAL_TYPES.get(mt, mt)}】{count} 筆')
+            reply.lines(lines.get(mt, [])).line()
+            total += meal_total or 0
+            paid += meal_paid or 0
 
-        reply += f'💰 總計 ${int(total)}｜已收 ${int(paid)}｜未收 ${int(total - paid)}'
-        return reply
+        reply.line(f'💰 總計 ${int(total)}｜已收 ${int(paid)}｜未收 ${int(total - paid)}')
+        return reply.render()
 
     # ─── !菜單 ───────────────────────────────────────────────────
+    @command('menu', '!菜單', '!menu', args=('text', 'host_url'))
     def handle_menu_query(self, message_text, host_url):
         keyword = re.sub(r'[！!]菜單|[！!]menu', '', message_text, flags=re.IGNORECASE).strip()
         if not keyword:
             return [LineTextMessage(text='❌ 請輸入店家名稱，例如：!菜單 麗媽')]
 
-        shops = Shop.query.all()
-        if not shops:
+        catalog = get_catalog()
+        if not catalog.shops:
             return [LineTextMessage(text='❌ 目前系統中沒有任何店家')]
 
-        names = [s.name for s in shops]
-        result = process.extractOne(keyword, names, scorer=fuzz.ratio)
-        
-        if not result or result[1] < 50:
+        matched_shop = catalog.match_shop(keyword, active_only=False)
+        if not matched_shop:
             return [LineTextMessage(text=f'❌ 找不到與「{keyword}」相近的店家')]
 
-        matched_shop = next(s for s in shops if s.name == result[0])
-        
         messages = []
         if matched_shop.menu_image:
             image_url = f"{host_url.rstrip('/')}/static/uploads/{matched_shop.menu_image}"
@@ -396,7 +491,7 @@ class OrderBot:
             messages.append(LineTextMessage(text=f'為您找尋到最符合的店家：【{matched_shop.name}】'))
             messages.append(ImageMessage(original_content_url=image_url, preview_image_url=image_url))
         else:
-            items = MenuItem.query.filter_by(shop_id=matched_shop.id, is_available=True).all()
+            items = catalog.items(matched_shop.id)
             if not items:
                 messages.append(LineTextMessage(text=f'📋 【{matched_shop.name}】目前沒有上傳圖片，也沒有品項資料。'))
             else:
@@ -409,84 +504,145 @@ class OrderBot:
         return messages
 
     # ─── !統計 ───────────────────────────────────────────────────
+    @command('stats', '!統計', cache=True)
     def handle_stats_query(self, message_text):
-        MEAL_KEYWORDS = {
-            '早餐': 'breakfast', '早': 'breakfast',
-            '午餐': 'lunch',     '午': 'lunch',
-            '晚餐': 'dinner',    '晚': 'dinner',
-            '點心': 'snack',     '下午茶': 'snack',
-            '飲料': 'drink',     '飲': 'drink',
-        }
-        from collections import Counter
         keyword = re.sub(r'[！!]統計', '', message_text, flags=re.IGNORECASE).strip()
-        forced_meal = MEAL_KEYWORDS.get(keyword)
+        forced_meal = MEAL_KEYWORDS.get(keyword.lower())
         today = date.today()
+        meals = self.meal_tallies(today, forced_meal)
 
         if forced_meal:
-            dm = DailyMenu.query.filter_by(menu_date=today, meal_type=forced_meal).first()
             meal_name = Config.MEAL_TYPES.get(forced_meal, forced_meal)
-            if not dm or not dm.orders:
+            if not meals:
                 return f'📊 今日{meal_name}（{today.strftime("%m/%d")}）還沒有訂單'
-            shop = dm.shop.name if dm.shop else '未指定店家'
-            counter = Counter(o.items for o in dm.orders)
-            total_count = sum(counter.values())
-            total_amount = sum(o.amount for o in dm.orders)
-            reply = f'📊 今日統計 ({today.strftime("%m/%d")})【{meal_name}】{shop}\n'
+            meal = meals[0]
+            reply = f'📊 今日統計 ({today.strftime("%m/%d")})【{meal_name}】{meal["shop"]}\n'
             reply += '─' * 20 + '\n'
-            for item, count in sorted(counter.items()):
+            for item, count in meal['items']:
                 reply += f'🍱 {item} × {count}\n'
             reply += '─' * 20 + '\n'
-            reply += f'共 {total_count} 份，總計 ${int(total_amount)}'
+            reply += f'共 {meal["count"]} 份，總計 ${int(meal["amount"])}'
             return reply
 
         # 不帶餐別 → 今天全部
-        dms = [dm for dm in DailyMenu.query.filter_by(menu_date=today).all() if dm.orders]
-        if not dms:
+        if not meals:
             return f'📊 今日（{today.strftime("%m/%d")}）還沒有任何訂單'
-        reply = f'📊 今日統計 ({today.strftime("%m/%d")})\n'
+        reply = ReplyBuilder().line(f'📊 今日統計 ({today.strftime("%m/%d")})')
         grand_total = 0
-        for dm in dms:
-            meal_name = Config.MEAL_TYPES.get(dm.meal_type, dm.meal_type)
-            shop = dm.shop.name if dm.shop else '未指定店家'
-            counter = Counter(o.items for o in dm.orders)
-            total_count = sum(counter.values())
-            total_amount = sum(o.amount for o in dm.orders)
-            grand_total += total_amount
-            reply += '─' * 20 + '\n'
-            reply += f'【{meal_name}】{shop}（{total_count} 份）\n'
-            for item, count in sorted(counter.items()):
-                reply += f'🍱 {item} × {count}\n'
-        reply += '─' * 20 + '\n'
-        reply += f'今日總計 ${int(grand_total)}'
-        return reply
+        for meal in meals:
+            meal_name = Config.MEAL_TYPES.get(meal['meal_type'], meal['meal_type'])
+            grand_total += meal['amount']
+            reply.divider().line(f'【{meal_name}】{meal["shop"]}（{meal["count"]} 份）')
+            reply.lines(f'🍱 {item} × {count}' for item, count in meal['items'])
+        reply.divider().line(f'今日總計 ${int(grand_total)}')
+        return reply.render()
+
+    @staticmethod
+    def meal_tallies(menu_date, meal_type=None):
+        """
+        某天各餐的叫餐總表：直接讀 meal_tallies（ledger 隨訂單異動維護），一個查詢
+        回傳 [{'meal_type', 'shop', 'count', 'amount', 'items': [(品項, 份數)]}]，依 DailyMenu 建立順序
+        """
+        q = (db.session.query(DailyMenu.id, DailyMenu.meal_type, Shop.name,
+                              MealTally.item, MealTally.count, MealTally.amount)
+             .join(MealTally, MealTally.daily_menu_id == DailyMenu.id)
+             .outerjoin(Shop, DailyMenu.shop_id == Shop.id)
+             .filter(DailyMenu.menu_date == menu_date, MealTally.count > 0))
+        if meal_type:
+            q = q.filter(DailyMenu.meal_type == meal_type)
+        meals = {}
+        for dm_id, mt, shop_name, item, count, amount in q.order_by(DailyMenu.id, MealTally.item):
+            meal = meals.setdefault(dm_id, {'meal_type': mt, 'shop': shop_name or '未指定店家',
+                                            'count': 0, 'amount': 0.0, 'items': []})
+            meal['count'] += count
+            meal['amount'] += amount or 0.0
+            meal['items'].append((item, count))
+        return list(meals.values())
 
     # ─── !結清 ────────────────────────────────────────────────────
+    @staticmethod
+    def parse_date(text, today=None):
+        """今天 / 昨天 / 10/15 / 2024-10-15，看不懂回傳 None"""
+        today = today or date.today()
+        if text in ('今天', '今日', 'today'):
+            return today
+        if text in ('昨天', 'yesterday'):
+            return today - timedelta(days=1)
+        try:
+            m = re.match(r'^(\d{4})[-/](\d{1,2})[-/](\d{1,2})$', text)
+            if m:
+                return date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+            m = re.match(r'^(\d{1,2})/(\d{1,2})$', text)
+            if m:
+                d = date(today.year, int(m.group(1)), int(m.group(2)))
+                # 沒寫年份又比今天晚，視為去年
+                return d if d <= today else d.replace(year=today.year - 1)
+        except ValueError:
+            return None
+        return None
+
+    @command('checkout', '!結清', '!checkout', read_only=False)
     def handle_checkout(self, message_text):
+        """
+        格式：!結清 [代號] [餐別(選填)] [日期或 日期~日期(選填)] [代墊人代號(選填)]
+        全部條件都走同一個 UPDATE ... RETURNING
+        """
+        usage = ('❌ 格式：!結清 [代號] [餐別] [日期] [代墊人]\n'
+                 '例：!結清 2\n　　!結清 2 午餐 10/15\n　　!結清 2 10/01~10/15 5')
         code = re.sub(r'[！!](結清|checkout)', '', message_text, flags=re.IGNORECASE).strip()
         parts = code.split()
         if not parts or not parts[0].isdigit():
-            return '❌ 格式：!結清 [代號]\n例：!結清 2'
+            return usage
 
         user_code = parts[0]
-        user = User.query.filter_by(user_code=user_code).first()
+        meal_type = payer_code = date_from = date_to = None
+        for token in parts[1:]:
+            if token.lower() in MEAL_KEYWORDS:
+                meal_type = MEAL_KEYWORDS[token.lower()]
+            elif token.isdigit():
+                payer_code = token
+            else:
+                bounds = [self.parse_date(t) for t in re.split(r'[~～]', token, maxsplit=1)]
+                if None in bounds:
+                    return f'❌ 看不懂「{token}」\n' + usage
+                date_from, date_to = bounds[0], bounds[-1]
+
+        users = self.resolve_users([user_code] + ([payer_code] if payer_code else []))
+        user = users.get(user_code)
         if not user:
             return f'❌ 代號 {user_code} 不存在'
+        payer = users.get(payer_code) if payer_code else None
+        if payer_code and not payer:
+            return f'❌ 代墊人代號 {payer_code} 不存在'
 
-        unpaid = Order.query.filter_by(user_id=user.id, paid=False).all()
-        if not unpaid:
+        # 篩選條件說明（沒有條件時回覆與以前相同）
+        scope = []
+        if date_from:
+            scope.append(date_from.strftime('%m/%d') if date_from == date_to
+                         else f'{date_from.strftime("%m/%d")}~{date_to.strftime("%m/%d")}')
+        if meal_type:
+            scope.append(Config.MEAL_TYPES.get(meal_type, meal_type))
+        if payer:
+            scope.append(f'代墊 {payer.user_code}. {payer.name}')
+        scope = '、'.join(scope)
+
+        settled = run_with_retry(lambda: ledger.settle(
+            user.id, payer_id=payer.id if payer else None,
+            date_from=date_from, date_to=date_to, meal_type=meal_type))
+        count, total = settled.get(user.id, (0, 0.0))
+        if not count:
+            if scope:
+                return f'✅ {user_code}號 {user.name} 沒有符合條件（{scope}）的未付款訂單'
             return f'✅ {user_code}號 {user.name} 目前沒有未付款訂單'
 
-        total = sum(o.amount for o in unpaid)
-        for o in unpaid:
-            o.paid = True
-        db.session.commit()
-
         return (f'💰 結帳成功！\n'
                 f'👤 {user.user_code}. {user.name}\n'
-                f'🧾 {len(unpaid)} 筆，共 ${int(total)}\n'
+                + (f'🔎 {scope}\n' if scope else '') +
+                f'🧾 {count} 筆，共 ${int(total)}\n'
                 f'✅ 已全部標記為已付款')
 
     # ─── !help ────────────────────────────────────────────────────
+    @command('help', '!help', '!說明', args=())
     def handle_help(self):
         return """🍱 點餐機器人 V2
 
@@ -523,22 +679,22 @@ class OrderBot:
 ══════════════════
 !結清 [代號]
 → 結清該人所有欠款
+!結清 [代號] [餐別] [日期] [代墊人]
+→ 只結清符合條件的（例：!結清 2 午餐 10/15）
 
 ══════════════════
 每晚 20:30 自動推播未付款提醒"""
 
     # ─── !今天吃什麼 ──────────────────────────────────────────────
+    @command('suggest', '!今天吃什麼', '!吃什麼', '!隨機', args=())
     def handle_suggest_shops(self):
         """隨機推薦最多 3 家今天有營業的店家"""
         import random
         weekday = date.today().weekday()  # 0=Mon ... 6=Sun
         day_names = ['一','二','三','四','五','六','日']
 
-        shops = Shop.query.filter_by(is_active=True).all()
-        open_shops = [
-            s for s in shops
-            if (s.business_days or '1111111')[weekday] == '1'
-        ]
+        catalog = get_catalog()
+        open_shops = [s for s in catalog.active_shops if s.is_open(weekday)]
 
         if not open_shops:
             return f'😢 今天（週{day_names[weekday]}）找不到任何有營業的店家，可能是假日？'
@@ -547,7 +703,7 @@ class OrderBot:
         reply = f'🎲 今天吃什麼？（隨機推薦，週{day_names[weekday]}）\n'
         reply += '─' * 20 + '\n'
         for i, s in enumerate(picks, 1):
-            items = MenuItem.query.filter_by(shop_id=s.id, is_available=True).limit(3).all()
+            items = catalog.items(s.id)[:3]
             sample = '、'.join(i.name for i in items) if items else '（尚無品項）'
             reply += f'{i}️⃣ {s.name}'
             if s.phone:
@@ -558,21 +714,52 @@ class OrderBot:
         return reply
 
     # ─── 每日統計 ─────────────────────────────────────────────────
-    def generate_daily_unpaid_summary(self):
-        users_with_unpaid = (db.session.query(User)
-                             .join(Order, User.id == Order.user_id)
-                             .filter(Order.paid == False, User.is_admin == False)
-                             .distinct()
-                             .order_by(db.cast(User.user_code, db.Integer))
-                             .all())
-        if not users_with_unpaid:
+    def generate_daily_unpaid_summary(self, by_payer=None):
+        """
+        每日帳務提醒：一個查詢取出所有欠款人（依代號數字排序）
+        by_payer=True 時改從 orders 依 (欠款人, 代墊人) GROUP BY，列出欠誰多少
+        """
+        if by_payer is None:
+            by_payer = self.config.get('DAILY_SUMMARY_BY_PAYER', False)
+        rows = self._unpaid_by_payer() if by_payer else self._unpaid_by_user()
+        if not rows:
             return None
 
         today = date.today()
-        reply = f'📊 帳務提醒 ({today.strftime("%Y/%m/%d")} 20:30)\n\n'
-        for user in users_with_unpaid:
-            unpaid = Order.query.filter_by(user_id=user.id, paid=False).all()
-            total = sum(o.amount for o in unpaid)
+        reply = ReplyBuilder().line(f'📊 帳務提醒 ({today.strftime("%Y/%m/%d")} 20:30)').line()
+        for user_code, name, total, payers in rows:
             if total > 0:
-                reply += f'{user.user_code}. {user.name}  未付 ${int(total)}\n'
-        return reply
+                reply.line(f'{user_code}. {name}  未付 ${int(total)}')
+                if payers:
+                    reply.line('　└ ' + '、'.join(f'{p}${int(amount)}' for p, amount in payers))
+        return reply.line().render()
+
+    @staticmethod
+    def _unpaid_by_user():
+        """帳本 join users，一個查詢"""
+        rows = (db.session.query(User.user_code, User.name, UserBalance.unpaid_total)
+                .join(UserBalance, UserBalance.user_id == User.id)
+                .filter(UserBalance.unpaid_count > 0, User.is_admin == False)
+                .order_by(db.cast(User.user_code, db.Integer))
+                .all())
+        return [(code, name, total, None) for code, name, total in rows]
+
+    @staticmethod
+    def _unpaid_by_payer():
+        """orders 依 (user_id, payer_id) 加總，一個查詢；回傳時再依欠款人合併"""
+        payer = db.aliased(User)
+        rows = (db.session.query(User.user_code, User.name, payer.user_code, payer.name,
+                                 db.func.sum(Order.amount))
+                .join(Order, Order.user_id == User.id)
+                .outerjoin(payer, Order.payer_id == payer.id)
+                .filter(Order.paid == False, User.is_admin == False)
+                .group_by(Order.user_id, Order.payer_id)
+                .order_by(db.cast(User.user_code, db.Integer), db.cast(payer.user_code, db.Integer))
+                .all())
+        merged = {}
+        for code, name, payer_code, payer_name, amount in rows:
+            entry = merged.setdefault(code, [code, name, 0.0, []])
+            entry[2] += amount or 0.0
+            label = f'欠 {payer_code}. {payer_name} ' if payer_code else '未指定代墊 '
+            entry[3].append((label, amount or 0.0))
+        return [tuple(entry) for entry in merged.values()]
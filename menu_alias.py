@@ -0,0 +1,112 @@
+"""
+品名別名（學習使用者的慣用簡稱）
+
+大家每天打的簡稱都差不多（「雞腿」、「排骨飯大」），模糊比對或後台修正後，
+就把 (店家, 正規化後的輸入) → 品項 記到 menu_aliases，下次精確比對不到時先查別名，
+命中就直接採用，不再跑模糊比對。
+模糊比對自動學到的別名可能猜錯：命中 trust_hits 次以前照樣跳「⚠️ 比對為」提醒，
+後台修正過（confirmed）的才一開始就不提醒。
+"""
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import case
+from sqlalchemy.dialects.sqlite import insert
+
+from models import db, MenuAlias
+from menu_catalog import clean_name
+
+
+class AliasStore:
+    def __init__(self, trust_hits=3):
+        self.trust_hits = trust_hits
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'learned': 0}
+
+    def _bump(self, key, n):
+        with self._lock:
+            self.stats[key] += n
+
+    # ─── 查詢 ─────────────────────────────────────────────────────
+    def resolve(self, shop_id, cleaned_names, catalog):
+        """
+        一次查出整批已正規化品名的別名，回傳 {cleaned: (CatalogItem, 是否可直接採用)}
+        已確認或命中達 trust_hits 次的別名可直接採用，其餘仍要提醒使用者確認
+        別名指向的品項已下架 / 不屬於該店時視為沒有別名
+        只讀不寫；實際採用後由呼叫端在寫入交易內呼叫 touch()
+        """
+        names = set(cleaned_names)
+        if shop_id is None or not names:
+            return {}
+        rows = (db.session.query(MenuAlias.normalized_input, MenuAlias.menu_item_id,
+                                 MenuAlias.confirmed, MenuAlias.hits)
+                .filter(MenuAlias.shop_id == shop_id, MenuAlias.normalized_input.in_(names))
+                .all())
+        found = {}
+        for name, item_id, confirmed, hits in rows:
+            item = catalog.items_by_id.get(item_id)
+            if item and item.shop_id == shop_id:
+                found[name] = (item, bool(confirmed) or (hits or 0) >= self.trust_hits)
+        self._bump('hits', len(found))
+        self._bump('misses', len(names) - len(found))
+        return found
+
+    @staticmethod
+    def touch(shop_id, names):
+        """採用的別名命中次數 +1、更新最後使用時間（與呼叫端同一個交易）"""
+        names = {clean_name(n) for n in names} - {''}
+        if shop_id is None or not names:
+            return
+        (MenuAlias.query
+         .filter(MenuAlias.shop_id == shop_id, MenuAlias.normalized_input.in_(names))
+         .update({MenuAlias.hits: MenuAlias.hits + 1, MenuAlias.last_used: datetime.utcnow()},
+                 synchronize_session=False))
+
+    # ─── 學習 ─────────────────────────────────────────────────────
+    def remember(self, shop_id, pairs, confirmed=False):
+        """
+        pairs: [(使用者輸入, menu_item_id)]；同一店家同一輸入以最後一次為準
+        confirmed: 後台修正時為 True；改指向別的品項時命中次數歸零
+        與呼叫端同一個交易，由呼叫端 commit
+        """
+        rows = {}
+        for raw, item_id in pairs:
+            cleaned = clean_name(raw)
+            if cleaned and item_id:
+                rows[cleaned] = item_id
+        if shop_id is None or not rows:
+            return 0
+        now = datetime.utcnow()
+        stmt = insert(MenuAlias)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[MenuAlias.shop_id, MenuAlias.normalized_input],
+            set_={
+                'menu_item_id': stmt.excluded.menu_item_id,
+                'confirmed': stmt.excluded.confirmed,
+                'hits': case((MenuAlias.menu_item_id == stmt.excluded.menu_item_id, MenuAlias.hits), else_=0),
+                'last_used': stmt.excluded.last_used,
+            },
+        )
+        db.session.execute(stmt, [
+            {'shop_id': shop_id, 'normalized_input': name, 'menu_item_id': item_id,
+             'hits': 0, 'confirmed': confirmed, 'created_date': now, 'last_used': now}
+            for name, item_id in rows.items()
+        ])
+        self._bump('learned', len(rows))
+        return len(rows)
+
+    # ─── 維護 ─────────────────────────────────────────────────────
+    @staticmethod
+    def prune(max_hits=0, idle_days=30):
+        """刪除命中次數 <= max_hits 且超過 idle_days 天沒用到的別名，回傳刪除筆數"""
+        cutoff = datetime.utcnow() - timedelta(days=idle_days)
+        return (MenuAlias.query
+                .filter(MenuAlias.hits <= max_hits, MenuAlias.last_used < cutoff)
+                .delete(synchronize_session=False))
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        return stats
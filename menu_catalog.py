@@ -0,0 +1,191 @@
+"""
+菜單目錄快照
+
+把所有店家、可供應品項（含正規化後的品名）、營業日與價格預先整理成一份唯讀快照，
+bot 指令比對店家 / 品項時直接查快照，不再每行訊息重新撈 MenuItem、重跑 clean_name。
+
+後台修改店家或菜單時呼叫 bump_version()（與該次修改同一個 commit），
+版本戳記存在 settings 表，所有 gunicorn worker 下次取用時發現版本不同就重建並整份替換。
+"""
+import re
+import threading
+import unicodedata
+import uuid
+from collections import OrderedDict
+
+from rapidfuzz import process, fuzz
+
+from flask import current_app
+
+from models import Shop, MenuItem, SystemSetting
+
+VERSION_KEY = 'menu_catalog_version'
+
+
+def clean_name(name):
+    """NFKC 正規化、去除零寬字元與換行、合併空白"""
+    if not name:
+        return ''
+    n = unicodedata.normalize('NFKC', name)
+    n = re.sub(r'[\u200b-\u200f\ufeff\u202a-\u202e\r\n]', '', n)
+    n = re.sub(r'\s+', ' ', n)
+    return n.strip()
+
+
+class CatalogShop:
+    __slots__ = ('id', 'name', 'phone', 'business_days', 'open_days', 'is_active', 'menu_image')
+
+    def __init__(self, shop):
+        self.id = shop.id
+        self.name = shop.name
+        self.phone = shop.phone
+        self.business_days = shop.business_days or '1111111'
+        days = self.business_days
+        # 格式不正確時視為每天營業（與原本判斷一致）
+        self.open_days = tuple(len(days) != 7 or days[i] != '0' for i in range(7))
+        self.is_active = bool(shop.is_active)
+        self.menu_image = shop.menu_image
+
+    def is_open(self, weekday):
+        return self.open_days[weekday]
+
+
+class CatalogItem:
+    __slots__ = ('id', 'shop_id', 'name', 'clean_name', 'price')
+
+    def __init__(self, item):
+        self.id = item.id
+        self.shop_id = item.shop_id
+        self.name = item.name
+        self.clean_name = clean_name(item.name)
+        self.price = item.price
+
+
+class MenuCatalog:
+    """某個版本的菜單快照（建立後不再修改）"""
+
+    def __init__(self, version, shops, items):
+        self.version = version
+        self.shops = tuple(CatalogShop(s) for s in shops)
+        self.shops_by_id = {s.id: s for s in self.shops}
+        self.active_shops = tuple(s for s in self.shops if s.is_active)
+
+        all_items = [CatalogItem(i) for i in items]
+        self.items_by_id = {i.id: i for i in all_items}
+        by_shop = {}
+        for i in all_items:
+            by_shop.setdefault(i.shop_id, []).append(i)
+        by_shop = {sid: tuple(its) for sid, its in by_shop.items()}
+        by_shop[None] = tuple(all_items)
+        self._items = by_shop
+        self._names = {sid: [i.clean_name for i in its] for sid, its in by_shop.items()}
+        self._exact = {}
+        for sid, its in by_shop.items():
+            exact = {}
+            for i in its:
+                exact.setdefault(i.clean_name, i)   # 同名時以第一筆為準
+            self._exact[sid] = exact
+
+    @classmethod
+    def load(cls, version):
+        shops = Shop.query.order_by(Shop.id).all()
+        items = MenuItem.query.filter_by(is_available=True).order_by(MenuItem.id).all()
+        return cls(version, shops, items)
+
+    def items(self, shop_id=None):
+        """可供應品項（shop_id=None 表示所有店家）"""
+        return self._items.get(shop_id, ())
+
+    def names(self, shop_id=None):
+        """與 items() 同順序的正規化品名"""
+        return self._names.get(shop_id, [])
+
+    def exact(self, shop_id, cleaned):
+        return self._exact.get(shop_id, {}).get(cleaned)
+
+    def match_shop(self, keyword, active_only=True, threshold=50):
+        shops = self.active_shops if active_only else self.shops
+        if not shops:
+            return None
+        result = process.extractOne(keyword, [s.name for s in shops], scorer=fuzz.ratio)
+        if result and result[1] >= threshold:
+            return shops[result[2]]
+        return None
+
+
+def bump_version():
+    """店家 / 菜單有異動時呼叫；與異動同一個 commit 寫入"""
+    SystemSetting.set(VERSION_KEY, uuid.uuid4().hex)
+
+
+class CatalogCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = None
+        self.builds = 0
+
+    def get(self):
+        version = SystemSetting.get(VERSION_KEY, '0')
+        current = self._current
+        if current is None or current.version != version:
+            with self._lock:
+                current = self._current
+                if current is None or current.version != version:
+                    current = MenuCatalog.load(version)
+                    self._current = current
+                    self.builds += 1
+        return current
+
+
+class MatchCache:
+    """
+    模糊比對結果的 LRU 快取：key = (菜單版本, shop_id, 正規化品名)，value = (品項 id 或 None, confidence)
+    只存 id，取用時再從當下的快照 items_by_id 取回 CatalogItem；菜單一改版本就不同，舊 key 自然淘汰
+    """
+
+    def __init__(self, maxsize=2048):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.stats['misses'] += 1
+                return None
+            self._data.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self._data)
+        stats['maxsize'] = self.maxsize
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        return stats
+
+
+def get_catalog():
+    """目前 app 的最新快照（每次呼叫只多一個 settings 查詢來比對版本）"""
+    cache = current_app.extensions.get('menu_catalog')
+    if cache is None:
+        cache = current_app.extensions.setdefault('menu_catalog', CatalogCache())
+    return cache.get()
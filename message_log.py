@@ -0,0 +1,145 @@
+"""
+LINE 訊息紀錄 write-behind 寫入
+
+handle_text_message 只把紀錄丟進記憶體緩衝區，背景執行緒累積到 batch_size 筆
+或最舊一筆超過 flush_seconds 秒時，用一個交易整批寫入 line_messages。
+- 緩衝區有上限；滿了就由呼叫端自己先寫一批（backpressure），還是放不進去就捨棄該筆，
+  webhook 執行緒不會因背景寫入卡住而一直等
+- 行程結束時（atexit）把剩下的寫完
+- 非指令的一般聊天可依 chatter_sample 抽樣或完全略過
+"""
+import atexit
+import queue
+import random
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from models import db, LineMessage
+
+
+class MessageLogWriter:
+    def __init__(self, app, batch_size=100, flush_seconds=2.0, capacity=5000,
+                 put_timeout=0.5, chatter_sample=1.0):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.put_timeout = put_timeout
+        self.chatter_sample = chatter_sample
+        self._buffer = queue.Queue(maxsize=capacity)
+        self._flush_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'buffered': 0, 'written': 0, 'batches': 0, 'skipped': 0,
+                      'backpressure': 0, 'dropped': 0}
+
+    @classmethod
+    def from_config(cls, app):
+        c = app.config
+        return cls(app,
+                   batch_size=c['LINE_LOG_BATCH_SIZE'],
+                   flush_seconds=c['LINE_LOG_FLUSH_SECONDS'],
+                   capacity=c['LINE_LOG_BUFFER'],
+                   chatter_sample=c['LINE_LOG_CHATTER_SAMPLE'] if c['LINE_LOG_CHATTER'] else 0.0)
+
+    # ─── 寫入緩衝 ─────────────────────────────────────────────────
+    def log(self, message_type, content, user_id=None, group_id=None, is_command=True):
+        if not is_command and (self.chatter_sample <= 0 or random.random() >= self.chatter_sample):
+            self._count('skipped')
+            return
+        row = {'message_type': message_type, 'message_content': content,
+               'user_id': user_id, 'group_id': group_id,
+               'processed': False, 'created_date': datetime.utcnow()}
+        try:
+            self._buffer.put(row, timeout=self.put_timeout)
+        except queue.Full:
+            # 背景執行緒跟不上：由呼叫端先寫掉一批再放進去；寫入卡住或還是滿的就捨棄這筆
+            self._count('backpressure')
+            self.flush(self.batch_size, timeout=self.put_timeout)
+            try:
+                self._buffer.put(row, timeout=self.put_timeout)
+            except queue.Full:
+                self._count('dropped')
+                return
+        self._count('buffered')
+
+    def _count(self, key, n=1):
+        # log() 由多個 webhook 執行緒呼叫，flush() 也可能在背景執行緒跑
+        with self._stats_lock:
+            self.stats[key] += n
+
+    # ─── 寫入 DB ──────────────────────────────────────────────────
+    def _take(self, limit):
+        rows = []
+        while len(rows) < limit:
+            try:
+                rows.append(self._buffer.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def flush(self, limit=None, timeout=-1):
+        """
+        把緩衝區內（最多 limit 筆）一次寫入，回傳寫入筆數
+        timeout 秒內拿不到寫入鎖（另一個 flush 卡住）就放棄，回傳 0；預設一直等
+        """
+        if not self._flush_lock.acquire(timeout=timeout):
+            return 0
+        try:
+            rows = self._take(limit or self._buffer.maxsize)
+            if not rows:
+                return 0
+            for attempt in range(2):
+                try:
+                    with self.app.app_context():
+                        db.session.execute(insert(LineMessage), rows)
+                        db.session.commit()
+                    break
+                except Exception as e:
+                    if attempt:
+                        print(f'訊息紀錄寫入失敗，捨棄 {len(rows)} 筆: {e}')
+                        self._count('dropped', len(rows))
+                        return 0
+                    time.sleep(0.5)
+            with self._stats_lock:
+                self.stats['written'] += len(rows)
+                self.stats['batches'] += 1
+            return len(rows)
+        finally:
+            self._flush_lock.release()
+
+    # ─── 背景執行緒 ───────────────────────────────────────────────
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='message-log', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        oldest = None
+        while not self._stop.is_set():
+            size = self._buffer.qsize()
+            if size and oldest is None:
+                oldest = time.monotonic()
+            if size >= self.batch_size or (oldest and time.monotonic() - oldest >= self.flush_seconds):
+                self.flush(self.batch_size)
+                oldest = time.monotonic() if self._buffer.qsize() else None
+                continue
+            self._stop.wait(min(0.2, self.flush_seconds))
+
+    def close(self):
+        """停止背景執行緒並寫完剩下的紀錄"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(5)
+            self._thread = None
+        while self.flush(self.batch_size):
+            pass
+
+    def metrics(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['pending'] = self._buffer.qsize()
+        return stats
@@ -1,10 +1,70 @@
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, date
+from sqlalchemy import event, insert
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from datetime import datetime, date, timedelta
 import json
+import random
+import time
 
 db = SQLAlchemy()
 
 
+class DuplicateEventError(Exception):
+    """同一個 LINE webhook 事件已經寫入過（LINE 重送，或佇列租約到期後被另一個 worker 重跑）"""
+
+
+def run_with_retry(work, attempts=4, base_delay=0.05):
+    """
+    執行 work() 並 commit；遇到 SQLite「database is locked」（其他 worker 正在寫）
+    就 rollback、稍等後整個交易重做，最多 attempts 次，其他錯誤直接往外丟
+    work 必須可重複執行（不要在裡面做寫 DB 以外的副作用）
+    正在處理 webhook 事件時（g.webhook_event_id），事件 id 與 work() 的寫入同一個交易記錄，
+    已記錄過就 rollback 並丟出 DuplicateEventError
+    """
+    event_id = g.get('webhook_event_id') if has_app_context() else None
+    for attempt in range(1, attempts + 1):
+        try:
+            result = work()
+            if event_id:
+                db.session.add(ProcessedEvent(event_id=event_id))
+            db.session.commit()
+            if event_id:
+                g.pop('webhook_event_id', None)   # 同一個事件的後續交易不再重複記錄
+            return result
+        except IntegrityError as e:
+            db.session.rollback()
+            if event_id and 'processed_events' in str(e):
+                raise DuplicateEventError(event_id) from e
+            raise
+        except OperationalError as e:
+            db.session.rollback()
+            if 'database is locked' not in str(e) or attempt == attempts:
+                raise
+            print(f'資料庫忙碌中，第 {attempt} 次重試')
+            time.sleep(base_delay * 2 ** (attempt - 1) * random.uniform(1, 2))
+
+
+def apply_sqlite_pragmas(engine, pragmas):
+    """
+    每條新的 SQLite 連線都執行 PRAGMA（WAL、busy_timeout、cache_size…），在第一條連線建立前呼叫
+    pragmas: {'journal_mode': 'WAL', ...}；值為 None 的略過，非 SQLite 引擎整個略過
+    """
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        try:
+            for name, value in pragmas.items():
+                if value is not None:
+                    cursor.execute(f'PRAGMA {name}={value}')
+        finally:
+            cursor.close()
+
+
 class User(db.Model):
     """使用者（代號識別，代號可隨時更動）"""
     __tablename__ = 'users'
@@ -31,6 +91,10 @@ class User(db.Model):
         foreign_keys='Order.payer_id'
     )
 
+    __table_args__ = (
+        db.Index('ix_users_role', 'role'),
+    )
+
     def __repr__(self):
         return f'<User {self.user_code}: {self.name} [{self.role}]>'
 
@@ -56,6 +120,10 @@ class Shop(db.Model):
     )
     daily_menus = db.relationship('DailyMenu', backref='shop', lazy=True)
 
+    __table_args__ = (
+        db.Index('ix_shops_is_active', 'is_active'),
+    )
+
     @property
     def meal_types(self):
         try:
@@ -82,6 +150,15 @@ class MenuItem(db.Model):
     is_available = db.Column(db.Boolean, default=True)
     created_date = db.Column(db.DateTime, default=datetime.utcnow)
 
+    aliases = db.relationship(
+        'MenuAlias', backref='menu_item', lazy=True,
+        cascade='all, delete-orphan'
+    )
+
+    __table_args__ = (
+        db.Index('ix_menu_items_shop_available', 'shop_id', 'is_available'),
+    )
+
     def __repr__(self):
         return f'<MenuItem {self.name} ${self.price}>'
 
@@ -100,11 +177,30 @@ class DailyMenu(db.Model):
         'Order', backref='daily_menu', lazy=True,
         cascade='all, delete-orphan'
     )
+    tallies = db.relationship(
+        'MealTally', backref='daily_menu', lazy=True,
+        cascade='all, delete-orphan'
+    )
 
     __table_args__ = (
+        # 同時是依日期查詢（menu_date 開頭）的索引
         db.UniqueConstraint('menu_date', 'meal_type', name='unique_daily_meal'),
+        db.Index('ix_daily_menus_shop', 'shop_id'),
     )
 
+    @staticmethod
+    def get_or_create(menu_date, meal_type):
+        """
+        取得（必要時建立）某天某餐的 DailyMenu，不 commit
+        用 INSERT ... ON CONFLICT DO NOTHING，兩則訊息同時建立同一餐也不會撞 unique_daily_meal
+        """
+        db.session.execute(
+            sqlite_insert(DailyMenu)
+            .values(menu_date=menu_date, meal_type=meal_type, created_date=datetime.utcnow())
+            .on_conflict_do_nothing(index_elements=['menu_date', 'meal_type'])
+        )
+        return DailyMenu.query.filter_by(menu_date=menu_date, meal_type=meal_type).one()
+
     def __repr__(self):
         return f'<DailyMenu {self.menu_date} {self.meal_type}>'
 
@@ -122,14 +218,123 @@ class Order(db.Model):
     paid = db.Column(db.Boolean, default=False)
     payer_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)  # 代墊人
     note = db.Column(db.String(200))
+    raw_item = db.Column(db.String(200))                 # 使用者原本輸入的品名（修正別名用）
     created_date = db.Column(db.DateTime, default=datetime.utcnow)
 
-    menu_item = db.relationship('MenuItem', foreign_keys=[menu_item_id])
+    # 刪除品項時 ORM 會把這些訂單的 menu_item_id 設為 NULL（foreign_keys=ON 下才不會違反外鍵）
+    menu_item = db.relationship('MenuItem', foreign_keys=[menu_item_id],
+                                backref=db.backref('orders', lazy=True))
+
+    __table_args__ = (
+        db.Index('ix_orders_user_paid', 'user_id', 'paid'),       # !bill、!結清、帳本對帳
+        db.Index('ix_orders_daily_menu', 'daily_menu_id'),        # 某天 / 某餐的訂單
+        db.Index('ix_orders_payer', 'payer_id'),                  # 代墊人彙總；刪除使用者時的外鍵檢查
+        db.Index('ix_orders_menu_item', 'menu_item_id'),          # 刪除品項時的外鍵檢查
+        # 只含未付款訂單的部分索引（覆蓋 user_id / payer_id / amount）：每日帳務提醒依代墊人加總、帳本對帳
+        db.Index('ix_orders_unpaid', 'user_id', 'payer_id', 'amount', sqlite_where=db.text('paid = 0')),
+    )
+
+    @staticmethod
+    def insert_many(rows):
+        """
+        一次 executemany 寫入多筆訂單（不經過 ORM 物件 / identity map），不 commit
+        rows: [dict]，欄位需一致；回傳與 rows 同順序的新訂單 id
+        """
+        if not rows:
+            return []
+        now = datetime.utcnow()
+        rows = [{'paid': False, 'created_date': now, **row} for row in rows]
+        # SQLite 的 RETURNING 不保證順序；同一交易內 rowid 依 VALUES 順序遞增，排序即對回 rows
+        # （sort_by_parameter_order=True 在 SQLite 會退回逐筆 INSERT）
+        return sorted(db.session.scalars(insert(Order).returning(Order.id), rows))
+
+    @staticmethod
+    def for_date(menu_date):
+        """
+        某天的訂單（後台列表頁用）：user / daily_menu 由 JOIN 直接帶回，
+        店家與代墊人各一個 IN 查詢，模板逐筆取 o.user / o.daily_menu.shop / o.payer 不再 lazy load
+        """
+        return (Order.query
+                .join(DailyMenu, Order.daily_menu_id == DailyMenu.id)
+                .join(User, Order.user_id == User.id)
+                .filter(DailyMenu.menu_date == menu_date)
+                .options(db.contains_eager(Order.daily_menu).selectinload(DailyMenu.shop),
+                         db.contains_eager(Order.user),
+                         db.selectinload(Order.payer)))
 
     def __repr__(self):
         return f'<Order {self.user.user_code if self.user else "?"}: {self.items}>'
 
 
+class MealTally(db.Model):
+    """每餐叫餐總表：品項 → 份數 / 金額（由 ledger.py 隨訂單異動同步維護）"""
+    __tablename__ = 'meal_tallies'
+
+    id = db.Column(db.Integer, primary_key=True)
+    daily_menu_id = db.Column(db.Integer, db.ForeignKey('daily_menus.id'), nullable=False)
+    item = db.Column(db.String(200), nullable=False)     # 與 Order.items 相同（含備註）
+    count = db.Column(db.Integer, nullable=False, default=0)
+    amount = db.Column(db.Float, nullable=False, default=0.0)
+
+    __table_args__ = (
+        db.UniqueConstraint('daily_menu_id', 'item', name='unique_meal_item'),
+    )
+
+    def __repr__(self):
+        return f'<MealTally {self.daily_menu_id} {self.item} x{self.count}>'
+
+
+class UserBalance(db.Model):
+    """每人未付款累計（由 ledger.py 隨訂單異動同步維護，定期與 orders 對帳）"""
+    __tablename__ = 'user_balances'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    unpaid_total = db.Column(db.Float, nullable=False, default=0.0)
+    unpaid_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<UserBalance {self.user_id} ${self.unpaid_total} ({self.unpaid_count})>'
+
+
+class ProcessedEvent(db.Model):
+    """已寫入過的 LINE webhook 事件（webhookEventId），由 run_with_retry 與寫入同一個交易記錄"""
+    __tablename__ = 'processed_events'
+
+    event_id = db.Column(db.String(64), primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    @staticmethod
+    def prune(days=7):
+        """LINE 只會在短時間內重送，舊紀錄定期清掉；不 commit"""
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        return ProcessedEvent.query.filter(ProcessedEvent.created_at < cutoff).delete()
+
+
+class MenuAlias(db.Model):
+    """品名別名（使用者常打的簡稱 → 菜單品項，模糊比對後自動學習、後台修正後確認）"""
+    __tablename__ = 'menu_aliases'
+
+    id = db.Column(db.Integer, primary_key=True)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shops.id'), nullable=False)
+    normalized_input = db.Column(db.String(200), nullable=False)   # clean_name 後的輸入
+    menu_item_id = db.Column(db.Integer, db.ForeignKey('menu_items.id'), nullable=False)
+    hits = db.Column(db.Integer, default=0)
+    confirmed = db.Column(db.Boolean, nullable=False, default=False)   # 後台修正 / 確認過
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used = db.Column(db.DateTime, default=datetime.utcnow)
+
+    shop = db.relationship('Shop')
+
+    __table_args__ = (
+        db.UniqueConstraint('shop_id', 'normalized_input', name='unique_shop_alias'),
+        db.Index('ix_menu_aliases_menu_item', 'menu_item_id'),
+    )
+
+    def __repr__(self):
+        return f'<MenuAlias {self.normalized_input} -> {self.menu_item_id}>'
+
+
 class LineMessage(db.Model):
     """LINE 訊息紀錄（偵錯用）"""
     __tablename__ = 'line_messages'
@@ -193,5 +398,9 @@ class LoginLog(db.Model):
     success = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_login_logs_created_at', 'created_at'),
+    )
+
     def __repr__(self):
         return f'<LoginLog {self.username} {"OK" if self.success else "FAIL"}>'
@@ -0,0 +1,250 @@
+"""
+對外訊息派送（push / reply / multicast）
+
+所有推播先寫進 DurableQueue，由背景執行緒依各 API 的速率限制（token bucket）送出：
+- 429 / 5xx / 網路錯誤：指數退避 + jitter 後重試，重試狀態存在佇列檔案裡，重開機也不會遺失
+- 內容完全相同、對象是個人 (U...) 的 push 會合併成 multicast，一次最多 500 人；
+  第一次合併時把批次 id（即 multicast 的 retry key）寫回每筆工作，重試時同一批照原樣送，
+  不會因為重新分組換了 retry key 而讓已收到的人再收一次
+"""
+import json
+import random
+import threading
+import time
+import uuid
+
+import urllib3
+from linebot.v3.messaging import (
+    Message, PushMessageRequest, ReplyMessageRequest, MulticastRequest,
+)
+from linebot.v3.messaging.exceptions import ApiException
+
+MULTICAST_MAX_RECIPIENTS = 500
+REPLY_TOKEN_TTL = 50          # reply token 約 1 分鐘失效，留一點餘裕
+
+
+class TokenBucket:
+    """每秒補充 rate 個 token，最多累積 capacity 個"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取得一個 token，不夠就睡到補滿為止；回傳等待秒數"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class OutboundDispatcher:
+    def __init__(self, line, queue, rate_limits=None, workers=1,
+                 base_delay=1.0, max_delay=300.0, idle_wait=1.0):
+        """
+        line:  LineClient
+        queue: DurableQueue（max_attempts 即最多嘗試次數）
+        rate_limits: {'push': 每秒請求數, 'reply': ..., 'multicast': ...}
+        """
+        self.line = line
+        self.queue = queue
+        self.buckets = {endpoint: TokenBucket(rate)
+                        for endpoint, rate in (rate_limits or {}).items()}
+        self.workers = workers
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.idle_wait = idle_wait
+        self.stats = {'sent': 0, 'multicast_batches': 0, 'coalesced': 0,
+                      'retried': 0, 'dead': 0, 'throttled_seconds': 0.0}
+        self._stats_lock = threading.Lock()
+        self._threads = []
+        self._stop = threading.Event()
+
+    # ─── 入佇列 ───────────────────────────────────────────────────
+    @staticmethod
+    def _serialize(messages):
+        return [m if isinstance(m, dict) else m.to_dict() for m in messages]
+
+    def push(self, to, messages):
+        return self.queue.enqueue({
+            'kind': 'push', 'to': to,
+            'messages': self._serialize(messages),
+            'retry_key': str(uuid.uuid4()),
+        })
+
+    def reply(self, reply_token, messages):
+        return self.queue.enqueue({
+            'kind': 'reply', 'reply_token': reply_token,
+            'messages': self._serialize(messages),
+            'expires_at': time.time() + REPLY_TOKEN_TTL,
+        })
+
+    # ─── 工作執行緒 ───────────────────────────────────────────────
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f'outbound-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        self.queue.notify()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                sent = self.drain_once()
+            except Exception as e:
+                print(f'推播佇列處理失敗: {e}')
+                sent = 0
+            if not sent:
+                self.queue.wait(self.idle_wait)
+
+    def drain_once(self, limit=MULTICAST_MAX_RECIPIENTS * 2):
+        """取出一批工作並送出，回傳處理的工作數"""
+        jobs = self.queue.claim_many(limit)
+        if len(jobs) >= limit and jobs[-1]['payload'].get('batch_key'):
+            # 取滿了，最後一批可能被切開；整批放回，下次從它開始取，同一個 retry key 只送一次
+            batch_key = jobs[-1]['payload']['batch_key']
+            cut = [job for job in jobs if job['payload'].get('batch_key') == batch_key]
+            self.queue.release([job['id'] for job in cut])
+            jobs = [job for job in jobs if job['payload'].get('batch_key') != batch_key]
+        for endpoint, group in self._plan(jobs):
+            self._send(endpoint, group)
+        return len(jobs)
+
+    def _plan(self, jobs):
+        """把同內容的個人 push 合併成 multicast，其餘逐筆送；已分過批的工作照原批次送"""
+        plans = []
+        by_content = {}
+        batches = {}
+        for job in jobs:
+            p = job['payload']
+            if p.get('batch_key'):
+                batches.setdefault(p['batch_key'], []).append(job)
+            elif p['kind'] == 'push' and p['to'].startswith('U'):
+                key = json.dumps(p['messages'], sort_keys=True, ensure_ascii=False)
+                by_content.setdefault(key, []).append(job)
+            else:
+                plans.append((p['kind'], [job]))
+        new_batches = []
+        for group in by_content.values():
+            for i in range(0, len(group), MULTICAST_MAX_RECIPIENTS):
+                chunk = group[i:i + MULTICAST_MAX_RECIPIENTS]
+                if len(chunk) == 1:
+                    plans.append(('push', chunk))
+                    continue
+                batch_key = str(uuid.uuid4())
+                for job in chunk:
+                    job['payload']['batch_key'] = batch_key
+                new_batches.extend(chunk)
+                plans.append(('multicast', chunk))
+        if new_batches:
+            # 送出前先記下批次，行程中途掛掉、租約到期重跑也用同一個 retry key
+            self.queue.update_payloads([(job['id'], job['payload']) for job in new_batches])
+        plans.extend(('multicast', group) for group in batches.values())
+        return plans
+
+    def _send(self, endpoint, group):
+        first = group[0]['payload']
+        if endpoint == 'reply' and time.time() > first['expires_at']:
+            self._give_up(group, 'reply token expired')
+            return
+
+        bucket = self.buckets.get(endpoint)
+        if bucket:
+            waited = bucket.acquire()
+            if waited:
+                self._bump('throttled_seconds', waited)
+
+        messages = [Message.from_dict(m) for m in first['messages']]
+        try:
+            if endpoint == 'reply':
+                self.line.reply_message(ReplyMessageRequest(
+                    reply_token=first['reply_token'], messages=messages))
+            elif endpoint == 'push':
+                self.line.push_message(PushMessageRequest(to=first['to'], messages=messages),
+                                       retry_key=first['retry_key'])
+            else:
+                recipients = sorted({job['payload']['to'] for job in group})
+                self.line.multicast(MulticastRequest(to=recipients, messages=messages),
+                                    retry_key=first['batch_key'])
+        except ApiException as e:
+            # 409：同一個 retry key 已被 LINE 接受過（上次其實送出了），視為成功
+            if e.status == 409:
+                self._done(endpoint, group)
+            elif e.status == 429 or (e.status or 0) >= 500:
+                self._retry(group, f'HTTP {e.status}', self._retry_after(e))
+            else:
+                self._give_up(group, f'HTTP {e.status}: {e.body!r}')
+            return
+        except urllib3.exceptions.HTTPError as e:
+            self._retry(group, f'{type(e).__name__}: {e}')
+            return
+        except Exception as e:
+            self._give_up(group, f'{type(e).__name__}: {e}')
+            return
+        self._done(endpoint, group)
+
+    # ─── 結果處理 ─────────────────────────────────────────────────
+    def _done(self, endpoint, group):
+        for job in group:
+            self.queue.ack(job['id'])
+        self._bump('sent', len(group))
+        if endpoint == 'multicast':
+            self._bump('multicast_batches', 1)
+            self._bump('coalesced', len(group))
+
+    def _retry(self, group, error, retry_after=None):
+        # 同一批用同一個延遲，重試時才會一起被取出、照原批次送
+        delay = retry_after or self.backoff(group[0]['attempts'])
+        for job in group:
+            if job['attempts'] >= self.queue.max_attempts:
+                self._give_up([job], error)
+                continue
+            self.queue.retry(job['id'], delay, error)
+            self._bump('retried', 1)
+
+    def _give_up(self, group, error):
+        for job in group:
+            print(f'推播放棄 (job {job["id"]}): {error}')
+            self.queue.fail(job['id'], error)
+        self._bump('dead', len(group))
+
+    def backoff(self, attempts):
+        """指數退避 + jitter：base × 2^(n-1)，取其一半再加上隨機的另一半"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @staticmethod
+    def _retry_after(exc):
+        try:
+            return float(exc.headers.get('Retry-After')) if exc.headers else None
+        except (TypeError, ValueError):
+            return None
+
+    def _bump(self, key, n):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def metrics(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['throttled_seconds'] = round(stats['throttled_seconds'], 3)
+        stats['queue_depth'] = self.queue.depth()
+        stats['queue_status'] = self.queue.counts()
+        return stats
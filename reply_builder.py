@@ -0,0 +1,98 @@
+"""
+回覆組裝與分段
+
+LINE 文字訊息一則最多 5000 字、一個 reply token 最多 5 則訊息；超過整個請求就會失敗。
+- ReplyBuilder：handler 逐行 / 逐段加入，最後只 join 一次（取代反覆 reply += ...）；
+  段落可以是產生器，render() 時才展開
+- split_text()：把長回覆切成不超過上限的多則訊息，盡量在段落開頭（空行、─── 分隔線、【餐別】）切開
+- 前 5 則走 reply，其餘由 OrderBot 改用 push 送出（有派送佇列時進佇列）
+"""
+TEXT_LIMIT = 5000
+MAX_MESSAGES = 5
+DIVIDER = '─' * 20
+
+
+class ReplyBuilder:
+    def __init__(self):
+        self._parts = []
+
+    def line(self, text=''):
+        self._parts.append(text)
+        return self
+
+    def lines(self, lines):
+        """加入多行；可以是產生器（render 時才執行）"""
+        self._parts.append(lines)
+        return self
+
+    def divider(self):
+        return self.line(DIVIDER)
+
+    def render(self):
+        out = []
+        for part in self._parts:
+            if isinstance(part, str):
+                out.append(part)
+            else:
+                out.extend(part)
+        return '\n'.join(out)
+
+    def __str__(self):
+        return self.render()
+
+
+def _is_section_start(line):
+    return not line.strip() or line.startswith(DIVIDER) or line.startswith('【')
+
+
+def _bounded_lines(text, limit):
+    """逐行產生；單行超過上限時硬切"""
+    for line in text.split('\n'):
+        while len(line) > limit:
+            yield line[:limit]
+            line = line[limit:]
+        yield line
+
+
+def split_text(text, limit=TEXT_LIMIT):
+    """
+    切成每則不超過 limit 字的文字訊息（不會回傳空字串）
+    放不下時優先在最後一個段落開頭切；該段落本身佔了超過一半就直接在行尾切
+    """
+    if len(text) <= limit:
+        return [text] if text else []
+
+    chunks = []
+    current, size = [], 0        # size = '\n'.join(current) 的長度
+    boundary = boundary_size = 0  # current[:boundary] 是完整段落，長度 boundary_size
+
+    def emit(lines):
+        chunk = '\n'.join(lines).strip('\n')
+        if chunk.strip():
+            chunks.append(chunk)
+
+    for line in _bounded_lines(text, limit):
+        if current and size + 1 + len(line) > limit:
+            if boundary and boundary_size * 2 >= limit:
+                emit(current[:boundary])
+                current = current[boundary:]
+                size = len('\n'.join(current))
+                # 留下的段落加上這一行還是放不下，也要先送出
+                if current and size + 1 + len(line) > limit:
+                    emit(current)
+                    current, size = [], 0
+            else:
+                emit(current)
+                current, size = [], 0
+            boundary = boundary_size = 0
+        if current and _is_section_start(line):
+            boundary, boundary_size = len(current), size
+        size += len(line) + (1 if current else 0)
+        current.append(line)
+    emit(current)
+    return chunks
+
+
+def batches(messages, size=MAX_MESSAGES):
+    """每 size 則一組（一個 reply / push 請求最多 5 則）"""
+    return [messages[i:i + size] for i in range(0, len(messages), size)]
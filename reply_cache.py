@@ -0,0 +1,132 @@
+"""
+唯讀指令的回覆快取
+
+點餐時段大家一直打 !today、!統計、自己的代號（!bill），每次都重跑同樣的查詢與字串組裝。
+這裡把回覆存在 worker 記憶體裡，key = (指令, 參數, 日期, 資料版本)：
+- 資料版本是每個 worker 自己的計數器；任何寫到 WATCHED_TABLES 的交易 commit 後 +1
+  （ORM flush 與 session.execute 的 INSERT / UPDATE / DELETE 都會被 SQLAlchemy 事件抓到）
+- 別的 worker 寫入時這裡不會知道，所以每筆快取另有 ttl 秒的存活時間，過期就重算
+ttl <= 0 時完全停用。
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# 會影響 !today / !統計 / !bill 回覆內容的表
+WATCHED_TABLES = frozenset({
+    'orders', 'daily_menus', 'users', 'user_balances', 'meal_tallies', 'shops', 'menu_items',
+})
+
+_DIRTY = 'reply_cache_dirty'
+
+
+class ReplyCache:
+    def __init__(self, ttl=10.0, maxsize=512):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.version = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'invalidations': 0, 'saved_ms': 0.0}
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.maxsize > 0
+
+    # ─── 存取 ─────────────────────────────────────────────────────
+    def get_or_compute(self, key, compute):
+        """
+        key 不含版本與日期（這裡自動補上）；compute() 產生回覆
+        回覆是 None 時不快取（例如 Flex 已直接送出）
+        """
+        if not self.enabled:
+            return compute()
+        full_key = (key, date.today(), self.version)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(full_key)
+            if entry is not None:
+                reply, expires, cost_ms = entry
+                if expires > now:
+                    self._data.move_to_end(full_key)
+                    self.stats['hits'] += 1
+                    self.stats['saved_ms'] += cost_ms
+                    return reply
+                del self._data[full_key]
+                self.stats['expired'] += 1
+            self.stats['misses'] += 1
+
+        version = self.version
+        started = time.perf_counter()
+        reply = compute()
+        cost_ms = (time.perf_counter() - started) * 1000
+        # 計算期間有寫入就不存（版本已變，存了也不會再被讀到）
+        if reply is not None and version == self.version:
+            with self._lock:
+                self._data[full_key] = (reply, time.monotonic() + self.ttl, cost_ms)
+                self._data.move_to_end(full_key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        return reply
+
+    def invalidate(self):
+        """資料有異動：版本 +1，舊的 key 全部失效"""
+        with self._lock:
+            self.version += 1
+            self.stats['invalidations'] += 1
+            self._data.clear()
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self._data)
+            stats['version'] = self.version
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        stats['saved_ms'] = round(stats['saved_ms'], 1)
+        stats['ttl'] = self.ttl
+        return stats
+
+    # ─── 失效事件 ─────────────────────────────────────────────────
+    def watch(self, session_cls=Session):
+        """在 SQLAlchemy Session 上掛事件：交易裡寫過 WATCHED_TABLES，commit 後就 invalidate()"""
+        event.listen(session_cls, 'after_flush', self._after_flush)
+        event.listen(session_cls, 'do_orm_execute', self._on_execute)
+        event.listen(session_cls, 'after_commit', self._after_commit)
+        event.listen(session_cls, 'after_soft_rollback', self._after_rollback)
+        return self
+
+    def unwatch(self, session_cls=Session):
+        event.remove(session_cls, 'after_flush', self._after_flush)
+        event.remove(session_cls, 'do_orm_execute', self._on_execute)
+        event.remove(session_cls, 'after_commit', self._after_commit)
+        event.remove(session_cls, 'after_soft_rollback', self._after_rollback)
+
+    @staticmethod
+    def _after_flush(session, flush_context):
+        for obj in (*session.new, *session.dirty, *session.deleted):
+            table = getattr(obj, '__tablename__', None)
+            if table in WATCHED_TABLES:
+                session.info[_DIRTY] = True
+                return
+
+    @staticmethod
+    def _on_execute(state):
+        if not (state.is_insert or state.is_update or state.is_delete):
+            return
+        table = getattr(state.statement, 'table', None)
+        if getattr(table, 'name', None) in WATCHED_TABLES:
+            state.session.info[_DIRTY] = True
+
+    def _after_commit(self, session):
+        if session.info.pop(_DIRTY, False):
+            self.invalidate()
+
+    @staticmethod
+    def _after_rollback(session, previous_transaction):
+        if previous_transaction.parent is None:
+            session.info.pop(_DIRTY, None)
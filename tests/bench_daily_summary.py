@@ -0,0 +1,95 @@
+"""
+壓測：每日帳務提醒（500 人、10 萬筆訂單）
+舊寫法每人一次 Order 查詢並把所有未付款撈出來加總；新寫法一個查詢
+Run: python tests/bench_daily_summary.py [時間上限秒數]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+from config import Config
+from models import db, User, DailyMenu, Order
+from line_handler import OrderBot
+import ledger
+
+USERS = 500
+ORDERS = 100_000
+PAYERS = 5
+
+
+def make_app(path):
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    app.config['LINE_CHANNEL_ACCESS_TOKEN'] = 'token'
+    db.init_app(app)
+    return app
+
+
+def seed():
+    rnd = random.Random(0)
+    db.create_all()
+    db.session.add_all(User(user_code=str(i), name=f'人{i}') for i in range(1, USERS + 1))
+    start = date.today() - timedelta(days=ORDERS // 200)
+    dms = [DailyMenu(menu_date=start + timedelta(days=d), meal_type='lunch') for d in range(ORDERS // 200 + 1)]
+    db.session.add_all(dms)
+    db.session.flush()
+    rows = [{'user_id': rnd.randint(1, USERS), 'daily_menu_id': dms[i // 200].id,
+             'items': '肉羹飯', 'amount': rnd.choice((60, 80, 90)),
+             'paid': rnd.random() < 0.7, 'payer_id': rnd.randint(1, PAYERS)}
+            for i in range(ORDERS)]
+    Order.insert_many(rows)
+    db.session.commit()
+    ledger.reconcile()
+
+
+def legacy_summary():
+    """改版前：先撈有欠款的人，再每人一次查詢加總"""
+    users = (db.session.query(User).join(Order, User.id == Order.user_id)
+             .filter(Order.paid == False, User.is_admin == False).distinct()
+             .order_by(db.cast(User.user_code, db.Integer)).all())
+    reply = ''
+    for user in users:
+        total = sum(o.amount for o in Order.query.filter_by(user_id=user.id, paid=False).all())
+        if total > 0:
+            reply += f'{user.user_code}. {user.name}  未付 ${int(total)}\n'
+    return reply
+
+
+def timed(fn, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 0.5
+    with tempfile.TemporaryDirectory() as d:
+        app = make_app(os.path.join(d, 'orders.db'))
+        with app.app_context():
+            seed()
+            bot = OrderBot(app.config)
+            results = {
+                '舊寫法（N+1）': timed(legacy_summary, 1),
+                '帳本（一個查詢）': timed(lambda: bot.generate_daily_unpaid_summary(by_payer=False)),
+                '依代墊人 GROUP BY': timed(lambda: bot.generate_daily_unpaid_summary(by_payer=True)),
+            }
+    print(f'{USERS} 人、{ORDERS} 筆訂單，時間上限 {budget:.2f}s')
+    for name, seconds in results.items():
+        print(f'  {name:<16} {seconds * 1000:8.1f} ms')
+    over = [name for name, seconds in list(results.items())[1:] if seconds > budget]
+    if over:
+        print(f'❌ 超過時間上限：{"、".join(over)}')
+        sys.exit(1)
+    print('✅ 皆在時間上限內')
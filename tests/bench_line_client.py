@@ -0,0 +1,47 @@
+"""
+壓測：每次回覆都新建 ApiClient vs 共用 LineClient 連線池
+Run: python tests/bench_line_client.py [次數]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from linebot.v3.messaging import (
+    Configuration, ApiClient, MessagingApi, ReplyMessageRequest, TextMessage,
+)
+from fake_line_server import FakeLineServer
+from line_client import LineClient
+
+
+def _request():
+    return ReplyMessageRequest(reply_token='token', messages=[TextMessage(text='✅ 已記錄 1 筆訂單')])
+
+
+def bench_per_call(url, n):
+    configuration = Configuration(access_token='token', host=url)
+    start = time.perf_counter()
+    for _ in range(n):
+        with ApiClient(configuration) as api:
+            MessagingApi(api).reply_message(_request())
+    return n / (time.perf_counter() - start)
+
+
+def bench_shared(url, n):
+    client = LineClient('token', host=url)
+    start = time.perf_counter()
+    for _ in range(n):
+        client.reply_message(_request())
+    return n / (time.perf_counter() - start), client.stats()
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    with FakeLineServer() as server:
+        before = bench_per_call(server.url, n)
+        after, stats = bench_shared(server.url, n)
+    print(f'每次新建 ApiClient：{before:8.1f} replies/s')
+    print(f'共用 LineClient   ：{after:8.1f} replies/s  ({after / before:.1f}x)')
+    print(f'連線統計：{stats}')
@@ -0,0 +1,82 @@
+"""
+壓測：!點 寫入速度（逐筆 ORM add vs 一次 executemany）
+Run: python tests/bench_order_insert.py [重複次數]
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+from config import Config
+from models import db, User, Shop, MenuItem, DailyMenu, Order
+from line_handler import OrderBot
+
+SIZES = (10, 50, 100, 500)
+
+
+def make_app(path):
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    app.config['LINE_CHANNEL_ACCESS_TOKEN'] = 'token'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add_all(User(user_code=str(i), name=f'人{i}') for i in range(1, 501))
+        shop = Shop(name='麗媽')
+        db.session.add(shop)
+        db.session.flush()
+        for name, price in [('肉羹飯', 60), ('沙茶牛肉炒麵', 80), ('雞腿飯', 90)]:
+            db.session.add(MenuItem(shop_id=shop.id, name=name, price=price))
+        db.session.commit()
+    return app
+
+
+def per_row_orm(n):
+    """舊寫法：DailyMenu 先 commit，每筆訂單一個 ORM 物件"""
+    dm = DailyMenu.query.filter_by(menu_date=date.today(), meal_type='lunch').first()
+    if not dm:
+        dm = DailyMenu(meal_type='lunch')
+        db.session.add(dm)
+        db.session.commit()
+    for i in range(1, n + 1):
+        db.session.add(Order(user_id=i, daily_menu_id=dm.id, items='肉羹飯', amount=60, payer_id=1))
+    db.session.commit()
+
+
+def bulk(n):
+    """新寫法：DailyMenu upsert + 一次 executemany，同一個交易"""
+    dm = DailyMenu.get_or_create(date.today(), 'lunch')
+    Order.insert_many([{'user_id': i, 'daily_menu_id': dm.id, 'items': '肉羹飯', 'amount': 60, 'payer_id': 1}
+                       for i in range(1, n + 1)])
+    db.session.commit()
+
+
+def bench(fn, n, repeat):
+    Order.query.delete()
+    db.session.commit()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(n)
+    return n * repeat / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with tempfile.TemporaryDirectory() as d:
+        app = make_app(os.path.join(d, 'orders.db'))
+        with app.app_context():
+            bot = OrderBot(app.config)
+            bot_path = lambda n: bot.handle_order_command(
+                '!點 午餐 麗媽 1\n' + '\n'.join(f'{i}. 肉羹飯' for i in range(1, n + 1)), 'token')
+            print(f'{"行數":>6} {"逐筆 ORM":>10} {"executemany":>12} {"!點 整段":>10}   (rows/s)')
+            for n in SIZES:
+                before = bench(per_row_orm, n, repeat)
+                after = bench(bulk, n, repeat)
+                full = bench(bot_path, n, repeat)
+                print(f'{n:>6} {before:>10.0f} {after:>12.0f} {full:>10.0f}   ({after / before:.1f}x)')
@@ -0,0 +1,104 @@
+"""
+壓測：300 筆訂單的一天，!today 回覆組裝 + 分段
+舊寫法 reply += 逐行串接、整份塞進一則 TextMessage（超過 5000 字 LINE 會拒絕）；
+新寫法 ReplyBuilder 組裝後 split_text 切成多則
+Run: python tests/bench_reply_split.py [時間上限秒數]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+from config import Config
+from models import db, User, DailyMenu, Order
+from line_handler import OrderBot
+from reply_builder import TEXT_LIMIT, MAX_MESSAGES, split_text
+import ledger
+
+USERS = 120
+ORDERS = 300
+ITEMS = ('肉羹飯', '雞腿飯（不要辣、飯少）', '沙茶牛肉炒麵 加蛋', '排骨便當（換白飯）', '鍋燒意麵')
+
+
+def make_app(path):
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    app.config['LINE_CHANNEL_ACCESS_TOKEN'] = 'token'
+    db.init_app(app)
+    return app
+
+
+def seed():
+    rnd = random.Random(0)
+    db.create_all()
+    db.session.add_all(User(user_code=str(i), name=f'同事{i}號') for i in range(1, USERS + 1))
+    dms = [DailyMenu(menu_date=date.today(), meal_type=mt) for mt in ('breakfast', 'lunch', 'dinner')]
+    db.session.add_all(dms)
+    db.session.flush()
+    rows = [{'user_id': rnd.randint(1, USERS), 'daily_menu_id': rnd.choice(dms).id,
+             'items': rnd.choice(ITEMS), 'amount': rnd.choice((60, 80, 90)),
+             'paid': rnd.random() < 0.3}
+            for _ in range(ORDERS)]
+    ledger.orders_added(rows)
+    Order.insert_many(rows)
+    db.session.commit()
+
+
+def legacy_today():
+    """改版前：逐行 reply += 串接"""
+    reply = f'📋 今日訂單 ({date.today().strftime("%m/%d")})\n\n'
+    for mt in ('breakfast', 'lunch', 'dinner'):
+        orders = (Order.query.join(DailyMenu)
+                  .filter(DailyMenu.menu_date == date.today(), DailyMenu.meal_type == mt).all())
+        reply += f'【{Config.MEAL_TYPES.get(mt, mt)}】{len(orders)} 筆\n'
+        for o in orders:
+            reply += f'{"✅" if o.paid else "⏳"} {o.user.user_code}. {o.user.name} - {o.items} (${int(o.amount)})\n'
+        reply += '\n'
+    return [reply]
+
+
+def timed(fn, repeat=5):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 0.2
+    with tempfile.TemporaryDirectory() as d:
+        app = make_app(os.path.join(d, 'orders.db'))
+        with app.app_context():
+            seed()
+            bot = OrderBot(app.config)
+            results = {
+                '舊寫法（+= 一則）': timed(legacy_today),
+                'ReplyBuilder + 分段': timed(lambda: split_text(bot.handle_today_summary())),
+            }
+    print(f'{ORDERS} 筆訂單，時間上限 {budget:.2f}s')
+    failed = []
+    for name, (seconds, messages) in results.items():
+        longest = max(len(m) for m in messages)
+        print(f'  {name:<18} {seconds * 1000:7.1f} ms  {len(messages)} 則，最長 {longest} 字')
+    seconds, messages = results['ReplyBuilder + 分段']
+    if seconds > budget:
+        failed.append('超過時間上限')
+    if any(len(m) > TEXT_LIMIT for m in messages):
+        failed.append(f'有訊息超過 {TEXT_LIMIT} 字')
+    if len(messages) > MAX_MESSAGES:
+        print(f'  （前 {MAX_MESSAGES} 則 reply，其餘 {len(messages) - MAX_MESSAGES} 則改推播）')
+    if failed:
+        print('❌ ' + '、'.join(failed))
+        sys.exit(1)
+    print('✅ 每則都在 LINE 字數上限內')
@@ -0,0 +1,113 @@
+"""
+壓測：SQLite 連線 PRAGMA（預設 rollback journal vs Config.SQLITE_PRAGMAS）
+模擬午餐時段：幾個行程不停寫訂單（像不同 gunicorn worker），另外幾個一直讀固定範圍的訂單
+比較讀 / 寫吞吐量與 database is locked 次數
+Run: python tests/bench_sqlite_pragmas.py [秒數]
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, func, insert, select
+from sqlalchemy.exc import OperationalError
+
+from config import Config
+from models import db, User, DailyMenu, Order, apply_sqlite_pragmas
+
+WRITERS = 4
+READERS = 4
+BATCH = 5          # 每個寫入交易幾筆訂單（一則 !點 訊息）
+BASELINE = {'busy_timeout': 5000}   # 只保留等待鎖的時間，其餘用 SQLite 預設值
+
+
+def make_engine(path, pragmas):
+    engine = create_engine(f'sqlite:///{path}')
+    apply_sqlite_pragmas(engine, pragmas)
+    return engine
+
+
+def setup(path, pragmas):
+    engine = make_engine(path, pragmas)
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{'user_code': str(i), 'name': f'人{i}'} for i in range(1, 51)])
+        conn.execute(insert(DailyMenu), [{'menu_date': date.today(), 'meal_type': 'lunch'}])
+        conn.execute(insert(Order), [{'user_id': i % 50 + 1, 'daily_menu_id': 1, 'items': '肉羹飯',
+                                      'amount': 60, 'paid': False} for i in range(200)])
+    engine.dispose()
+
+
+def writer(path, pragmas, seconds, n, out):
+    engine = make_engine(path, pragmas)
+    rows = [{'user_id': (n * BATCH + i) % 50 + 1, 'daily_menu_id': 1, 'items': '肉羹飯',
+             'amount': 60, 'paid': False, 'created_date': datetime.utcnow()} for i in range(BATCH)]
+    done = locked = 0
+    stop = time.monotonic() + seconds
+    while time.monotonic() < stop:
+        try:
+            with engine.begin() as conn:
+                conn.execute(insert(Order), rows)
+            done += 1
+        except OperationalError:
+            locked += 1
+    out.put(('writes', done, locked))
+
+
+def reader(path, pragmas, seconds, out):
+    engine = make_engine(path, pragmas)
+    # 固定讀前 200 筆（rowid 範圍），成本不隨寫入量增加
+    q = (select(Order.items, func.count(Order.id), func.sum(Order.amount))
+         .where(Order.id <= 200)
+         .group_by(Order.items))
+    done = locked = 0
+    stop = time.monotonic() + seconds
+    while time.monotonic() < stop:
+        try:
+            with engine.connect() as conn:
+                conn.execute(q).all()
+            done += 1
+        except OperationalError:
+            locked += 1
+    out.put(('reads', done, locked))
+
+
+def run(path, pragmas, seconds):
+    out = multiprocessing.Queue()
+    procs = ([multiprocessing.Process(target=writer, args=(path, pragmas, seconds, n, out))
+              for n in range(WRITERS)] +
+             [multiprocessing.Process(target=reader, args=(path, pragmas, seconds, out))
+              for _ in range(READERS)])
+    for p in procs:
+        p.start()
+    counts = {'writes': 0, 'reads': 0, 'locked': 0}
+    for _ in procs:
+        kind, done, locked = out.get()
+        counts[kind] += done
+        counts['locked'] += locked
+    for p in procs:
+        p.join()
+    return counts
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    results = {}
+    for name, pragmas in (('預設（rollback journal）', BASELINE), ('Config.SQLITE_PRAGMAS', Config.SQLITE_PRAGMAS)):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'orders.db')
+            setup(path, pragmas)
+            results[name] = run(path, pragmas, seconds)
+    print(f'{WRITERS} 個寫入行程 + {READERS} 個讀取行程，各跑 {seconds:.0f}s（每筆寫入 = {BATCH} 筆訂單一個交易）')
+    for name, c in results.items():
+        print(f'  {name:<24} 寫 {c["writes"] / seconds:8.0f} 次/s  讀 {c["reads"] / seconds:8.0f} 次/s'
+              f'  locked {c["locked"]}')
+    base, tuned = results.values()
+    if tuned['locked'] > base['locked'] or tuned['reads'] + tuned['writes'] < base['reads'] + base['writes']:
+        print('❌ 調整後沒有比較好')
+        sys.exit(1)
+    print('✅ 調整後吞吐量較高')
@@ -0,0 +1,141 @@
+"""
+共用 fixture：用暫存 SQLite 檔建立最小的 Flask app（不載入 app.py，避免啟動排程與 LINE 設定）
+需要打後台路由的測試改用 web：載入 app.py 本身，但指向暫存 DB、不啟動排程
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from flask import Flask
+
+from config import Config
+from models import db, apply_sqlite_pragmas
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{tmp_path / "orders.db"}'
+    app.config['LINE_CHANNEL_ACCESS_TOKEN'] = 'token'
+    db.init_app(app)
+    with app.app_context():
+        apply_sqlite_pragmas(db.engine, app.config['SQLITE_PRAGMAS'])
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def bot(app):
+    from line_handler import OrderBot
+    return OrderBot(app.config)
+
+
+@pytest.fixture
+def seed(app):
+    """10 位使用者、一家店（麗媽）與三個品項"""
+    from models import User, Shop, MenuItem
+    for i in range(1, 11):
+        db.session.add(User(user_code=str(i), name=f'人{i}'))
+    shop = Shop(name='麗媽', phone='02-1234')
+    db.session.add(shop)
+    db.session.flush()
+    for name, price in [('肉羹飯', 60), ('沙茶牛肉炒麵', 80), ('雞腿飯', 90)]:
+        db.session.add(MenuItem(shop_id=shop.id, name=name, price=price))
+    db.session.commit()
+    return shop
+
+
+@pytest.fixture(scope='session')
+def web_app(tmp_path_factory):
+    """整個測試階段只 import 一次 app.py（模組層會建表、跑 migration 與對帳）"""
+    d = tmp_path_factory.mktemp('web')
+    overrides = {
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{d / "orders.db"}',
+        'QUEUE_DB_PATH': str(d / 'queue.db'),
+        'UPLOAD_FOLDER': str(d / 'uploads'),
+        'LINE_CHANNEL_SECRET': 'secret',
+        'LINE_CHANNEL_ACCESS_TOKEN': 'token',
+        'OUTBOUND_QUEUE': False,
+        'WEBHOOK_ASYNC': False,
+        'DEBUG': True,            # app.debug 且不是 reloader 子行程 → 不啟動排程
+    }
+    saved = {k: getattr(Config, k, None) for k in overrides}
+    for k, v in overrides.items():
+        setattr(Config, k, v)
+    try:
+        import app as web
+    finally:
+        for k, v in saved.items():
+            setattr(Config, k, v)
+    web.app.config.update(DEBUG=False, TESTING=True)
+    # app.py 的 reply_cache 掛在全域 Session 上，只在 web 測試期間掛著，免得搶走其他測試快取的失效通知
+    web.reply_cache.unwatch()
+    return web
+
+
+@pytest.fixture
+def web(web_app):
+    """app.py 的 test client；每個測試前清空資料表與回覆快取"""
+    with web_app.app.app_context():
+        db.drop_all()
+        db.create_all()
+        # 新的菜單版本，讓 app.py 留著的快照 / 比對快取不會沿用上一個測試的資料
+        web_app.bump_catalog_version()
+        db.session.commit()
+        web_app.reply_cache.invalidate()
+        web_app.reply_cache.watch()
+        try:
+            yield web_app
+        finally:
+            web_app.reply_cache.unwatch()
+            db.session.remove()
+
+
+@pytest.fixture
+def client_for(web):
+    """回傳一個以指定使用者登入的 test client"""
+    def make(user):
+        client = web.app.test_client()
+        with client.session_transaction() as s:
+            s['user_id'] = user.id
+        return client
+    return make
+
+
+class QueryCounter:
+    """計算 with 區塊內送出的 SQL（statements 可用來檢查查了哪些表）"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+        self.parameters = []      # 與 statements 同順序（executemany 時是多組參數）
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+        self.parameters.append(parameters)
+
+    def __enter__(self):
+        from sqlalchemy import event
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc):
+        from sqlalchemy import event
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def matching(self, fragment):
+        return [s for s in self.statements if fragment in s]
+
+
+@pytest.fixture
+def count_queries(app):
+    return lambda: QueryCounter(db.engine)
@@ -0,0 +1,77 @@
+"""
+本機假 LINE Messaging API 伺服器（測試 / 壓測用）
+
+記錄每個請求的路徑與 JSON body；可用 responses 排定接下來要回的狀態碼（例如先 429 再 200）。
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        server = self.server
+        with server.lock:
+            server.requests.append({
+                'path': self.path,
+                'body': json.loads(raw) if raw else None,
+                'retry_key': self.headers.get('X-Line-Retry-Key'),
+            })
+            status = server.responses.pop(0) if server.responses else 200
+        if status != 200:
+            payload = json.dumps({'message': f'status {status}'}).encode()
+        elif self.path.endswith(('/reply', '/push')):
+            payload = json.dumps({'sentMessages': [{'id': str(len(server.requests))}]}).encode()
+        else:
+            payload = b'{}'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeLineServer:
+    def __init__(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.lock = threading.Lock()
+        self.httpd.requests = []
+        self.httpd.responses = []
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f'http://{host}:{port}'
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    def queue_responses(self, *statuses):
+        with self.httpd.lock:
+            self.httpd.responses.extend(statuses)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
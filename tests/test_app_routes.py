@@ -0,0 +1,420 @@
+"""
+Tests for app.py 後台路由（載入 app.py 本身，foreign_keys=ON）
+Run: pytest tests/ -v
+"""
+import base64
+import hashlib
+import hmac
+import json
+import time
+from datetime import date
+
+from models import db, DailyMenu, MealTally, MenuItem, Order, ProcessedEvent, Shop, User, UserBalance
+from durable_queue import DurableQueue
+from menu_catalog import get_catalog
+from webhook_intake import WebhookIntake
+import ledger
+
+
+def _add_user(code, role='user', **kw):
+    u = User(user_code=code, name=f'人{code}', role=role, username=f'u{code}',
+             is_admin=role != 'user', **kw)
+    db.session.add(u)
+    db.session.commit()
+    return u
+
+
+def _add_orders(user, *items, menu_date=None, paid=False):
+    menu_date = menu_date or date.today()
+    dm = DailyMenu.query.filter_by(menu_date=menu_date, meal_type='lunch').first()
+    if dm is None:
+        dm = DailyMenu(menu_date=menu_date, meal_type='lunch')
+        db.session.add(dm)
+        db.session.flush()
+    rows = [{'user_id': user.id, 'daily_menu_id': dm.id, 'items': name, 'amount': amount, 'paid': paid}
+            for name, amount in items]
+    ids = Order.insert_many(rows)
+    ledger.orders_added(rows)
+    db.session.commit()
+    return ids
+
+
+class TestDeleteUser:
+    def test_foreign_keys_enabled(self, web):
+        assert db.session.execute(db.text('PRAGMA foreign_keys')).scalar() == 1
+
+    def test_provider_deletes_admin_with_ledger_row(self, web, client_for):
+        provider = _add_user('p', role='provider')
+        admin = _add_user('adm1', role='admin')
+        _add_orders(admin, ('肉羹飯', 60))
+        ledger.settle(user_id=admin.id)          # 結清後帳本仍留著 0 元的那一列
+        db.session.commit()
+        assert UserBalance.query.filter_by(user_id=admin.id).count() == 1
+
+        resp = client_for(provider).post(f'/provider/delete-admin/{admin.id}')
+        assert resp.status_code == 302
+        db.session.expire_all()
+        assert db.session.get(User, admin.id) is None
+        assert UserBalance.query.count() == 0
+        assert MealTally.query.count() == 0
+        assert Order.query.count() == 0
+
+    def test_admin_deletes_user_with_unpaid_orders(self, web, client_for):
+        admin = _add_user('adm1', role='admin')
+        user = _add_user('2')
+        _add_orders(user, ('肉羹飯', 60), ('雞腿飯', 90))
+        resp = client_for(admin).post(f'/users/delete/{user.id}')
+        assert resp.status_code == 302
+        db.session.expire_all()
+        assert db.session.get(User, user.id) is None
+        assert (UserBalance.query.count(), MealTally.query.count()) == (0, 0)
+        assert ledger.reconcile(repair=False) == []
+
+
+class TestPortalHistory:
+    RANGE = {'start': '2026-03-01', 'end': '2026-03-31'}
+
+    def _setup(self, client_for):
+        user = _add_user('2')
+        other = _add_user('3')
+        _add_orders(user, ('肉羹飯', 60), ('雞腿飯', 90), ('肉羹飯', 60), menu_date=date(2026, 3, 10))
+        _add_orders(user, ('沙茶牛肉炒麵', 80), ('雞腿飯', 90), menu_date=date(2026, 3, 9), paid=True)
+        _add_orders(other, ('雞腿飯', 90), menu_date=date(2026, 3, 10))
+        _add_orders(user, ('雞腿飯', 90), menu_date=date(2026, 4, 1))      # 區間外
+        return client_for(user)
+
+    def _get(self, client, **args):
+        return client.get('/user-portal/history', query_string={**self.RANGE, **args})
+
+    def test_cursor_pages_cover_range_once(self, web, client_for):
+        client = self._setup(client_for)
+        seen, cursor, pages = [], None, 0
+        while True:
+            data = self._get(client, limit=2, **({'cursor': cursor} if cursor else {})).get_json()
+            seen += [(o['date'], o['items']) for o in data['orders']]
+            pages += 1
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        # 第 2 頁跨過 3/10 → 3/9 的日期邊界，不重複也不漏
+        assert pages == 3
+        assert seen == [('2026/03/10', '肉羹飯'), ('2026/03/10', '雞腿飯'), ('2026/03/10', '肉羹飯'),
+                        ('2026/03/09', '雞腿飯'), ('2026/03/09', '沙茶牛肉炒麵')]
+
+    def test_last_page_has_no_cursor(self, web, client_for):
+        data = self._get(self._setup(client_for), limit=5).get_json()
+        assert len(data['orders']) == 5
+        assert data['next_cursor'] is None
+
+    def test_limit_is_clamped(self, web, client_for):
+        client = self._setup(client_for)
+        assert len(self._get(client, limit=0).get_json()['orders']) == 1
+        assert len(self._get(client, limit=-5).get_json()['orders']) == 1
+        user = User.query.filter_by(user_code='2').one()
+        _add_orders(user, *[('肉羹飯', 60)] * 200, menu_date=date(2026, 3, 1))
+        data = self._get(client, limit=10_000).get_json()
+        assert len(data['orders']) == 200
+        assert data['next_cursor'] is not None
+
+    def test_malformed_cursor(self, web, client_for):
+        client = self._setup(client_for)
+        for cursor in ('abc', '2026-03-10', '2026-03-10:x', '2026/03/10:5', '2026-03-10:5:1'):
+            assert self._get(client, cursor=cursor).status_code == 400
+
+    def test_totals_only_on_first_page(self, web, client_for):
+        client = self._setup(client_for)
+        first = self._get(client, limit=2).get_json()
+        assert (first['count'], first['total'], first['paid'], first['unpaid']) == (5, 380, 170, 210)
+        second = self._get(client, limit=2, cursor=first['next_cursor']).get_json()
+        assert 'count' not in second and 'total' not in second
+
+    def test_etag_not_modified(self, web, client_for):
+        client = self._setup(client_for)
+        first = self._get(client)
+        etag = first.headers['ETag']
+        again = client.get('/user-portal/history', query_string=self.RANGE,
+                           headers={'If-None-Match': etag})
+        assert again.status_code == 304 and again.data == b''
+        # 內容變了就換 ETag
+        o = Order.query.filter_by(items='沙茶牛肉炒麵').one()
+        o.amount = 85
+        db.session.commit()
+        changed = client.get('/user-portal/history', query_string=self.RANGE,
+                             headers={'If-None-Match': etag})
+        assert changed.status_code == 200 and changed.headers['ETag'] != etag
+
+
+class TestHistoryCalendar:
+    def test_month_order_dates(self, web):
+        user = _add_user('2')
+        _add_orders(user, ('肉羹飯', 60), menu_date=date(2026, 3, 9))
+        _add_orders(user, ('雞腿飯', 90), menu_date=date(2026, 3, 31))
+        _add_orders(user, ('雞腿飯', 90), menu_date=date(2026, 4, 1))
+        db.session.add(DailyMenu(menu_date=date(2026, 3, 20), meal_type='lunch'))   # 沒人點
+        db.session.commit()
+        assert web.month_order_dates(2026, 3) == {'2026-03-09', '2026-03-31'}
+        assert web.month_order_dates(2026, 2) == frozenset()
+
+    def test_latest_skips_menu_without_orders(self, web):
+        user = _add_user('2')
+        _add_orders(user, ('肉羹飯', 60), menu_date=date(2026, 3, 9))
+        db.session.add(DailyMenu(menu_date=date(2026, 3, 20), meal_type='lunch'))
+        db.session.commit()
+        assert web.latest_order_date() == date(2026, 3, 9)
+
+    def test_recomputed_after_order_writes(self, web):
+        user = _add_user('2')
+        _add_orders(user, ('肉羹飯', 60), menu_date=date(2026, 3, 9))
+        assert web.latest_order_date() == date(2026, 3, 9)
+        assert web.month_order_dates(2026, 3) == {'2026-03-09'}
+
+        version = web.reply_cache.version
+        (new_id,) = _add_orders(user, ('雞腿飯', 90), menu_date=date(2026, 3, 12))
+        assert web.reply_cache.version > version
+        assert web.latest_order_date() == date(2026, 3, 12)
+        assert web.month_order_dates(2026, 3) == {'2026-03-09', '2026-03-12'}
+
+        version = web.reply_cache.version
+        o = db.session.get(Order, new_id)
+        ledger.order_removed(o)
+        db.session.delete(o)
+        db.session.commit()
+        assert web.reply_cache.version > version
+        assert web.latest_order_date() == date(2026, 3, 9)
+        assert web.month_order_dates(2026, 3) == {'2026-03-09'}
+
+
+class TestWebhookReplay:
+    @staticmethod
+    def _payload(text, event_id, redelivery=False):
+        body = json.dumps({'destination': 'U0', 'events': [{
+            'type': 'message', 'mode': 'active', 'timestamp': int(time.time() * 1000),
+            'webhookEventId': event_id, 'deliveryContext': {'isRedelivery': redelivery},
+            'source': {'type': 'group', 'groupId': 'C1', 'userId': 'U1'},
+            'replyToken': 'r' + event_id,
+            'message': {'type': 'text', 'id': '1', 'quoteToken': 'q', 'text': text},
+        }]}, ensure_ascii=False)
+        signature = base64.b64encode(hmac.new(b'secret', body.encode(), hashlib.sha256).digest()).decode()
+        return {'body': body, 'signature': signature, 'host_url': 'http://test/'}
+
+    def _setup(self, web, monkeypatch, tmp_path, **queue_kw):
+        for code in ('1', '2'):
+            _add_user(code)
+        shop = Shop(name='麗媽')
+        db.session.add(shop)
+        db.session.flush()
+        db.session.add(MenuItem(shop_id=shop.id, name='肉羹飯', price=60))
+        web.bump_catalog_version()
+        db.session.commit()
+        replies = []
+        monkeypatch.setattr(web.order_bot, 'send_reply', lambda token, text, push_to=None: replies.append(text))
+        queue = DurableQueue(str(tmp_path / 'queue.db'), 'webhook', **queue_kw)
+        return WebhookIntake(queue, web._process_webhook), replies
+
+    def test_expired_lease_replay_does_not_duplicate(self, web, monkeypatch, tmp_path):
+        intake, replies = self._setup(web, monkeypatch, tmp_path, lease_seconds=0)
+        intake.submit(**self._payload('!點 麗媽 1\n2. 肉羹飯', 'EV1'))
+        # 第一個 worker 寫完訂單後、ack 前就掛了
+        first = intake.queue.claim()
+        web._process_webhook(first['payload'])
+        assert Order.query.count() == 1
+        time.sleep(0.01)
+        replay = intake.queue.claim()
+        assert replay['id'] == first['id'] and replay['attempts'] == 2
+        intake.run_job(replay)
+        db.session.expire_all()
+        assert Order.query.count() == 1
+        assert ledger.balance(User.query.filter_by(user_code='2').one().id) == (60, 1)
+        assert intake.queue.depth() == 0 and intake.failed == 0
+        assert len(replies) == 1
+
+    def test_line_redelivery_is_skipped(self, web, monkeypatch, tmp_path):
+        intake, replies = self._setup(web, monkeypatch, tmp_path)
+        intake.submit(**self._payload('!點 麗媽 1\n2. 肉羹飯', 'EV2'))
+        intake.submit(**self._payload('!點 麗媽 1\n2. 肉羹飯', 'EV2', redelivery=True))
+        intake.submit(**self._payload('!點 麗媽 1\n2. 肉羹飯', 'EV3'))
+        while (job := intake.queue.claim()):
+            intake.run_job(job)
+        db.session.expire_all()
+        assert Order.query.count() == 2
+        assert {e.event_id for e in ProcessedEvent.query} == {'EV2', 'EV3'}
+        assert intake.processed == 3 and intake.failed == 0
+
+    def test_concurrent_replay_rolls_back(self, web, monkeypatch, tmp_path):
+        """另一個 worker 在本次檢查之後才寫入同一個事件：整筆交易 rollback，不留重複訂單"""
+        intake, replies = self._setup(web, monkeypatch, tmp_path)
+        payload = self._payload('!點 麗媽 1\n2. 肉羹飯', 'EV4')
+        web._process_webhook(payload)
+        monkeypatch.setattr(db.session, 'get', lambda *a, **kw: None)   # 跳過事前檢查
+        web._process_webhook(payload)
+        db.session.expire_all()
+        assert Order.query.count() == 1
+        assert len(replies) == 1
+
+
+class TestAliasRoutes:
+    def _setup(self, web):
+        from models import MenuAlias
+        admin = _add_user('adm1', role='admin')
+        user = _add_user('2')
+        shop = Shop(name='麗媽')
+        db.session.add(shop)
+        db.session.flush()
+        rice = MenuItem(shop_id=shop.id, name='肉羹飯', price=60)
+        leg = MenuItem(shop_id=shop.id, name='雞腿飯', price=90)
+        db.session.add_all([rice, leg])
+        db.session.flush()
+        # 模糊比對猜錯：「雞腿」被記成肉羹飯
+        web.order_bot.aliases.remember(shop.id, [('雞腿', rice.id)])
+        (oid,) = _add_orders(user, ('肉羹飯', 60))
+        o = db.session.get(Order, oid)
+        o.menu_item_id, o.raw_item = rice.id, '雞腿'
+        web.bump_catalog_version()
+        db.session.commit()
+        return admin, user, shop, rice, leg, o, MenuAlias
+
+    def test_item_correction_rewrites_and_confirms_alias(self, web, client_for):
+        admin, user, shop, rice, leg, o, MenuAlias = self._setup(web)
+        resp = client_for(admin).post(f'/orders/{o.id}/item', data={'menu_item_id': leg.id})
+        assert resp.status_code == 302
+        db.session.expire_all()
+        o = db.session.get(Order, o.id)
+        assert (o.items, o.amount, o.menu_item_id) == ('雞腿飯', 90, leg.id)
+        assert ledger.balance(user.id) == (90, 1)
+        alias = MenuAlias.query.one()
+        assert (alias.menu_item_id, alias.confirmed, alias.hits) == (leg.id, True, 0)
+        # 修正後直接採用，不再提醒
+        found = web.order_bot.aliases.resolve(shop.id, ['雞腿'], get_catalog())
+        assert found['雞腿'][0].id == leg.id and found['雞腿'][1] is True
+
+    def test_item_correction_unknown_item(self, web, client_for):
+        admin, user, shop, rice, leg, o, MenuAlias = self._setup(web)
+        client_for(admin).post(f'/orders/{o.id}/item', data={'menu_item_id': 9999})
+        db.session.expire_all()
+        assert db.session.get(Order, o.id).menu_item_id == rice.id
+        assert MenuAlias.query.one().menu_item_id == rice.id
+
+    def test_alias_page_confirm_and_delete(self, web, client_for):
+        admin, user, shop, rice, leg, o, MenuAlias = self._setup(web)
+        client = client_for(admin)
+        page = client.get('/aliases')
+        assert page.status_code == 200 and '待確認' in page.get_data(as_text=True)
+        alias = MenuAlias.query.one()
+        client.post(f'/aliases/confirm/{alias.id}')
+        db.session.expire_all()
+        assert MenuAlias.query.one().confirmed is True
+        client.post(f'/aliases/delete/{alias.id}')
+        assert MenuAlias.query.count() == 0
+
+    def test_prune(self, web, client_for):
+        from datetime import datetime, timedelta
+        admin, user, shop, rice, leg, o, MenuAlias = self._setup(web)
+        web.order_bot.aliases.remember(shop.id, [('肉羹', rice.id)])
+        MenuAlias.query.filter_by(normalized_input='雞腿').update(
+            {'last_used': datetime.utcnow() - timedelta(days=60)})
+        db.session.commit()
+        client_for(admin).post('/aliases/prune', data={'max_hits': 0, 'idle_days': 30})
+        db.session.expire_all()
+        assert [a.normalized_input for a in MenuAlias.query] == ['肉羹']
+
+
+def _flashes(client):
+    with client.session_transaction() as s:
+        return [msg for _, msg in s.pop('_flashes', [])]
+
+
+class TestSettleOrders:
+    def _setup(self, client_for):
+        admin = _add_user('adm1', role='admin')
+        a, b = _add_user('2'), _add_user('3')
+        _add_orders(a, ('肉羹飯', 60), ('雞腿飯', 90), menu_date=date(2026, 3, 10))
+        _add_orders(b, ('雞腿飯', 90), menu_date=date(2026, 3, 10))
+        _add_orders(a, ('肉羹飯', 60), menu_date=date(2026, 3, 11))
+        return client_for(admin), a, b
+
+    def _unpaid(self, user):
+        db.session.expire_all()
+        return sorted((o.daily_menu.menu_date.day, o.amount)
+                      for o in Order.query.filter_by(user_id=user.id, paid=False))
+
+    def test_filter_by_user_and_date(self, web, client_for):
+        client, a, b = self._setup(client_for)
+        resp = client.post('/orders/settle', data={'date': '2026-03-10', 'user_id': a.id})
+        assert resp.status_code == 302
+        assert _flashes(client) == ['✅ 已結清 2 筆，共 $150']
+        assert self._unpaid(a) == [(11, 60)]
+        assert self._unpaid(b) == [(10, 90)]
+        assert ledger.balance(a.id) == (60, 1)
+        assert ledger.balance(b.id) == (90, 1)
+
+    def test_whole_day(self, web, client_for):
+        client, a, b = self._setup(client_for)
+        client.post('/orders/settle', data={'date': '2026-03-10'})
+        assert _flashes(client) == ['✅ 已結清 3 筆，共 $240']
+        assert (ledger.balance(a.id), ledger.balance(b.id)) == ((60, 1), (0, 0))
+        assert ledger.reconcile(repair=False) == []
+
+    def test_nothing_to_settle(self, web, client_for):
+        client, a, b = self._setup(client_for)
+        client.post('/orders/settle', data={'date': '2026-03-12'})
+        assert _flashes(client) == ['✅ 已結清 0 筆，共 $0']
+        client.post('/orders/settle', data={'date': 'bad'})
+        assert _flashes(client) == ['❌ 日期格式錯誤']
+        assert ledger.balance(a.id) == (210, 3)
+
+
+class TestQueryCounter:
+    def _setup(self, n):
+        admin = _add_user('adm1', role='admin')
+        payer = _add_user('1')
+        shop = Shop(name='麗媽')
+        db.session.add(shop)
+        db.session.flush()
+        db.session.add(MenuItem(shop_id=shop.id, name='肉羹飯', price=60))
+        db.session.add(DailyMenu(menu_date=date.today(), meal_type='lunch', shop_id=shop.id))
+        for i in range(n):
+            _add_orders(_add_user(str(10 + i)), ('肉羹飯', 60))
+        Order.query.update({'payer_id': payer.id})
+        db.session.commit()
+        return admin
+
+    def _count(self, client):
+        db.session.remove()      # 請求用乾淨的 session，不吃測試這邊的 identity map
+        return client.get('/accounting').headers.get('X-SQL-Queries')
+
+    def test_header_is_per_request_and_constant(self, web, client_for, monkeypatch):
+        monkeypatch.setitem(web.app.config, 'SQL_QUERY_COUNTER', True)
+        client = client_for(self._setup(3))
+        # 目前使用者、訂單（JOIN users / daily_menus）、店家與代墊人各一個 IN、當天菜單
+        assert self._count(client) == '5'
+        assert self._count(client) == '5'          # 每個請求重新計數，不累加
+        for i in range(20):
+            _add_orders(_add_user(str(100 + i)), ('肉羹飯', 60))
+        assert self._count(client) == '5'          # 訂單變多查詢數不變（沒有 N+1）
+
+    def test_no_header_when_disabled(self, web, client_for):
+        client = client_for(self._setup(1))
+        assert 'X-SQL-Queries' not in client.get('/accounting').headers
+
+
+class TestDashboardKpi:
+    def test_aggregates(self, web, client_for):
+        from datetime import timedelta
+        admin = _add_user('adm1', role='admin')
+        a, b = _add_user('2'), _add_user('3')
+        _add_orders(a, ('肉羹飯', 60), ('雞腿飯', 90))
+        _add_orders(b, ('沙茶牛肉炒麵', 80), paid=True)
+        _add_orders(b, ('雞腿飯', 90), menu_date=date.today() - timedelta(days=1))   # 只算進累計未收
+        client = client_for(admin)
+        assert client.get('/dashboard/kpi').get_json() == {
+            'count': 3, 'total': 230, 'paid': 80, 'unpaid': 150, 'unpaid_all': 240}
+
+        # 結清後下一次輪詢就是新數字（寫入即讓快取失效）
+        ledger.settle(user_id=a.id)
+        db.session.commit()
+        assert client.get('/dashboard/kpi').get_json() == {
+            'count': 3, 'total': 230, 'paid': 230, 'unpaid': 0, 'unpaid_all': 90}
+
+    def test_requires_admin(self, web, client_for):
+        resp = client_for(_add_user('2')).get('/dashboard/kpi')
+        assert resp.status_code == 302
@@ -0,0 +1,87 @@
+"""
+Tests for command_router.CommandRouter 與 OrderBot 指令註冊
+Run: pytest tests/ -v
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from command_router import CommandRouter, CommandSpec, command
+from line_handler import OrderBot
+
+
+@pytest.fixture
+def router():
+    r = CommandRouter()
+    r.register_object(OrderBot({'LINE_CHANNEL_ACCESS_TOKEN': 'token'}))
+    r.register(CommandSpec('groupid', (), lambda g: g, args=('group_id',), exact=('!groupid',)))
+    return r
+
+
+def _name(router, text):
+    spec = router.resolve(text)
+    return spec.name if spec else None
+
+
+class TestResolve:
+    @pytest.mark.parametrize('text, expected', [
+        ('!點 麗媽 18\n2. 肉羹飯', 'order'),
+        ('！點 18', 'order'),
+        ('!bill 2', 'bill'),
+        ('！BILL 2', 'bill'),
+        ('!查帳 2', 'bill'),
+        ('18', 'bill'),
+        ('!統計 午餐', 'stats'),
+        ('!today', 'today'),
+        ('!今日', 'today'),
+        ('！今天', 'today'),
+        ('!今天吃什麼', 'suggest'),
+        ('!吃什麼', 'suggest'),
+        ('!隨機', 'suggest'),
+        ('!結清 2', 'checkout'),
+        ('!Checkout 2', 'checkout'),
+        ('!說明', 'help'),
+        ('!菜單 麗媽', 'menu'),
+        ('!MENU 麗媽', 'menu'),
+        ('!groupid', 'groupid'),
+    ])
+    def test_commands(self, router, text, expected):
+        assert _name(router, text) == expected
+
+    @pytest.mark.parametrize('text', [
+        '中午吃什麼', '', '!', '!今天吃飯了嗎', '!groupid2', '點 18', '12a',
+    ])
+    def test_chatter_is_not_a_command(self, router, text):
+        assert router.resolve(text) is None
+
+    def test_metadata(self, router):
+        assert router.resolve('!點 18').read_only is False
+        assert router.resolve('!結清 2').read_only is False
+        assert router.resolve('!today').read_only is True
+
+
+class TestDispatch:
+    def test_args_and_stats(self):
+        class Bot:
+            @command('echo', '!echo', args=('text', 'group_id'))
+            def handle_echo(self, text, group_id):
+                return f'{group_id}:{text}'
+
+        r = CommandRouter()
+        r.register_object(Bot())
+        spec = r.resolve('!echo hi')
+        assert r.dispatch(spec, text='!echo hi', group_id='C1', reply_token='t') == 'C1:!echo hi'
+        m = r.metrics()['echo']
+        assert m['count'] == 1 and m['errors'] == 0
+
+    def test_error_is_counted(self):
+        def boom(text):
+            raise RuntimeError
+        r = CommandRouter()
+        spec = r.register(CommandSpec('boom', ('!boom',), boom))
+        with pytest.raises(RuntimeError):
+            r.dispatch(spec, text='!boom')
+        assert r.metrics()['boom']['errors'] == 1
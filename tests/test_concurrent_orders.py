@@ -0,0 +1,103 @@
+"""
+Tests for 多個 worker 同時 !點（DailyMenu get-or-create、database is locked 重試、SQLite PRAGMA）
+Run: pytest tests/ -v
+"""
+import threading
+
+import pytest
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from sqlalchemy import create_engine
+
+from models import db, DailyMenu, Order, run_with_retry, apply_sqlite_pragmas
+
+THREADS = 8
+ROUNDS = 5
+
+
+def _hammer(app, bot, barrier, errors, worker):
+    with app.app_context():
+        try:
+            barrier.wait()
+            for r in range(ROUNDS):
+                code = (worker * ROUNDS + r) % 10 + 1
+                reply = bot.handle_order_command(f'!點 午餐 麗媽 1\n{code}. 肉羹飯', 'token')
+                assert reply.startswith('✅ 已記錄 1 筆'), reply
+        except Exception as e:
+            errors.append(e)
+        finally:
+            db.session.remove()
+
+
+class TestConcurrentOrders:
+    def test_parallel_order_commands_share_one_daily_menu(self, app, bot, seed):
+        barrier = threading.Barrier(THREADS)
+        errors = []
+        threads = [threading.Thread(target=_hammer, args=(app, bot, barrier, errors, i))
+                   for i in range(THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(60)
+        assert errors == []
+        assert DailyMenu.query.count() == 1
+        assert Order.query.count() == THREADS * ROUNDS
+        assert {o.daily_menu_id for o in Order.query} == {DailyMenu.query.one().id}
+
+
+class TestRunWithRetry:
+    def test_retries_locked_then_succeeds(self, app):
+        calls = []
+
+        def work():
+            calls.append(1)
+            if len(calls) < 3:
+                raise OperationalError('INSERT', {}, Exception('database is locked'))
+            return 'ok'
+
+        assert run_with_retry(work, base_delay=0) == 'ok'
+        assert len(calls) == 3
+
+    def test_gives_up_after_attempts(self, app):
+        def work():
+            raise OperationalError('INSERT', {}, Exception('database is locked'))
+
+        with pytest.raises(OperationalError):
+            run_with_retry(work, attempts=2, base_delay=0)
+
+    def test_other_errors_not_retried(self, app):
+        calls = []
+
+        def work():
+            calls.append(1)
+            raise OperationalError('INSERT', {}, Exception('no such table: orders'))
+
+        with pytest.raises(OperationalError):
+            run_with_retry(work, base_delay=0)
+        assert len(calls) == 1
+
+
+class TestSqlitePragmas:
+    def test_applied_on_every_connection(self, app):
+        expected = {'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 5000,
+                    'temp_store': 2, 'foreign_keys': 1}
+        with db.engine.connect() as a, db.engine.connect() as b:
+            for conn in (a, b):
+                got = {name: conn.exec_driver_sql(f'PRAGMA {name}').scalar() for name in expected}
+                assert got == expected
+
+    def test_foreign_keys_enforced(self, app, seed):
+        from models import User
+        with pytest.raises(IntegrityError):
+            db.session.add(Order(user_id=999, daily_menu_id=999, items='x'))
+            db.session.commit()
+        db.session.rollback()
+        assert User.query.count() == 10
+
+    def test_none_values_skipped(self, tmp_path):
+        engine = create_engine(f'sqlite:///{tmp_path / "x.db"}')
+        apply_sqlite_pragmas(engine, {'journal_mode': None, 'cache_size': -2000})
+        with engine.connect() as conn:
+            assert conn.exec_driver_sql('PRAGMA journal_mode').scalar() == 'delete'
+            assert conn.exec_driver_sql('PRAGMA cache_size').scalar() == -2000
+        engine.dispose()
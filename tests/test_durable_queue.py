@@ -0,0 +1,111 @@
+"""
+Tests for durable_queue.DurableQueue & webhook_intake.WebhookIntake
+Run: pytest tests/ -v
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from durable_queue import DurableQueue
+from webhook_intake import WebhookIntake
+
+
+def _queue(tmp_path, **kw):
+    return DurableQueue(str(tmp_path / 'queue.db'), 'test', **kw)
+
+
+class TestDurableQueue:
+    def test_fifo_and_ack(self, tmp_path):
+        q = _queue(tmp_path)
+        q.enqueue({'n': 1})
+        q.enqueue({'n': 2})
+        assert q.depth() == 2
+        job = q.claim()
+        assert job['payload'] == {'n': 1}
+        assert job['attempts'] == 1
+        q.ack(job['id'])
+        assert q.claim()['payload'] == {'n': 2}
+        assert q.claim() is None
+
+    def test_survives_reopen(self, tmp_path):
+        _queue(tmp_path).enqueue({'body': '測試'})
+        job = _queue(tmp_path).claim()
+        assert job['payload'] == {'body': '測試'}
+
+    def test_retry_delay(self, tmp_path):
+        q = _queue(tmp_path)
+        q.enqueue({'n': 1})
+        job = q.claim()
+        q.retry(job['id'], delay=60, error='boom')
+        assert q.claim() is None
+        assert q.counts() == {'pending': 1}
+
+    def test_expired_lease_is_reclaimed(self, tmp_path):
+        q = _queue(tmp_path, lease_seconds=0)
+        q.enqueue({'n': 1})
+        first = q.claim()
+        time.sleep(0.01)
+        again = q.claim()
+        assert again['id'] == first['id']
+        assert again['attempts'] == 2
+
+    def test_lease_gives_up_after_max_attempts(self, tmp_path):
+        q = _queue(tmp_path, lease_seconds=0, max_attempts=1)
+        q.enqueue({'n': 1})
+        q.claim()
+        time.sleep(0.01)
+        assert q.claim() is None
+        assert q.counts() == {'dead': 1}
+
+    def test_concurrent_claims_are_exclusive(self, tmp_path):
+        q = _queue(tmp_path)
+        for i in range(200):
+            q.enqueue({'n': i})
+        seen, lock = [], threading.Lock()
+
+        def drain():
+            while True:
+                job = q.claim()
+                if job is None:
+                    return
+                with lock:
+                    seen.append(job['payload']['n'])
+                q.ack(job['id'])
+
+        threads = [threading.Thread(target=drain) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert sorted(seen) == list(range(200))
+
+
+class TestWebhookIntake:
+    def test_workers_drain_queue(self, tmp_path):
+        done = []
+        intake = WebhookIntake(_queue(tmp_path), lambda p: done.append(p['body']),
+                               workers=2, idle_wait=0.05)
+        for i in range(10):
+            intake.submit(f'body{i}', 'sig')
+        intake.start()
+        deadline = time.time() + 5
+        while len(done) < 10 and time.time() < deadline:
+            time.sleep(0.01)
+        intake.stop()
+        assert sorted(done) == sorted(f'body{i}' for i in range(10))
+        m = intake.metrics()
+        assert m['processed'] == 10 and m['queue_depth'] == 0
+        assert m['wait_seconds']['count'] == 10
+
+    def test_failed_job_is_not_retried(self, tmp_path):
+        def boom(payload):
+            raise RuntimeError('x')
+        q = _queue(tmp_path)
+        intake = WebhookIntake(q, boom)
+        intake.submit('body', 'sig')
+        intake.run_job(q.claim())
+        assert intake.failed == 1
+        assert q.counts() == {'dead': 1}
@@ -0,0 +1,38 @@
+"""
+Tests for Order.for_date（後台列表頁一次載入關聯，查詢數不隨訂單數增加）
+Run: pytest tests/ -v
+"""
+from datetime import date
+
+import pytest
+
+from models import db, Order
+
+
+def _touch(orders):
+    """模擬 dashboard / accounting / history 模板會取用的欄位"""
+    return [(o.user.user_code, o.user.name, o.daily_menu.meal_type,
+             o.daily_menu.shop.name if o.daily_menu.shop else None,
+             o.payer.name if o.payer else None)
+            for o in orders]
+
+
+class TestForDate:
+    @pytest.mark.parametrize('lines', [2, 40])
+    def test_bounded_queries(self, bot, seed, count_queries, lines):
+        body = '\n'.join(f'{i % 10 + 1}. 肉羹飯' for i in range(lines))
+        bot.handle_order_command('!點 午餐 麗媽 1\n' + body, 'token')
+        bot.handle_order_command('!點 晚餐\n2. 雞腿飯', 'token')
+        db.session.expunge_all()
+
+        with count_queries() as q:
+            rows = _touch(Order.for_date(date.today()).order_by(Order.id).all())
+        # 訂單（含 user / daily_menu）+ 店家 + 代墊人
+        assert q.count == 3
+        assert len(rows) == lines + 1
+        assert rows[0] == ('1', '人1', 'lunch', '麗媽', '人1')
+        assert rows[-1] == ('2', '人2', 'dinner', None, None)
+
+    def test_other_days_excluded(self, bot, seed):
+        bot.handle_order_command('!點 午餐 麗媽 1\n2. 肉羹飯', 'token')
+        assert Order.for_date(date(2000, 1, 1)).all() == []
@@ -0,0 +1,250 @@
+"""
+Tests for ledger（每人未付款帳本、每餐叫餐總表）
+Run: pytest tests/ -v
+"""
+from datetime import date, timedelta
+
+from models import db, DailyMenu, MealTally, Order, User, UserBalance
+import ledger
+
+
+def _order(bot, body, header='!點 麗媽 1'):
+    return bot.handle_order_command(header + '\n' + body, 'token')
+
+
+def _user(code):
+    return User.query.filter_by(user_code=code).one()
+
+
+class TestLedger:
+    def test_orders_update_balance(self, bot, seed):
+        _order(bot, '2. 肉羹飯\n2. 雞腿飯\n3. 肉羹飯')
+        assert ledger.balance(_user('2').id) == (150, 2)
+        assert ledger.balance(_user('3').id) == (60, 1)
+        assert ledger.balance(_user('4').id) == (0.0, 0)
+
+    def test_amount_change_and_toggle(self, bot, seed):
+        _order(bot, '2. 肉羹飯\n2. 雞腿飯')
+        uid = _user('2').id
+        o = Order.query.filter_by(items='肉羹飯').one()
+
+        old = o.amount
+        o.amount = 70
+        ledger.order_changed(o, old, o.paid)
+        db.session.commit()
+        assert ledger.balance(uid) == (160, 2)
+
+        o.paid = True
+        ledger.order_changed(o, o.amount, False)
+        db.session.commit()
+        assert ledger.balance(uid) == (90, 1)
+
+        # 已付款的訂單改金額不影響欠款
+        ledger.order_changed(o, 70, True)
+        o.amount = 75
+        db.session.commit()
+        assert ledger.balance(uid) == (90, 1)
+
+    def test_remove(self, bot, seed):
+        _order(bot, '2. 肉羹飯\n2. 雞腿飯')
+        o = Order.query.filter_by(items='雞腿飯').one()
+        ledger.order_removed(o)
+        db.session.delete(o)
+        db.session.commit()
+        assert ledger.balance(_user('2').id) == (60, 1)
+
+    def test_checkout_zeroes_balance(self, bot, seed):
+        _order(bot, '2. 肉羹飯\n2. 雞腿飯')
+        reply = bot.handle_checkout('!結清 2')
+        assert '🧾 2 筆，共 $150' in reply
+        assert ledger.balance(_user('2').id) == (0, 0)
+        assert Order.query.filter_by(paid=False).count() == 0
+        assert bot.handle_checkout('!結清 2') == '✅ 2號 人2 目前沒有未付款訂單'
+
+    def test_bill_reads_ledger_not_orders(self, bot, seed, count_queries):
+        _order(bot, '2. 肉羹飯')
+        with count_queries() as q:
+            reply = bot.handle_bill_query('!bill 2')
+        assert '【累計欠款】$60' in reply
+        assert len(q.matching('FROM user_balances')) == 1
+        assert not [s for s in q.statements if 'paid = 0' in s and 'user_balances' not in s]
+
+    def test_daily_summary(self, bot, seed):
+        _order(bot, '10. 肉羹飯\n2. 雞腿飯')
+        summary = bot.generate_daily_unpaid_summary()
+        assert summary.splitlines()[2:] == ['2. 人2  未付 $90', '10. 人10  未付 $60']
+
+
+class TestReconcile:
+    def test_clean_ledger_has_no_drift(self, bot, seed):
+        _order(bot, '2. 肉羹飯\n3. 雞腿飯')
+        assert ledger.reconcile() == []
+
+    def test_repairs_drift(self, bot, seed):
+        _order(bot, '2. 肉羹飯\n3. 雞腿飯')
+        uid2, uid3 = _user('2').id, _user('3').id
+        # 模擬繞過帳本的修改：直接改 orders、弄丟一筆帳本、留下一筆多餘的帳本
+        Order.query.filter_by(user_id=uid2).update({'amount': 65})
+        UserBalance.query.filter_by(user_id=uid3).delete()
+        db.session.add(UserBalance(user_id=_user('4').id, unpaid_total=30, unpaid_count=1))
+        db.session.commit()
+
+        drift = {uid: (have, want) for uid, have, want in ledger.reconcile()}
+        assert drift[uid2] == ((60, 1), (65, 1))
+        assert drift[uid3] == ((0.0, 0), (90, 1))
+        assert len(drift) == 3
+        assert ledger.balance(uid2) == (65, 1)
+        assert ledger.balance(uid3) == (90, 1)
+        assert ledger.balance(_user('4').id) == (0, 0)
+        assert ledger.reconcile() == []
+
+    def test_dry_run(self, bot, seed):
+        _order(bot, '2. 肉羹飯')
+        UserBalance.query.delete()
+        db.session.commit()
+        assert len(ledger.reconcile(repair=False)) == 1
+        assert ledger.balance(_user('2').id) == (0.0, 0)
+
+
+class TestDailySummary:
+    def test_one_query_per_mode(self, bot, seed, count_queries):
+        _order(bot, '2. 肉羹飯\n3. 雞腿飯')
+        _order(bot, '2. 雞腿飯', header='!點 晚餐 麗媽 5')
+        for by_payer in (False, True):
+            with count_queries() as q:
+                bot.generate_daily_unpaid_summary(by_payer=by_payer)
+            assert q.count == 1
+
+    def test_payer_breakdown(self, bot, seed):
+        _order(bot, '2. 肉羹飯\n3. 雞腿飯')
+        _order(bot, '2. 雞腿飯', header='!點 晚餐 麗媽 5')
+        _order(bot, '3. 肉羹飯', header='!點 點心 麗媽')
+        lines = bot.generate_daily_unpaid_summary(by_payer=True).splitlines()[2:]
+        assert lines == [
+            '2. 人2  未付 $150',
+            '　└ 欠 1. 人1 $60、欠 5. 人5 $90',
+            '3. 人3  未付 $150',
+            '　└ 未指定代墊 $60、欠 1. 人1 $90',
+        ]
+        # 不分代墊人時總額一致
+        assert bot.generate_daily_unpaid_summary(by_payer=False).splitlines()[2:] == [lines[0], lines[2]]
+
+
+class TestSettle:
+    def _seed_orders(self, bot):
+        _order(bot, '2. 肉羹飯\n3. 雞腿飯', header='!點 午餐 麗媽 1')
+        _order(bot, '2. 雞腿飯', header='!點 晚餐 麗媽 5')
+        # 把晚餐移到前一天
+        dm = Order.query.filter_by(items='雞腿飯', user_id=_user('2').id).one().daily_menu
+        dm.menu_date = dm.menu_date - timedelta(days=1)
+        db.session.commit()
+
+    def test_single_update_statement(self, bot, seed, count_queries):
+        self._seed_orders(bot)
+        with count_queries() as q:
+            bot.handle_checkout('!結清 2')
+        assert len(q.matching('UPDATE orders')) == 1
+        assert not q.matching('FROM orders')
+
+    def test_filter_by_meal(self, bot, seed):
+        self._seed_orders(bot)
+        reply = bot.handle_checkout('!結清 2 晚餐')
+        assert '🔎 晚餐\n🧾 1 筆，共 $90' in reply
+        assert ledger.balance(_user('2').id) == (60, 1)
+
+    def test_filter_by_date_range_and_payer(self, bot, seed):
+        self._seed_orders(bot)
+        today = date.today()
+        assert '沒有符合條件' in bot.handle_checkout(f'!結清 2 {today:%Y-%m-%d} 5')
+        reply = bot.handle_checkout(f'!結清 2 {today - timedelta(days=3):%Y-%m-%d}~今天 1')
+        assert '🧾 1 筆，共 $60' in reply
+        assert ledger.balance(_user('2').id) == (90, 1)
+        assert ledger.balance(_user('3').id) == (90, 1)
+
+    def test_bad_arguments(self, bot, seed):
+        assert bot.handle_checkout('!結清 2 明年').startswith('❌ 看不懂「明年」')
+        assert bot.handle_checkout('!結清 2 99') == '❌ 代墊人代號 99 不存在'
+
+    def test_settle_whole_day(self, bot, seed):
+        self._seed_orders(bot)
+        settled = ledger.settle(date_from=date.today(), date_to=date.today())
+        db.session.commit()
+        assert settled == {_user('2').id: (1, 60), _user('3').id: (1, 90)}
+        assert ledger.reconcile() == []
+
+    def test_parse_date(self, bot):
+        today = date(2024, 3, 1)
+        assert bot.parse_date('2/28', today) == date(2024, 2, 28)
+        assert bot.parse_date('12/31', today) == date(2023, 12, 31)
+        assert bot.parse_date('2024/3/1', today) == today
+        assert bot.parse_date('昨天', today) == date(2024, 2, 29)
+        assert bot.parse_date('2/30', today) is None
+
+
+class TestTally:
+    def _tally(self):
+        return [(item, count, amount) for item, count, amount in ledger.tally(DailyMenu.query.one().id)]
+
+    def test_reply_is_cumulative_across_batches(self, bot, seed):
+        _order(bot, '2. 肉羹飯\n3. 雞腿飯', header='!點 午餐 麗媽 1')
+        reply = _order(bot, '4. 肉羹飯', header='!點 午餐 麗媽 1')
+        assert '🍱 肉羹飯 × 2\n🍱 雞腿飯 × 1\n' in reply
+        assert '共 3 份，總計 $210（本次 1 份 $60）' in reply
+        assert bot.handle_stats_query('!統計 午餐').endswith('共 3 份，總計 $210')
+
+    def test_edit_and_remove(self, bot, seed):
+        _order(bot, '2. 肉羹飯\n3. 雞腿飯\n4. 雞腿飯')
+        o = Order.query.filter_by(items='肉羹飯').one()
+        old_amount, old_items = o.amount, o.items
+        o.items, o.amount = '雞腿飯', 90
+        ledger.order_changed(o, old_amount, o.paid, old_items)
+        db.session.commit()
+        assert self._tally() == [('雞腿飯', 3, 270)]
+
+        o = Order.query.filter_by(user_id=_user('4').id).one()
+        ledger.order_removed(o)
+        db.session.delete(o)
+        db.session.commit()
+        assert self._tally() == [('雞腿飯', 2, 180)]
+
+        ledger.user_removed(_user('3').id)
+        db.session.delete(_user('3'))
+        db.session.commit()
+        assert self._tally() == [('雞腿飯', 1, 90)]
+        assert ledger.reconcile_tallies() == []
+
+    def test_checkout_keeps_tally(self, bot, seed):
+        _order(bot, '2. 肉羹飯')
+        bot.handle_checkout('!結清 2')
+        assert self._tally() == [('肉羹飯', 1, 60)]
+
+    def test_reconcile_rebuilds(self, bot, seed):
+        _order(bot, '2. 肉羹飯\n3. 雞腿飯')
+        dm_id = DailyMenu.query.one().id
+        Order.query.filter_by(items='肉羹飯').update({'amount': 65})
+        MealTally.query.filter_by(item='雞腿飯').delete()
+        db.session.commit()
+        assert ledger.reconcile_tallies(repair=False) == [dm_id]
+        assert ledger.reconcile_tallies() == [dm_id]
+        assert self._tally() == [('肉羹飯', 1, 65), ('雞腿飯', 1, 90)]
+        assert ledger.reconcile_tallies() == []
+
+
+class TestDayKpis:
+    def test_totals_in_one_query(self, bot, seed, count_queries):
+        _order(bot, '2. 肉羹飯\n3. 雞腿飯', header='!點 午餐 麗媽 1')
+        bot.handle_checkout('!結清 3')
+        _order(bot, '2. 雞腿飯', header='!點 晚餐 麗媽 5')
+        # 昨天的未付款只算在累計未收
+        dm = Order.query.filter_by(items='雞腿飯', user_id=_user('2').id).one().daily_menu
+        dm.menu_date = dm.menu_date - timedelta(days=1)
+        db.session.commit()
+
+        with count_queries() as q:
+            kpi = ledger.day_kpis(date.today())
+        assert q.count == 1
+        assert kpi == {'count': 2, 'total': 150, 'paid': 90, 'unpaid': 60, 'unpaid_all': 150}
+
+    def test_empty_day(self, app):
+        assert ledger.day_kpis(date.today()) == {'count': 0, 'total': 0, 'paid': 0, 'unpaid': 0,
+                                                 'unpaid_all': 0}
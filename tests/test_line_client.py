@@ -0,0 +1,63 @@
+"""
+Tests for line_client.LineClient（對本機假 LINE 伺服器）
+Run: pytest tests/ -v
+"""
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+from linebot.v3.messaging import ReplyMessageRequest, PushMessageRequest, TextMessage
+
+from fake_line_server import FakeLineServer
+from line_client import LineClient
+
+
+@pytest.fixture
+def server():
+    with FakeLineServer() as s:
+        yield s
+
+
+def _reply(text='hi'):
+    return ReplyMessageRequest(reply_token='token', messages=[TextMessage(text=text)])
+
+
+class TestLineClient:
+    def test_reuses_connection(self, server):
+        client = LineClient('token', host=server.url)
+        for _ in range(5):
+            client.reply_message(_reply())
+        stats = client.stats()
+        assert stats['requests'] == 5
+        assert stats['connections_opened'] == 1
+        assert stats['connections_reused'] == 4
+        assert [r['path'] for r in server.requests] == ['/v2/bot/message/reply'] * 5
+
+    def test_push_sends_retry_key(self, server):
+        client = LineClient('token', host=server.url)
+        client.push_message(PushMessageRequest(to='Cgroup', messages=[TextMessage(text='x')]),
+                            retry_key='123e4567-e89b-12d3-a456-426614174000')
+        assert server.requests[0]['retry_key'] == '123e4567-e89b-12d3-a456-426614174000'
+
+    def test_shared_across_threads(self, server):
+        client = LineClient('token', host=server.url, pool_size=4)
+        threads = [threading.Thread(target=lambda: [client.reply_message(_reply()) for _ in range(10)])
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats = client.stats()
+        assert stats['requests'] == 40 and stats['errors'] == 0
+        assert stats['connections_opened'] <= 4
+
+    def test_error_is_counted(self, server):
+        server.queue_responses(500)
+        client = LineClient('token', host=server.url)
+        with pytest.raises(Exception):
+            client.reply_message(_reply())
+        assert client.stats()['errors'] == 1
@@ -0,0 +1,104 @@
+"""
+Tests for menu_catalog（菜單快照與版本戳記）
+Run: pytest tests/ -v
+"""
+from flask import current_app
+
+from models import db, MenuItem, Shop
+from menu_catalog import bump_version, get_catalog
+
+
+def _builds():
+    return current_app.extensions['menu_catalog'].builds
+
+
+class TestMenuCatalog:
+    def test_snapshot_reused_until_version_bump(self, app, seed):
+        first = get_catalog()
+        assert get_catalog() is first
+        assert _builds() == 1
+
+        db.session.add(MenuItem(shop_id=seed.id, name='排骨飯', price=85))
+        bump_version()
+        db.session.commit()
+        second = get_catalog()
+        assert second is not first
+        assert '排骨飯' in second.names(seed.id)
+        assert '排骨飯' not in first.names(seed.id)   # 舊快照不受影響
+
+    def test_unavailable_items_excluded(self, app, seed):
+        MenuItem.query.filter_by(name='雞腿飯').update({'is_available': False})
+        bump_version()
+        db.session.commit()
+        assert '雞腿飯' not in get_catalog().names(seed.id)
+
+    def test_business_day_mask(self, app):
+        db.session.add(Shop(name='週末休', business_days='1111100'))
+        db.session.add(Shop(name='格式錯', business_days='11'))
+        db.session.commit()
+        catalog = get_catalog()
+        closed = catalog.match_shop('週末休')
+        assert closed.is_open(0) and not closed.is_open(6)
+        assert catalog.match_shop('格式錯').is_open(6)
+
+    def test_suggest_uses_same_open_rule(self, bot, app):
+        db.session.add(Shop(name='格式錯', business_days='11'))
+        db.session.commit()
+        assert '格式錯' in bot.handle_suggest_shops()   # 短字串視為每天營業，不會 IndexError
+
+    def test_match_shop_skips_inactive(self, app, seed):
+        db.session.add(Shop(name='停業店', is_active=False))
+        db.session.commit()
+        catalog = get_catalog()
+        assert catalog.match_shop('停業店') is None
+        assert catalog.match_shop('停業店', active_only=False).name == '停業店'
+
+
+class TestMatchMenuItem:
+    def test_exact_fuzzy_none(self, bot, seed):
+        item, conf = bot.match_menu_item('肉羹飯\u200b', shop_id=seed.id)
+        assert (item.name, conf) == ('肉羹飯', 'exact')
+        item, conf = bot.match_menu_item('雞腿', shop_id=seed.id)
+        assert (item.name, conf) == ('雞腿飯', 'fuzzy')
+        assert bot.match_menu_item('珍珠奶茶', shop_id=seed.id) == (None, 'none')
+
+    def test_no_menu_queries_after_first_build(self, bot, seed, count_queries):
+        catalog = get_catalog()
+        with count_queries() as q:
+            for _ in range(5):
+                bot.match_menu_item('雞腿', shop_id=seed.id, catalog=catalog)
+        assert not q.matching('FROM menu_items') and not q.matching('FROM shops')
+
+    def test_batch_matches_single(self, bot, seed):
+        names = ['肉羹飯', '雞腿', '珍珠奶茶', '沙茶牛肉炒麵', '肉羹']
+        batch = bot.match_menu_items(names, shop_id=seed.id)
+        assert batch == [bot.match_menu_item(n, shop_id=seed.id) for n in names]
+        assert [conf for _, conf in batch] == ['exact', 'fuzzy', 'none', 'exact', 'fuzzy']
+
+    def test_batch_empty_menu(self, bot, app):
+        assert bot.match_menu_items(['雞腿'], shop_id=999) == [(None, 'none')]
+
+
+class TestMatchCache:
+    def test_repeat_fuzzy_served_from_cache(self, bot, seed):
+        first = bot.match_menu_item('雞腿', shop_id=seed.id)
+        second = bot.match_menu_item('雞腿', shop_id=seed.id)
+        assert second == first
+        assert bot.match_menu_item('珍珠奶茶', shop_id=seed.id) == (None, 'none')
+        assert bot.match_menu_item('珍珠奶茶', shop_id=seed.id) == (None, 'none')
+        stats = bot.match_cache.metrics()
+        assert (stats['hits'], stats['misses'], stats['size']) == (2, 2, 2)
+
+    def test_menu_edit_invalidates(self, bot, seed):
+        assert bot.match_menu_item('雞腿', shop_id=seed.id)[0].price == 90
+        MenuItem.query.filter_by(name='雞腿飯').update({'price': 95})
+        bump_version()
+        db.session.commit()
+        assert bot.match_menu_item('雞腿', shop_id=seed.id)[0].price == 95
+
+    def test_lru_eviction(self, bot, seed):
+        bot.match_cache.maxsize = 2
+        for name in ('雞腿', '肉羹', '沙茶牛肉', '雞腿'):
+            bot.match_menu_item(name, shop_id=seed.id)
+        stats = bot.match_cache.metrics()
+        assert (stats['size'], stats['evictions'], stats['hits']) == (2, 2, 0)
@@ -0,0 +1,73 @@
+"""
+Tests for message_log.MessageLogWriter
+Run: pytest tests/ -v
+"""
+import time
+
+from models import db, LineMessage
+from message_log import MessageLogWriter
+
+
+def _count():
+    db.session.expire_all()
+    return LineMessage.query.count()
+
+
+class TestMessageLogWriter:
+    def test_flush_writes_one_batch(self, app):
+        w = MessageLogWriter(app, batch_size=10)
+        for i in range(25):
+            w.log('text', f'!點 {i}', 'U1', 'C1')
+        assert _count() == 0
+        assert w.flush() == 25
+        assert _count() == 25
+        assert w.metrics()['batches'] == 1
+
+    def test_background_flush_by_size_and_age(self, app):
+        w = MessageLogWriter(app, batch_size=5, flush_seconds=0.1)
+        w.start()
+        try:
+            for i in range(7):
+                w.log('text', str(i))
+            deadline = time.time() + 3
+            while _count() < 7 and time.time() < deadline:
+                time.sleep(0.05)
+            assert _count() == 7
+        finally:
+            w.close()
+
+    def test_backpressure_flushes_in_caller(self, app):
+        w = MessageLogWriter(app, batch_size=2, capacity=3, put_timeout=0.01)
+        for i in range(5):
+            w.log('text', str(i))
+        # 第 4 筆時緩衝已滿 → 呼叫端先寫掉 2 筆
+        assert w.metrics()['backpressure'] == 1
+        assert _count() == 2
+        assert w.metrics()['pending'] == 3
+
+    def test_close_flushes_remaining(self, app):
+        w = MessageLogWriter(app, batch_size=100, flush_seconds=60)
+        w.start()
+        w.log('text', '!today')
+        w.close()
+        assert _count() == 1
+
+    def test_chatter_sampling(self, app):
+        w = MessageLogWriter(app, chatter_sample=0.0)
+        w.log('text', '午安', is_command=False)
+        w.log('text', '!today', is_command=True)
+        w.flush()
+        assert [m.message_content for m in LineMessage.query.all()] == ['!today']
+        assert w.metrics()['skipped'] == 1
+
+    def test_stalled_writer_drops_instead_of_blocking(self, app):
+        w = MessageLogWriter(app, batch_size=2, capacity=2, put_timeout=0.01)
+        w.log('text', '1')
+        w.log('text', '2')
+        with w._flush_lock:            # 模擬背景寫入卡在 flush 裡
+            started = time.monotonic()
+            w.log('text', '3')
+            assert time.monotonic() - started < 1
+        stats = w.metrics()
+        assert (stats['backpressure'], stats['dropped'], stats['pending']) == (1, 1, 2)
+
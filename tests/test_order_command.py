@@ -0,0 +1,121 @@
+"""
+Tests for OrderBot.handle_order_command（!點 指令，走實際 DB）
+Run: pytest tests/ -v
+"""
+from datetime import date, datetime, timedelta
+
+from models import db, DailyMenu, MenuAlias, MenuItem, Order
+
+
+def _order(bot, body, header='!點 麗媽 1'):
+    return bot.handle_order_command(header + '\n' + body, 'token')
+
+
+class TestUserResolution:
+    def test_one_user_query_for_whole_batch(self, bot, seed, count_queries):
+        body = '\n'.join(f'{i}. 肉羹飯' for i in range(1, 11))
+        with count_queries() as q:
+            reply = _order(bot, body)
+        assert reply.startswith('✅ 已記錄 10 筆訂單')
+        assert len(q.matching('FROM users')) == 1
+
+    def test_bad_codes_reported_per_line(self, bot, seed):
+        reply = _order(bot, '2. 肉羹飯\n99. 雞腿飯\n亂打一通\n3. 雞腿飯')
+        assert '已記錄 2 筆' in reply
+        assert '• 代號 99 不存在\n• 無法解析：亂打一通' in reply
+        assert Order.query.count() == 2
+
+    def test_unknown_payer(self, bot, seed):
+        assert _order(bot, '2. 肉羹飯', header='!點 麗媽 77') == '❌ 代墊人代號 77 不存在'
+        assert Order.query.count() == 0
+
+
+class TestItemMatching:
+    def test_remark_forms(self, bot, seed):
+        _order(bot, '1. 雞腿飯(不要辣)\n2. 肉羹飯-加蛋\n3. 沙茶牛肉炒麵 大辣')
+        orders = {o.user_id: o for o in Order.query.all()}
+        assert [(o.items, o.note, o.amount) for _, o in sorted(orders.items())] == [
+            ('雞腿飯 (不要辣)', '不要辣', 90),
+            ('肉羹飯 (加蛋)', '加蛋', 60),
+            ('沙茶牛肉炒麵 (大辣)', '大辣', 80),
+        ]
+
+    def test_space_in_item_name_falls_back_to_whole_text(self, bot, seed):
+        # 「雞腿」本身就比對得到，保留備註；「沙茶」比對不到，改用整串重新比對
+        _order(bot, '1. 沙茶 牛肉炒麵\n2. 雞腿 飯')
+        assert [(o.items, o.note) for o in Order.query.order_by(Order.id)] == [
+            ('沙茶牛肉炒麵', ''), ('雞腿飯 (飯)', '飯'),
+        ]
+
+
+class TestAliases:
+    def test_fuzzy_match_learned_as_alias(self, bot, seed):
+        first = _order(bot, '1. 雞腿')
+        assert '比對為「雞腿飯」' in first
+        alias = MenuAlias.query.one()
+        assert (alias.normalized_input, alias.menu_item.name, alias.hits, alias.confirmed) == ('雞腿', '雞腿飯', 0, False)
+
+        # 自動學到的別名直接命中，但命中 trust_hits 次以前照樣提醒
+        for code in range(2, 2 + bot.aliases.trust_hits):
+            assert '比對為「雞腿飯」' in _order(bot, f'{code}. 雞腿')
+        assert MenuAlias.query.one().hits == bot.aliases.trust_hits
+        assert bot.aliases.metrics()['hits'] == bot.aliases.trust_hits
+        assert '比對為' not in _order(bot, '9. 雞腿')
+        assert {o.amount for o in Order.query} == {90}
+
+    def test_confirmed_alias_is_silent(self, bot, seed):
+        item = MenuItem.query.filter_by(name='雞腿飯').one()
+        bot.aliases.remember(seed.id, [('雞腿', item.id)], confirmed=True)
+        db.session.commit()
+        assert '比對為' not in _order(bot, '1. 雞腿')
+
+    def test_alias_lookup_is_one_query_per_batch(self, bot, seed, count_queries):
+        _order(bot, '1. 雞腿\n2. 肉羹')
+        with count_queries() as q:
+            _order(bot, '3. 雞腿\n4. 肉羹\n5. 沙茶')
+        assert len(q.matching('FROM menu_aliases')) == 1
+
+    def test_alias_to_other_item_wins_over_fuzzy(self, bot, seed):
+        item = MenuItem.query.filter_by(name='肉羹飯').one()
+        bot.aliases.remember(seed.id, [('雞腿', item.id)])
+        db.session.commit()
+        _order(bot, '1. 雞腿')
+        assert Order.query.one().items == '肉羹飯'
+
+    def test_prune(self, bot, seed):
+        _order(bot, '1. 雞腿\n2. 肉羹')
+        MenuAlias.query.filter_by(normalized_input='雞腿').update(
+            {'last_used': datetime.utcnow() - timedelta(days=60)})
+        assert bot.aliases.prune(max_hits=0, idle_days=30) == 1
+        assert [a.normalized_input for a in MenuAlias.query.all()] == ['肉羹']
+
+
+class TestBulkInsert:
+    def test_one_executemany_for_all_lines(self, bot, seed, count_queries):
+        body = '\n'.join(f'{i}. 肉羹飯' for i in range(1, 11))
+        with count_queries() as q:
+            _order(bot, body)
+        assert len(q.matching('INSERT INTO orders')) == 1
+        assert Order.query.count() == 10
+        assert {o.daily_menu_id for o in Order.query} == {DailyMenu.query.one().id}
+
+    def test_daily_menu_reused(self, bot, seed):
+        _order(bot, '1. 肉羹飯', header='!點 午餐 麗媽 1')
+        _order(bot, '2. 雞腿飯', header='!點 午餐 1')
+        dm = DailyMenu.query.one()
+        assert dm.shop_id == seed.id
+        assert len(dm.orders) == 2
+
+    def test_get_or_create_ignores_existing(self, app):
+        first = DailyMenu.get_or_create(date(2024, 1, 2), 'lunch')
+        db.session.commit()
+        assert DailyMenu.get_or_create(date(2024, 1, 2), 'lunch').id == first.id
+        assert DailyMenu.query.count() == 1
+
+    def test_insert_many_returns_ids_in_order(self, app, seed):
+        dm = DailyMenu.get_or_create(date(2024, 1, 2), 'lunch')
+        rows = [{'user_id': i, 'daily_menu_id': dm.id, 'items': f'品項{i}', 'amount': i}
+                for i in range(1, 6)]
+        ids = Order.insert_many(rows)
+        db.session.commit()
+        assert [db.session.get(Order, i).items for i in ids] == [f'品項{i}' for i in range(1, 6)]
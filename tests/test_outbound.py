@@ -0,0 +1,166 @@
+"""
+Tests for outbound.OutboundDispatcher（對本機假 LINE 伺服器）
+Run: pytest tests/ -v
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+from linebot.v3.messaging import TextMessage
+
+from durable_queue import DurableQueue
+from fake_line_server import FakeLineServer
+from line_client import LineClient
+from outbound import OutboundDispatcher, TokenBucket
+
+
+@pytest.fixture
+def server():
+    with FakeLineServer() as s:
+        yield s
+
+
+def _dispatcher(tmp_path, server, **kw):
+    queue = DurableQueue(str(tmp_path / 'queue.db'), 'outbound', max_attempts=kw.pop('max_attempts', 3))
+    return OutboundDispatcher(LineClient('token', host=server.url), queue, base_delay=0, **kw)
+
+
+def _drain(d):
+    """跑到佇列清空（重試 delay 為 0）"""
+    for _ in range(20):
+        if not d.drain_once():
+            return
+
+
+class TestOutboundDispatcher:
+    def test_push_to_group(self, tmp_path, server):
+        d = _dispatcher(tmp_path, server)
+        d.push('Cgroup', [TextMessage(text='📊 帳務提醒')])
+        _drain(d)
+        assert len(server.requests) == 1
+        req = server.requests[0]
+        assert req['path'] == '/v2/bot/message/push'
+        assert req['body']['to'] == 'Cgroup'
+        assert req['body']['messages'][0]['text'] == '📊 帳務提醒'
+        assert req['retry_key']
+
+    def test_identical_user_pushes_become_multicast(self, tmp_path, server):
+        d = _dispatcher(tmp_path, server)
+        for i in range(3):
+            d.push(f'U{i}', [TextMessage(text='記得付錢')])
+        d.push('U9', [TextMessage(text='不同內容')])
+        _drain(d)
+        paths = sorted(r['path'] for r in server.requests)
+        assert paths == ['/v2/bot/message/multicast', '/v2/bot/message/push']
+        multicast = next(r for r in server.requests if r['path'].endswith('multicast'))
+        assert multicast['body']['to'] == ['U0', 'U1', 'U2']
+        assert d.metrics()['coalesced'] == 3
+
+    def test_multicast_is_chunked_at_500(self, tmp_path, server):
+        d = _dispatcher(tmp_path, server)
+        for i in range(501):
+            d.push(f'U{i:04d}', [TextMessage(text='same')])
+        _drain(d)
+        sizes = sorted(len(r['body']['to']) for r in server.requests if r['path'].endswith('multicast'))
+        singles = [r for r in server.requests if r['path'].endswith('push')]
+        assert sizes == [500] and len(singles) == 1
+
+    def test_retries_429_and_5xx_with_same_retry_key(self, tmp_path, server):
+        server.queue_responses(429, 503)
+        d = _dispatcher(tmp_path, server)
+        d.push('Cgroup', [TextMessage(text='x')])
+        _drain(d)
+        assert len(server.requests) == 3
+        assert len({r['retry_key'] for r in server.requests}) == 1
+        m = d.metrics()
+        assert m['sent'] == 1 and m['retried'] == 2 and m['queue_depth'] == 0
+
+    def test_multicast_retry_keeps_batch_and_key(self, tmp_path, server):
+        server.queue_responses(503)
+        d = _dispatcher(tmp_path, server)
+        d.push('U0', [TextMessage(text='記得付錢')])
+        d.push('U1', [TextMessage(text='記得付錢')])
+        d.drain_once()
+        # 重試前又來一筆同內容的：不能併進原批次（否則 retry key 會變）
+        d.push('U2', [TextMessage(text='記得付錢')])
+        _drain(d)
+        multicasts = [r for r in server.requests if r['path'].endswith('multicast')]
+        assert [r['body']['to'] for r in multicasts] == [['U0', 'U1'], ['U0', 'U1']]
+        assert multicasts[0]['retry_key'] == multicasts[1]['retry_key']
+        pushes = [r for r in server.requests if r['path'].endswith('push')]
+        assert [r['body']['to'] for r in pushes] == ['U2']
+
+    def test_full_claim_does_not_split_a_batch(self, tmp_path, server):
+        server.queue_responses(503)
+        d = _dispatcher(tmp_path, server)
+        for i in range(3):
+            d.push(f'U{i}', [TextMessage(text='same')])
+        d.drain_once()
+        d.push('Cgroup', [TextMessage(text='other')])
+        # 只取 2 筆時會切到那一批 → 整批放回，不算嘗試次數
+        time.sleep(0.01)
+        assert d.drain_once(limit=2) == 0
+        assert d.metrics()['queue_status'] == {'pending': 4}
+        _drain(d)
+        multicasts = [r for r in server.requests if r['path'].endswith('multicast')]
+        assert [r['body']['to'] for r in multicasts] == [['U0', 'U1', 'U2']] * 2
+        assert len({r['retry_key'] for r in multicasts}) == 1
+
+    def test_gives_up_after_max_attempts(self, tmp_path, server):
+        server.queue_responses(500, 500, 500)
+        d = _dispatcher(tmp_path, server, max_attempts=3)
+        d.push('Cgroup', [TextMessage(text='x')])
+        _drain(d)
+        assert len(server.requests) == 3
+        assert d.metrics()['queue_status'] == {'dead': 1}
+
+    def test_client_error_is_not_retried(self, tmp_path, server):
+        server.queue_responses(400)
+        d = _dispatcher(tmp_path, server)
+        d.push('Cgroup', [TextMessage(text='x')])
+        _drain(d)
+        assert len(server.requests) == 1
+        assert d.metrics()['dead'] == 1
+
+    def test_conflict_means_already_delivered(self, tmp_path, server):
+        server.queue_responses(409)
+        d = _dispatcher(tmp_path, server)
+        d.push('Cgroup', [TextMessage(text='x')])
+        _drain(d)
+        assert d.metrics()['sent'] == 1
+
+    def test_retry_state_survives_restart(self, tmp_path, server):
+        server.queue_responses(503)
+        d = _dispatcher(tmp_path, server, max_attempts=5)
+        d.base_delay = 0.05
+        d.push('Cgroup', [TextMessage(text='x')])
+        d.drain_once()
+        # 新的 dispatcher（模擬重開機）讀同一個佇列檔案
+        time.sleep(0.1)
+        d2 = _dispatcher(tmp_path, server, max_attempts=5)
+        _drain(d2)
+        assert len(server.requests) == 2
+        assert d2.metrics()['sent'] == 1
+
+    def test_expired_reply_token_is_dropped(self, tmp_path, server):
+        d = _dispatcher(tmp_path, server)
+        d.reply('token', [TextMessage(text='x')])
+        job = d.queue.claim()
+        job['payload']['expires_at'] = time.time() - 1
+        d._send('reply', [job])
+        assert server.requests == []
+        assert d.metrics()['dead'] == 1
+
+
+class TestTokenBucket:
+    def test_throttles_after_burst(self):
+        bucket = TokenBucket(rate=50, capacity=5)
+        start = time.monotonic()
+        for _ in range(10):
+            bucket.acquire()
+        # 前 5 個立即拿到，後 5 個要等 ~0.1 秒
+        assert time.monotonic() - start >= 0.08
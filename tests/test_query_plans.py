@@ -0,0 +1,84 @@
+"""
+Tests for 熱門查詢的索引（EXPLAIN QUERY PLAN：bot 指令與後台查詢都不可整表掃描 orders）
+Run: pytest tests/ -v
+"""
+import re
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import inspect
+
+from models import db, DailyMenu, Order
+import ledger
+
+# 掃描只含未付款訂單的部分索引不算整表掃描（大小等於未付款筆數，報表本來就要全部讀）
+PARTIAL_INDEXES = {'ix_orders_unpaid'}
+FULL_SCAN = re.compile(r'^SCAN orders(?: USING (?:COVERING )?INDEX (\w+))?')
+
+
+def _plan(statement, parameters):
+    if isinstance(parameters, list):        # executemany：取第一組
+        parameters = parameters[0]
+    rows = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+    return [row[-1] for row in rows]
+
+
+def _full_scans(q):
+    scans = []
+    for statement, parameters in zip(q.statements, q.parameters):
+        if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'INSERT')):
+            continue
+        details = _plan(statement, parameters)
+        if any(m and m.group(1) not in PARTIAL_INDEXES for m in map(FULL_SCAN.match, details)):
+            scans.append((statement, details))
+    return scans
+
+
+@pytest.fixture
+def history(bot, seed):
+    """三天、三餐的訂單，其中一天移到上週"""
+    for header in ('!點 午餐 麗媽 1', '!點 晚餐 麗媽 5', '!點 點心'):
+        bot.handle_order_command(header + '\n' + '\n'.join(f'{i}. 肉羹飯' for i in range(1, 11)), 'token')
+    dm = DailyMenu.query.filter_by(meal_type='snack').one()
+    dm.menu_date = date.today() - timedelta(days=7)
+    db.session.commit()
+
+
+class TestIndexes:
+    def test_declared_indexes_exist(self, app):
+        names = {ix['name'] for ix in inspect(db.engine).get_indexes('orders')}
+        assert {'ix_orders_user_paid', 'ix_orders_daily_menu', 'ix_orders_payer', 'ix_orders_menu_item',
+                'ix_orders_unpaid'} <= names
+
+    @pytest.mark.parametrize('text', [
+        '!點 午餐 麗媽 1\n2. 雞腿飯\n3. 肉羹飯',
+        '!bill 2',
+        '2',
+        '!today',
+        '!統計',
+        '!統計 午餐',
+        '!結清 3',
+        '!結清 4 晚餐 5',
+        f'!結清 5 {date.today() - timedelta(days=10):%Y-%m-%d}~今天',
+    ])
+    def test_bot_commands_use_indexes(self, bot, history, count_queries, text):
+        handler = {'!點': lambda t: bot.handle_order_command(t, 'token'),
+                   '!bill': bot.handle_bill_query, '2': bot.handle_bill_query,
+                   '!today': lambda t: bot.handle_today_summary(),
+                   '!統計': bot.handle_stats_query, '!結清': bot.handle_checkout}[text.split()[0]]
+        with count_queries() as q:
+            handler(text)
+        assert _full_scans(q) == []
+
+    def test_admin_queries_use_indexes(self, bot, history, count_queries):
+        uid = Order.query.first().user_id
+        with count_queries() as q:
+            Order.for_date(date.today()).order_by(Order.id).all()
+            ledger.day_kpis(date.today())
+            ledger.balance(uid)
+            ledger.settle(date_from=date.today(), date_to=date.today(), meal_type='lunch')
+            bot.generate_daily_unpaid_summary(by_payer=False)
+            bot.generate_daily_unpaid_summary(by_payer=True)
+            ledger.reconcile(repair=False)
+        db.session.rollback()
+        assert _full_scans(q) == []
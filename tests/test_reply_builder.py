@@ -0,0 +1,121 @@
+"""
+Tests for reply_builder（長回覆分段）與 OrderBot 超過 5 則時改推播
+Run: pytest tests/ -v
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+from fake_line_server import FakeLineServer
+from line_client import LineClient
+from line_handler import OrderBot
+from reply_builder import DIVIDER, ReplyBuilder, split_text
+
+
+def _meal_text(meals, lines_per_meal, width=30):
+    b = ReplyBuilder().line('📋 今日訂單').line()
+    for m in range(meals):
+        b.line(f'【第{m}餐】{lines_per_meal} 筆')
+        b.lines(f'⏳ {i}. ' + '飯' * width for i in range(lines_per_meal))
+        b.line()
+    return b.render()
+
+
+class TestSplitText:
+    def test_short_text_untouched(self):
+        assert split_text('hello') == ['hello']
+        assert split_text('') == []
+
+    def test_chunks_respect_limit_and_keep_all_lines(self):
+        text = _meal_text(4, 40)
+        chunks = split_text(text, limit=1000)
+        assert len(chunks) > 1
+        assert all(len(c) <= 1000 for c in chunks)
+        kept = [line for c in chunks for line in c.split('\n') if line]
+        assert kept == [line for line in text.split('\n') if line]
+
+    def test_prefers_section_boundaries(self):
+        text = _meal_text(3, 10)       # 每餐約 400 字
+        chunks = split_text(text, limit=1000)
+        assert all(c.split('\n')[0].startswith(('📋', '【')) for c in chunks)
+
+    def test_long_section_is_split_by_line(self):
+        text = '\n'.join([DIVIDER] + ['x' * 90] * 30)
+        chunks = split_text(text, limit=500)
+        assert all(len(c) <= 500 for c in chunks)
+        assert sum(c.count('x' * 90) for c in chunks) == 30
+
+    def test_overlong_line_is_hard_split(self):
+        chunks = split_text('a' * 1200, limit=500)
+        assert [len(c) for c in chunks] == [500, 500, 200]
+
+    @pytest.mark.parametrize('limit', [20, 50, 1000])
+    def test_random_layouts_never_exceed_limit(self, limit):
+        import random
+        rng = random.Random(limit)
+        starts = ['', DIVIDER, '【午餐】', '']
+        for _ in range(3000):
+            lines = []
+            for _ in range(rng.randint(1, 40)):
+                if rng.random() < 0.3:
+                    lines.append(rng.choice(starts))
+                else:
+                    lines.append('x' * rng.randint(0, limit + limit // 2))
+            text = '\n'.join(lines)
+            chunks = split_text(text, limit=limit)
+            assert all(0 < len(c) <= limit for c in chunks), (limit, lines)
+            assert ''.join(''.join(chunks).split()) == ''.join(text.split())
+
+    def test_builder_renders_generators_lazily(self):
+        calls = []
+
+        def rows():
+            calls.append(1)
+            yield '一'
+            yield '二'
+
+        b = ReplyBuilder().line('標題').lines(rows()).divider()
+        assert calls == []
+        assert b.render() == f'標題\n一\n二\n{DIVIDER}'
+
+
+@pytest.fixture
+def server():
+    with FakeLineServer() as s:
+        yield s
+
+
+@pytest.fixture
+def line_bot(server):
+    b = OrderBot({'LINE_CHANNEL_ACCESS_TOKEN': 'token'})
+    b.line = LineClient('token', host=server.url)
+    return b
+
+
+class TestOverflow:
+    def test_reply_then_push_rest(self, line_bot, server):
+        text = _meal_text(8, 150)              # 約 8 餐 × 5 千字
+        assert len(split_text(text)) > 5
+        line_bot.send_reply('rt', text, push_to='Cgroup')
+        reply, *pushes = server.requests
+        assert reply['path'] == '/v2/bot/message/reply'
+        assert len(reply['body']['messages']) == 5
+        assert pushes and all(r['path'] == '/v2/bot/message/push' for r in pushes)
+        assert all(r['body']['to'] == 'Cgroup' for r in pushes)
+        sent = [m['text'] for r in server.requests for m in r['body']['messages']]
+        assert all(len(t) <= 5000 for t in sent)
+        assert sent == split_text(text)
+
+    def test_no_push_target_drops_overflow(self, line_bot, server, capsys):
+        line_bot.send_reply('rt', _meal_text(8, 150))
+        assert len(server.requests) == 1
+        assert '略過' in capsys.readouterr().out
+
+    def test_push_message_is_batched(self, line_bot, server):
+        assert line_bot.send_push_message('Cgroup', _meal_text(12, 150))
+        assert all(len(r['body']['messages']) <= 5 for r in server.requests)
+        assert len(server.requests) >= 2
@@ -0,0 +1,101 @@
+"""
+Tests for reply_cache.ReplyCache（唯讀指令回覆快取與寫入失效）
+Run: pytest tests/ -v
+"""
+import pytest
+
+from command_router import CommandRouter
+from models import db, Order, User
+from reply_cache import ReplyCache
+import ledger
+
+
+@pytest.fixture
+def cache(app):
+    c = ReplyCache(ttl=60).watch()
+    yield c
+    c.unwatch()
+
+
+@pytest.fixture
+def router(bot, cache):
+    r = CommandRouter(cache)
+    r.register_object(bot)
+    return r
+
+
+def _ask(router, text):
+    return router.dispatch(router.resolve(text), text=text)
+
+
+class TestReplyCache:
+    def test_hit_skips_queries(self, bot, seed, router, cache, count_queries):
+        bot.handle_order_command('!點 午餐 麗媽 1\n2. 肉羹飯', 'token')
+        first = _ask(router, '!統計')
+        with count_queries() as q:
+            assert _ask(router, '!統計') == first
+        assert q.count == 0
+        assert _ask(router, '!today') == bot.handle_today_summary()
+        m = cache.metrics()
+        assert (m['hits'], m['misses']) == (1, 2)
+        assert m['saved_ms'] > 0
+
+    def test_args_are_part_of_key(self, bot, seed, router):
+        bot.handle_order_command('!點 午餐 麗媽 1\n2. 肉羹飯\n3. 雞腿飯', 'token')
+        assert '$60' in _ask(router, '2')
+        assert '$90' in _ask(router, '3')
+
+    def test_order_command_invalidates(self, bot, seed, router):
+        bot.handle_order_command('!點 午餐 麗媽 1\n2. 肉羹飯', 'token')
+        assert '肉羹飯 × 1' in _ask(router, '!統計')
+        bot.handle_order_command('!點 午餐 麗媽 1\n3. 肉羹飯', 'token')
+        assert '肉羹飯 × 2' in _ask(router, '!統計')
+
+    def test_core_and_orm_writes_invalidate(self, bot, seed, router, cache):
+        bot.handle_order_command('!點 午餐 麗媽 1\n2. 肉羹飯', 'token')
+        _ask(router, '2')
+        version = cache.version
+
+        ledger.settle(User.query.filter_by(user_code='2').one().id)   # UPDATE ... RETURNING
+        db.session.commit()
+        assert cache.version == version + 1
+        assert '目前沒有欠款' in _ask(router, '2')
+
+        Order.query.one().amount = 70                                   # ORM flush
+        db.session.commit()
+        assert cache.version == version + 2
+
+    def test_rollback_and_unwatched_tables_keep_cache(self, seed, cache):
+        version = cache.version
+        db.session.add(User(user_code='99', name='路人'))
+        db.session.flush()
+        db.session.rollback()
+        from models import SystemSetting
+        SystemSetting.set('x', '1')
+        db.session.commit()
+        assert cache.version == version
+
+    def test_ttl_expiry(self, app, monkeypatch):
+        c = ReplyCache(ttl=5)
+        calls = []
+        now = [100.0]
+        monkeypatch.setattr('reply_cache.time.monotonic', lambda: now[0])
+        compute = lambda: calls.append(1) or f'回覆{len(calls)}'
+        assert c.get_or_compute(('today',), compute) == '回覆1'
+        assert c.get_or_compute(('today',), compute) == '回覆1'
+        now[0] += 6
+        assert c.get_or_compute(('today',), compute) == '回覆2'
+        assert c.metrics()['expired'] == 1
+
+    def test_disabled_and_uncached_commands(self, bot, seed, cache):
+        off = ReplyCache(ttl=0)
+        calls = []
+        assert off.get_or_compute(('x',), lambda: calls.append(1) or 'a') == 'a'
+        off.get_or_compute(('x',), lambda: calls.append(1) or 'a')
+        assert len(calls) == 2
+
+        r = CommandRouter(cache)
+        r.register_object(bot)
+        _ask(r, '!今天吃什麼')
+        _ask(r, '!說明')
+        assert cache.metrics()['misses'] == 0
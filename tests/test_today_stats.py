@@ -0,0 +1,66 @@
+"""
+Tests for !today / !統計（SQL 端加總，查詢數不隨訂單數增加）
+Run: pytest tests/ -v
+"""
+import pytest
+
+
+def _order(bot, body, header):
+    return bot.handle_order_command(header + '\n' + body, 'token')
+
+
+@pytest.fixture
+def orders(bot, seed):
+    def make(lunch_lines):
+        body = '\n'.join(f'{i % 10 + 1}. {("肉羹飯", "雞腿飯")[i % 2]}' for i in range(lunch_lines))
+        _order(bot, body, '!點 午餐 麗媽 1')
+        _order(bot, '2. 沙茶牛肉炒麵\n3. 不在菜單上', '!點 晚餐 1')
+    return make
+
+
+class TestTodaySummary:
+    def test_reply(self, bot, orders):
+        orders(2)
+        reply = bot.handle_today_summary()
+        assert '【午餐】2 筆\n⏳ 1. 人1 - 肉羹飯 ($60)\n⏳ 2. 人2 - 雞腿飯 ($90)\n' in reply
+        assert '【晚餐】2 筆\n⏳ 2. 人2 - 沙茶牛肉炒麵 ($80)\n⏳ 3. 人3 - 不在菜單上 ($0)\n' in reply
+        assert reply.endswith('💰 總計 $230｜已收 $0｜未收 $230')
+
+    @pytest.mark.parametrize('lines', [2, 40])
+    def test_query_count_bounded(self, bot, orders, count_queries, lines):
+        orders(lines)
+        with count_queries() as q:
+            bot.handle_today_summary()
+        assert q.count == 2
+
+
+class TestStats:
+    def test_all_meals(self, bot, orders):
+        orders(3)
+        assert bot.handle_stats_query('!統計').splitlines()[1:] == [
+            '─' * 20,
+            '【午餐】麗媽（3 份）',
+            '🍱 肉羹飯 × 2',
+            '🍱 雞腿飯 × 1',
+            '─' * 20,
+            '【晚餐】未指定店家（2 份）',
+            '🍱 不在菜單上 × 1',
+            '🍱 沙茶牛肉炒麵 × 1',
+            '─' * 20,
+            '今日總計 $290',
+        ]
+
+    def test_single_meal(self, bot, orders):
+        orders(3)
+        reply = bot.handle_stats_query('!統計 午餐')
+        assert reply.endswith('共 3 份，總計 $210')
+        assert '今日晚餐' not in bot.handle_stats_query('!統計 晚')
+        assert '還沒有訂單' in bot.handle_stats_query('!統計 早餐')
+
+    @pytest.mark.parametrize('lines', [2, 40])
+    def test_query_count_bounded(self, bot, orders, count_queries, lines):
+        orders(lines)
+        for text in ('!統計', '!統計 午餐'):
+            with count_queries() as q:
+                bot.handle_stats_query(text)
+            assert q.count == 1
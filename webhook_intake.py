@@ -0,0 +1,124 @@
+"""
+LINE Webhook 非同步收件
+
+/callback 驗完簽章就把原始 body 丟進 DurableQueue 並立刻回 200，
+由背景工作執行緒取出後再交給 WebhookHandler 處理（寫 DB、比對菜單、回覆訊息）。
+租約到期或 LINE 重送都可能讓同一個事件再跑一次；寫入端用 webhookEventId 去重
+（models.ProcessedEvent，與訂單同一個交易記錄）。
+"""
+import threading
+import time
+import traceback
+from collections import deque
+
+
+class WaitStats:
+    """最近 N 筆樣本的延遲統計（秒）"""
+
+    def __init__(self, window=1000):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+            self.total += seconds
+
+    def snapshot(self):
+        with self._lock:
+            samples = sorted(self._samples)
+            count, total = self.count, self.total
+        if not samples:
+            return {'count': count, 'avg': 0.0, 'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+
+        def pct(p):
+            return samples[min(len(samples) - 1, int(len(samples) * p))]
+        return {
+            'count': count,
+            'avg': round(total / count, 4) if count else 0.0,
+            'p50': round(pct(0.50), 4),
+            'p95': round(pct(0.95), 4),
+            'max': round(samples[-1], 4),
+        }
+
+
+class WebhookIntake:
+    def __init__(self, queue, process, workers=4, idle_wait=1.0):
+        """
+        queue:   DurableQueue
+        process: callable(payload dict) → 實際處理一筆 webhook（需自行建立 app context）
+        """
+        self.queue = queue
+        self.process = process
+        self.workers = workers
+        self.idle_wait = idle_wait
+        self.wait_time = WaitStats()
+        self.process_time = WaitStats()
+        self.processed = 0
+        self.failed = 0
+        self._threads = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def submit(self, body, signature, host_url=None):
+        return self.queue.enqueue({'body': body, 'signature': signature, 'host_url': host_url})
+
+    # ─── 工作執行緒 ───────────────────────────────────────────────
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f'webhook-worker-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        self.queue.notify()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim()
+            except Exception as e:
+                print(f'Webhook 佇列讀取失敗: {e}')
+                job = None
+            if job is None:
+                self.queue.wait(self.idle_wait)
+                continue
+            self.run_job(job)
+
+    def run_job(self, job):
+        self.wait_time.add(time.time() - job['enqueued_at'])
+        started = time.perf_counter()
+        try:
+            self.process(job['payload'])
+            self.queue.ack(job['id'])
+            with self._lock:
+                self.processed += 1
+        except Exception:
+            err = traceback.format_exc()
+            print(f'Webhook 處理失敗 (job {job["id"]}):\n{err}')
+            # 處理到一半失敗可能已寫入部分訂單，不自動重跑；只有行程中斷（租約到期）才會重新派送
+            self.queue.fail(job['id'], err[-2000:])
+            with self._lock:
+                self.failed += 1
+        finally:
+            self.process_time.add(time.perf_counter() - started)
+
+    # ─── 監控 ─────────────────────────────────────────────────────
+    def metrics(self):
+        return {
+            'workers': self.workers,
+            'alive_workers': sum(1 for t in self._threads if t.is_alive()),
+            'queue_depth': self.queue.depth(),
+            'queue_status': self.queue.counts(),
+            'processed': self.processed,
+            'failed': self.failed,
+            'wait_seconds': self.wait_time.snapshot(),
+            'process_seconds': self.process_time.snapshot(),
+        }